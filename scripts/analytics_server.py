@@ -3,24 +3,96 @@
 Lightweight open-source analytics + events collector using only Python stdlib + SQLite.
 
 Endpoints:
-  POST /api/collect         -> JSON event body, writes to sqlite (events.db)
+  POST /api/collect         -> JSON event body, queued and written to sqlite in batches
+  POST /api/ingest/bulk     -> NDJSON or CSV body (optionally gzip), streamed in large transactions;
+                               replies with written/invalid line counts
   GET  /api/stats/summary   -> basic counters (24h, 7d), top pages/searches
+  GET  /api/stats/ingest    -> ingestion queue depth and batch sizes (backpressure)
+  GET  /api/stats/snapshot  -> read snapshot generation, age and refresh timings
+  GET  /api/stats/cache     -> result cache hits, misses and invalidations
+  GET  /api/stats/funnel    -> view -> click -> appointment funnel per visitor (needs numpy)
+  GET  /api/stats/retention -> day-N retention and weekly cohorts (needs numpy)
+  GET  /api/stats/realtime  -> top blogs/searches/subscribe clicks for 1h/24h/7d from in-memory top-k
+  GET  /api/stream          -> Server-Sent Events: dashboard counter deltas once per second
+  GET  /metrics             -> Prometheus text format: request counts/latency, batch timings, file sizes
+  GET  /api/bulten/status   -> bulletin watcher process: scans, builds, pending documents, last error
+  POST /api/bulten/rebuild  -> queue a bulletin rebuild (?slug=..., default every bulletin)
+  GET  /api/export/uniques  -> approximate distinct visitors/sessions per day (by=page: per page)
+  GET  /api/export/events   -> raw events, CSV or NDJSON, streamed (chunked, optional gzip)
+                               with keyset cursors: since/until, order, limit, after_ts/after_id
   GET  /admin               -> simple dashboard UI (static HTML)
 
+Ingestion is write-behind: /api/collect only validates and enqueues events, a single
+writer thread drains the bounded queue and inserts each batch with executemany inside
+one transaction (group commit). When the queue is full the collector answers 503 so
+the browser keeps the events in its local queue and retries later.
+
 Auth: optional shared token via header X-Analytics-Token (set ANALYTICS_TOKEN env).
 
+Stats and CSV exports read hourly/daily rollup tables (rollup_pages, rollup_values)
+that the writer updates in the same transaction as the raw insert; only the leading
+partial hour of a window touches `events`. Rendered stats and aggregate CSV bodies are
+kept in an in-process result cache until a newly ingested event falls inside their
+window; CSV exports take an optional `until` (unix ts) to ask for a closed window,
+e.g. `days=30&until=<today 00:00 UTC>`, which then stays cached.
+
+Raw events live in one SQLite file per month (<db stem>-events/YYYY-MM.db), attached
+only for queries whose window overlaps that month. Each file stores a STRICT `facts`
+table with ua/ref/page/event/element interned into dict_* tables, plus an `events`
+view with the original columns. A periodic maintenance pass
+checkpoints WAL files, compacts closed months with VACUUM INTO and archives or drops
+months past the retention period (rollups are kept).
+
 Run:
   python3 scripts/analytics_server.py --host 127.0.0.1 --port 8787 --db analytics.db
+  python3 scripts/analytics_server.py --db analytics.db --rebuild-rollups   # recompute rollups
+  python3 scripts/analytics_server.py --db analytics.db --maintenance       # one maintenance pass
+  python3 scripts/analytics_server.py --db restored.db --load events.ndjson.gz   # load an export back
+  python3 scripts/analytics_server.py --engine asyncio --workers 8 --keepalive 75   # event loop server
+
+Ingestion tuning (flags or env):
+  --queue-size      ANALYTICS_QUEUE_SIZE      max queued requests before 503 (default 10000)
+  --batch-size      ANALYTICS_BATCH_SIZE      max events per transaction (default 500)
+  --batch-delay-ms  ANALYTICS_BATCH_DELAY_MS  max wait to fill a batch (default 200)
+  --readers         ANALYTICS_READERS         pooled read-only connections (default 8)
+  --result-cache    ANALYTICS_RESULT_CACHE    cached stats/export bodies (default 256, 0 = off)
+  --result-ttl      ANALYTICS_RESULT_TTL      max age of an open-window body in seconds (default 60)
+
+Partition maintenance (flags or env):
+  --retention-months      ANALYTICS_RETENTION_MONTHS  raw months to keep (default 0 = forever)
+  --retention-mode        ANALYTICS_RETENTION_MODE    archive | drop (default archive)
+  --maintenance-interval  ANALYTICS_MAINTENANCE_SEC   seconds between passes (default 3600, 0 = off)
+
+Read snapshot (flag or env):
+  --snapshot-interval  ANALYTICS_SNAPSHOT_SEC  seconds between snapshot refreshes (default 0 = off);
+                       summary, dashboard, funnel/retention and /api/export/* then read a copy
+                       made with the sqlite3 backup API and answer with X-Snapshot-Age
+
+Bulletin watcher (separate process, see scripts/bulten_worker.py):
+  --bulten-interval  ANALYTICS_BULTEN_SEC       seconds between site/bulten_doc scans (default 10, 0 = off)
+  --bulten-debounce  ANALYTICS_BULTEN_DEBOUNCE  seconds a changed document must settle (default 2)
 
 This server is tiny and file-based; suitable for local and low-traffic usage.
 """
+import asyncio
+import bisect
+import calendar
+import hashlib
+import io
+import itertools
 import json
+import math
+import queue
+import signal
+import sys
 import threading
+import zlib
 import time as _time
 import shutil
 import os
 import sqlite3
 import time
+from concurrent.futures import ThreadPoolExecutor
 from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 from urllib.parse import urlparse, parse_qs
 
@@ -28,6 +100,29 @@ ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
 # Default DB under data/runtime to keep repo root clean
 DB_PATH = os.environ.get("ANALYTICS_DB", os.path.join(ROOT, "data", "runtime", "analytics.db"))
 TOKEN = os.environ.get("ANALYTICS_TOKEN", "")
+QUEUE_SIZE = int(os.environ.get("ANALYTICS_QUEUE_SIZE", "10000"))
+BATCH_SIZE = int(os.environ.get("ANALYTICS_BATCH_SIZE", "500"))
+BATCH_DELAY_MS = int(os.environ.get("ANALYTICS_BATCH_DELAY_MS", "200"))
+RETENTION_MONTHS = int(os.environ.get("ANALYTICS_RETENTION_MONTHS", "0"))   # 0 = keep raw events forever
+RETENTION_MODE = os.environ.get("ANALYTICS_RETENTION_MODE", "archive")     # archive | drop
+MAINTENANCE_SEC = int(os.environ.get("ANALYTICS_MAINTENANCE_SEC", "3600"))
+
+# Repeated strings are interned per partition file into dict_<column>(id, s) tables;
+# the fact table stores their ids and the `events` view joins them back.
+DICT_COLUMNS = ('ua', 'ref', 'page', 'event', 'element')
+FACT_COLS = ("id, ts, client_id, session_id, ip, ua_id, ref_id, page_id, event_id, element_id, "
+             "value, props, start_hour, href_host, tag")
+# `{schema}` is the attached partition, e.g. p_202509 (see IngestQueue._partition)
+INSERT_FACT_SQL = f"INSERT INTO {{schema}}.facts({FACT_COLS}) VALUES ({','.join('?' * 15)})"
+DICT_CACHE = int(os.environ.get("ANALYTICS_DICT_CACHE", "20000"))   # string -> id entries kept by the writer
+SKETCH_CACHE = 2048   # decoded HyperLogLog sketches (4 KB each) kept by the writer
+RESULT_CACHE = int(os.environ.get("ANALYTICS_RESULT_CACHE", "256"))     # rendered stats/export bodies (0 = off)
+RESULT_TTL = int(os.environ.get("ANALYTICS_RESULT_TTL", "60"))          # seconds an open-window body may live
+BATCH_LOG = 4096   # committed batches remembered for result cache invalidation
+BULK_CHUNK = int(os.environ.get("ANALYTICS_BULK_CHUNK", "20000"))   # rows per /api/ingest/bulk transaction
+SNAPSHOT_SEC = int(os.environ.get("ANALYTICS_SNAPSHOT_SEC", "0"))   # seconds between read snapshots (0 = off)
+BULTEN_SEC = int(os.environ.get("ANALYTICS_BULTEN_SEC", "10"))    # bulletin watcher scan interval (0 = off)
+BULTEN_DEBOUNCE = float(os.environ.get("ANALYTICS_BULTEN_DEBOUNCE", "2"))   # seconds a changed doc must settle
 
 ADMIN_HTML = """<!DOCTYPE html><html lang=tr><meta charset=utf-8><title>Analytics Dashboard</title>
 <meta name=viewport content="width=device-width, initial-scale=1">
@@ -103,6 +198,12 @@ ADMIN_HTML = """<!DOCTYPE html><html lang=tr><meta charset=utf-8><title>Analytic
       </h2>
       <div class=muted>Son olayları CSV olarak indirebilirsiniz (varsayılan 10.000 satır).</div>
     </div>
+    <div class=card>
+      <h2>Tekil Ziyaretçi ve Oturum (14 gün)
+        <a href="/api/export/uniques?days=30&by=page" target="_blank" class="muted" style="font-size:12px; float:right">CSV indir</a>
+      </h2>
+      <canvas id=uniqCanvas></canvas>
+    </div>
   </div>
 </main>
 <script>
@@ -124,27 +225,52 @@ function drawBars(canvas, labels, values){
   const max = Math.max(1, ...values); const bw = W/(values.length*1.4);
   values.forEach((v,i)=>{ const x = i*(W/values.length)+bw*0.2; const h=(v/max)*H*0.8; ctx.fillStyle='#0b5ed7'; ctx.fillRect(x, H-h, bw, h); });
 }
-fetch('/api/stats/dashboard', {headers: token? {'X-Analytics-Token':token} : {}})
- .then(r=>r.json()).then(d=>{
-   q('last24').textContent = `Görüntüleme: ${d.last24.views} · Arama: ${d.last24.searches} · Tıklama: ${d.last24.clicks} · Randevu: ${d.last24.appointments} · E‑posta: ${d.last24.emails}`;
-   q('last7').textContent = `Görüntüleme: ${d.last7.views} · Arama: ${d.last7.searches} · Tıklama: ${d.last7.clicks} · Randevu: ${d.last7.appointments} · E‑posta: ${d.last7.emails}`;
-   q('last30').textContent = `Görüntüleme: ${d.last30.views} · Arama: ${d.last30.searches} · Tıklama: ${d.last30.clicks} · Randevu: ${d.last30.appointments} · E‑posta: ${d.last30.emails}`;
-   fillTable(q('topBlogs'), d.tops.blogs);
-   fillTable(q('topSearches'), d.tops.searches);
-   fillTable(q('subClicks'), d.tops.subs);
-   drawLine(q('tsCanvas'), [ {y:d.timeseries.appointments}, {y:d.timeseries.emails} ]);
-   drawBars(q('hourCanvas'), d.appointmentHours.labels, d.appointmentHours.values);
- }).catch(()=>{ q('last24').textContent='Veri yok'; q('last7').textContent='Veri yok'; });
+let D = null;
+function card(w){
+  const c=D[w], u=D.uniques[w];
+  q(w).textContent = `Görüntüleme: ${c.views} · Arama: ${c.searches} · Tıklama: ${c.clicks} · Randevu: ${c.appointments} · E‑posta: ${c.emails} · Tekil ziyaretçi: ~${u.visitors} · Oturum: ~${u.sessions}`;
+}
+function render(){
+   ['last24','last7','last30'].forEach(card);
+   fillTable(q('topBlogs'), D.tops.blogs);
+   fillTable(q('topSearches'), D.tops.searches);
+   fillTable(q('subClicks'), D.tops.subs);
+   drawLine(q('tsCanvas'), [ {y:D.timeseries.appointments}, {y:D.timeseries.emails} ]);
+   drawBars(q('hourCanvas'), D.appointmentHours.labels, D.appointmentHours.values);
+   drawLine(q('uniqCanvas'), [ {y:D.uniquesDaily.visitors}, {y:D.uniquesDaily.sessions} ]);
+}
+// /api/stream deltas (see LiveFeed.delta); sliding windows are re-synced by load()
+function apply(x){
+  for (const w in x.cards) for (const k in x.cards[w]) D[w][k] += x.cards[w][k];
+  for (const h in x.appointmentHours) D.appointmentHours.values[+h] += x.appointmentHours[h];
+  const ts = D.timeseries;
+  for (const day in x.days){
+    let i = ts.days.indexOf(+day);
+    if (i < 0){
+      if (ts.days.length && +day < ts.days[ts.days.length-1]) continue;
+      ts.days.push(+day); ts.appointments.push(0); ts.emails.push(0); i = ts.days.length-1;
+    }
+    ts.appointments[i] += x.days[day].appointments; ts.emails[i] += x.days[day].emails;
+  }
+}
+function load(){
+  return fetch('/api/stats/dashboard', {headers: token? {'X-Analytics-Token':token} : {}})
+    .then(r=>r.json()).then(d=>{ D=d; render(); });
+}
+load().then(()=>{
+  if (!window.EventSource) return;
+  const es = new EventSource('/api/stream' + (token? '?token='+encodeURIComponent(token) : ''));
+  es.addEventListener('delta', e=>{ if (D){ apply(JSON.parse(e.data)); render(); } });
+  setInterval(load, 5*60*1000);
+}).catch(()=>{ q('last24').textContent='Veri yok'; q('last7').textContent='Veri yok'; });
 </script>
 """
 
 
-def get_db():
-    dbp = os.environ.get("ANALYTICS_DB", DB_PATH)
-    os.makedirs(os.path.dirname(os.path.abspath(dbp)), exist_ok=True)
-    conn = sqlite3.connect(dbp)
-    conn.execute("PRAGMA journal_mode=WAL;")
-    conn.execute(
+# Applied once at startup, in order, tracked with PRAGMA user_version.
+# A step is either SQL text or a callable taking the connection (data backfills).
+MIGRATIONS = [
+    (1, [
         """
         CREATE TABLE IF NOT EXISTS events (
           id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -160,405 +286,3526 @@ def get_db():
           value TEXT,
           props TEXT
         );
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_events_ts ON events(ts);",
+        "CREATE INDEX IF NOT EXISTS idx_events_event ON events(event);",
+    ]),
+    # 2 and 3 ran against the single `events` table that migration 4 splits into
+    # monthly files; on fresh databases they only touch the empty legacy table.
+    (2, [
+        """
+        CREATE TABLE IF NOT EXISTS rollup_pages (
+          grain INTEGER NOT NULL,
+          bucket INTEGER NOT NULL,
+          event TEXT NOT NULL,
+          page TEXT NOT NULL,
+          n INTEGER NOT NULL,
+          PRIMARY KEY (grain, bucket, event, page)
+        ) WITHOUT ROWID;
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS rollup_values (
+          grain INTEGER NOT NULL,
+          bucket INTEGER NOT NULL,
+          event TEXT NOT NULL,
+          value TEXT NOT NULL,
+          n INTEGER NOT NULL,
+          PRIMARY KEY (grain, bucket, event, value)
+        ) WITHOUT ROWID;
+        """,
+        lambda conn: rebuild_rollups(conn, legacy=True),
+    ]),
+    (3, [
+        # Covering indexes picked from EXPLAIN QUERY PLAN (see HOT_QUERIES and
+        # scripts/check_query_plans.py). (ts, event) serves the raw window heads and
+        # ORDER BY ts, so it replaces idx_events_ts. The NOCASE collation lets the
+        # case-insensitive `event LIKE 'view%'` use the (event, ts, page) index.
+        "CREATE INDEX IF NOT EXISTS idx_events_ts_event ON events(ts, event);",
+        "CREATE INDEX IF NOT EXISTS idx_events_event_ts_page ON events(event COLLATE NOCASE, ts, page);",
+        "DROP INDEX IF EXISTS idx_events_ts;",
+    ]),
+    (4, [
+        """
+        CREATE TABLE IF NOT EXISTS partitions (
+          month TEXT PRIMARY KEY,
+          lo INTEGER NOT NULL,
+          hi INTEGER NOT NULL,
+          file TEXT NOT NULL,
+          state TEXT NOT NULL DEFAULT 'hot',
+          rows INTEGER NOT NULL DEFAULT 0
+        );
+        """,
+        "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL);",
+        lambda conn: split_events_into_partitions(conn),
+    ]),
+    (5, [
+        # HyperLogLog registers of client_id ('visitor') and session_id ('session') per
+        # UTC day, for the whole site (page '') and per page; see apply_sketches().
+        """
+        CREATE TABLE IF NOT EXISTS hll_sketches (
+          day INTEGER NOT NULL,
+          kind TEXT NOT NULL,
+          page TEXT NOT NULL,
+          sketch BLOB NOT NULL,
+          PRIMARY KEY (day, kind, page)
+        ) WITHOUT ROWID;
+        """,
+        lambda conn: rebuild_sketches(conn),
+    ]),
+    (6, [
+        # checkpoint of the in-memory heavy-hitter summaries (see TopK)
         """
-    )
-    conn.execute("CREATE INDEX IF NOT EXISTS idx_events_ts ON events(ts);")
-    conn.execute("CREATE INDEX IF NOT EXISTS idx_events_event ON events(event);")
-    return conn
+        CREATE TABLE IF NOT EXISTS topk_state (
+          category TEXT NOT NULL,
+          grain INTEGER NOT NULL,
+          bucket INTEGER NOT NULL,
+          item TEXT NOT NULL,
+          count INTEGER NOT NULL,
+          error INTEGER NOT NULL,
+          PRIMARY KEY (category, grain, bucket, item)
+        ) WITHOUT ROWID;
+        """,
+    ]),
+]
 
+# Schema of one monthly partition file, tracked with the file's own user_version.
+# Ids are assigned by the writer from meta.next_event_id, so they stay unique across files.
+PARTITION_MIGRATIONS = [
+    (1, [
+        """
+        CREATE TABLE IF NOT EXISTS events (
+          id INTEGER PRIMARY KEY,
+          ts INTEGER NOT NULL,
+          client_id TEXT,
+          session_id TEXT,
+          ip TEXT,
+          ua TEXT,
+          ref TEXT,
+          page TEXT,
+          event TEXT,
+          element TEXT,
+          value TEXT,
+          props TEXT
+        );
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_events_ts_event ON events(ts, event);",
+        "CREATE INDEX IF NOT EXISTS idx_events_event_ts_page ON events(event COLLATE NOCASE, ts, page);",
+        "CREATE INDEX IF NOT EXISTS idx_events_event ON events(event);",
+    ]),
+    # props fields the stats read, extracted once at ingest instead of json.loads per query
+    (2, [
+        "ALTER TABLE events ADD COLUMN start_hour INTEGER;",
+        "ALTER TABLE events ADD COLUMN href_host TEXT;",
+        "ALTER TABLE events ADD COLUMN tag TEXT;",
+        "CREATE INDEX IF NOT EXISTS idx_events_ts_start_hour ON events(ts, start_hour) WHERE start_hour IS NOT NULL;",
+        lambda conn: backfill_props_fields(conn),
+    ]),
+    # dictionary-encoded STRICT fact table; `events` stays as a view with the old columns.
+    # The view looks strings up with scalar subqueries, which drop out of queries that
+    # do not read that column, so (ts, event_id, page_id) stays a covering index.
+    (3, [f"CREATE TABLE IF NOT EXISTS dict_{col} (id INTEGER PRIMARY KEY, s TEXT NOT NULL UNIQUE) STRICT;"
+         for col in DICT_COLUMNS] + [
+        """
+        CREATE TABLE IF NOT EXISTS facts (
+          id INTEGER PRIMARY KEY,
+          ts INTEGER NOT NULL,
+          client_id ANY,
+          session_id ANY,
+          ip TEXT,
+          ua_id INTEGER,
+          ref_id INTEGER,
+          page_id INTEGER,
+          event_id INTEGER,
+          element_id INTEGER,
+          value ANY,
+          props TEXT,
+          start_hour INTEGER,
+          href_host TEXT,
+          tag TEXT
+        ) STRICT;
+        """,
+        lambda conn: copy_into_facts(conn, 'main', 'main.events'),
+        "DROP TABLE events;",
+        """
+        CREATE VIEW IF NOT EXISTS events AS
+        SELECT f.id, f.ts, f.client_id, f.session_id, f.ip,
+               (SELECT s FROM dict_ua WHERE id = f.ua_id) AS ua,
+               (SELECT s FROM dict_ref WHERE id = f.ref_id) AS ref,
+               (SELECT s FROM dict_page WHERE id = f.page_id) AS page,
+               (SELECT s FROM dict_event WHERE id = f.event_id) AS event,
+               (SELECT s FROM dict_element WHERE id = f.element_id) AS element,
+               f.value, f.props, f.start_hour, f.href_host, f.tag
+        FROM facts AS f;
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_facts_ts ON facts(ts, event_id, page_id);",
+        "CREATE INDEX IF NOT EXISTS idx_facts_ts_start_hour ON facts(ts, start_hour) WHERE start_hour IS NOT NULL;",
+    ]),
+]
 
-def ok_token(headers):
-    if not TOKEN:
-        return True
-    return headers.get('X-Analytics-Token', '') == TOKEN
+# Per-connection tuning. WAL makes synchronous=NORMAL durable up to the last checkpoint-safe commit.
+CONN_PRAGMAS = (
+    "PRAGMA synchronous=NORMAL;",
+    "PRAGMA cache_size=-16000;",      # 16 MB page cache
+    "PRAGMA mmap_size=268435456;",    # 256 MB memory-mapped reads
+    "PRAGMA temp_store=MEMORY;",
+    "PRAGMA busy_timeout=5000;",
+)
+STMT_CACHE = 256          # prepared statements kept per connection (keyed by SQL text)
+READER_POOL = int(os.environ.get("ANALYTICS_READERS", "8"))
 
 
-class Handler(BaseHTTPRequestHandler):
-    server_version = "VMAnalytics/1.0"
+# ---- Monthly partitions ---------------------------------------------------------
+# Raw events live in one SQLite file per UTC month next to the main database
+# (<db>-events/2025-09.db). The main file keeps rollups and the `partitions` catalog;
+# partitions are ATTACHed only for the queries that need their time range.
+COLD_GRACE = 2 * 86400   # late client timestamps may still land in a month this long after it ends
+WRITER_ATTACHED = 6      # partitions the writer keeps attached (SQLite allows 10); also months per commit
+LIVE_STATES = ('hot', 'cold')
 
-    def _set_cors(self):
-        self.send_header('Access-Control-Allow-Origin', '*')
-        self.send_header('Access-Control-Allow-Headers', 'Content-Type, X-Analytics-Token')
-        self.send_header('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
 
-    def do_OPTIONS(self):
-        self.send_response(204)
-        self._set_cors()
-        self.end_headers()
+def month_key(ts):
+    t = _time.gmtime(ts)
+    return f"{t.tm_year:04d}{t.tm_mon:02d}"
 
-    def do_GET(self):
-        parsed = urlparse(self.path)
-        if parsed.path == '/admin':
-            self.send_response(200)
-            self._set_cors()
-            self.send_header('Content-Type', 'text/html; charset=utf-8')
-            self.end_headers()
-            self.wfile.write(ADMIN_HTML.encode('utf-8'))
-            return
-        if parsed.path == '/api/stats/summary':
-            if not ok_token(self.headers):
-                self.send_response(401); self._set_cors(); self.end_headers(); return
-            conn = get_db()
-            now = int(time.time())
-            def count(event_like, since):
-                cur = conn.execute("SELECT count(*) FROM events WHERE ts>=? AND event LIKE ?", (since, event_like))
-                return cur.fetchone()[0]
-            last24 = now - 24*3600
-            last7 = now - 7*24*3600
-            data = {
-                'last24': {
-                    'views': count('view%', last24),
-                    'searches': count('search%', last24),
-                    'clicks': count('click%', last24),
-                },
-                'last7': {
-                    'views': count('view%', last7),
-                    'searches': count('search%', last7),
-                    'clicks': count('click%', last7),
-                },
-            }
-            # top pages & searches (7d)
-            cur = conn.execute("SELECT page, COUNT(*) c FROM events WHERE ts>=? AND event LIKE 'view%' AND page IS NOT NULL GROUP BY page ORDER BY c DESC LIMIT 10", (last7,))
-            pages = [{'page': r[0], 'c': r[1]} for r in cur.fetchall()]
-            cur = conn.execute("SELECT value, COUNT(*) c FROM events WHERE ts>=? AND event='search' AND value IS NOT NULL GROUP BY value ORDER BY c DESC LIMIT 10", (last7,))
-            searches = [{'k': r[0], 'c': r[1]} for r in cur.fetchall()]
-            data['tops'] = {'pages': pages, 'searches': searches}
-            self.send_response(200)
-            self._set_cors()
-            self.send_header('Content-Type', 'application/json')
-            self.end_headers()
-            self.wfile.write(json.dumps(data).encode('utf-8'))
-            return
-        if parsed.path == '/api/stats/dashboard':
-            if not ok_token(self.headers):
-                self.send_response(401); self._set_cors(); self.end_headers(); return
-            conn = get_db()
-            now = int(time.time())
-            span24 = now - 24*3600; span7 = now - 7*24*3600; span30 = now - 30*24*3600
-            def cnt(since, like):
-                return conn.execute("SELECT count(*) FROM events WHERE ts>=? AND event LIKE ?", (since, like)).fetchone()[0]
-            def cnt_eq(since, eq):
-                return conn.execute("SELECT count(*) FROM events WHERE ts>=? AND event=?", (since, eq)).fetchone()[0]
-            out = {
-              'last24': {'views':cnt(span24,'view%'),'searches':cnt(span24,'search%'),'clicks':cnt(span24,'click%'),'appointments':cnt_eq(span24,'appointment')+cnt_eq(span24,'appointment_gcal')+cnt_eq(span24,'appointment_api'),'emails':cnt_eq(span24,'email_send')},
-              'last7':  {'views':cnt(span7,'view%'),'searches':cnt(span7,'search%'),'clicks':cnt(span7,'click%'),'appointments':cnt_eq(span7,'appointment')+cnt_eq(span7,'appointment_gcal')+cnt_eq(span7,'appointment_api'),'emails':cnt_eq(span7,'email_send')},
-              'last30': {'views':cnt(span30,'view%'),'searches':cnt(span30,'search%'),'clicks':cnt(span30,'click%'),'appointments':cnt_eq(span30,'appointment')+cnt_eq(span30,'appointment_gcal')+cnt_eq(span30,'appointment_api'),'emails':cnt_eq(span30,'email_send')},
-            }
-            # top blogs (7d)
-            cur = conn.execute("SELECT page, COUNT(*) c FROM events WHERE ts>=? AND event LIKE 'view%' AND page LIKE '%/blog/%' GROUP BY page ORDER BY c DESC LIMIT 10", (span7,))
-            blogs = [{'page': r[0], 'c': r[1]} for r in cur.fetchall()]
-            # top searches (7d)
-            cur = conn.execute("SELECT value, COUNT(*) c FROM events WHERE ts>=? AND event='search' AND value IS NOT NULL GROUP BY value ORDER BY c DESC LIMIT 10", (span7,))
-            searches = [{'q': r[0], 'c': r[1]} for r in cur.fetchall()]
-            # subscribe clicks (7d)
-            cur = conn.execute("SELECT COALESCE(page,'(yok)') k, COUNT(*) c FROM events WHERE ts>=? AND event='click' AND (element LIKE '%subscribe%' OR props LIKE '%youtube.com/%') GROUP BY page ORDER BY c DESC LIMIT 10", (span7,))
-            subs = [{'k': r[0], 'c': r[1]} for r in cur.fetchall()]
-            # timeseries (14d) appointments & emails
-            days = 14
-            from_dt = now - days*24*3600
-            cur = conn.execute("SELECT (ts/86400) d, event, COUNT(*) c FROM events WHERE ts>=? AND event IN ('appointment','appointment_gcal','appointment_api','email_send') GROUP BY d, event", (from_dt,))
-            agg = {}
-            for drow in cur.fetchall():
-                dkey = int(drow[0]); evt = drow[1]; c = drow[2]; agg.setdefault(dkey, {'apt':0,'mail':0});
-                if evt.startswith('appointment'): agg[dkey]['apt'] += c
-                if evt=='email_send': agg[dkey]['mail'] += c
-            # collapse to arrays
-            if agg:
-                min_d = min(agg.keys()); max_d = max(agg.keys())
-            else:
-                min_d = int(from_dt/86400); max_d = int(now/86400)
-            apt = []; mail = []
-            for dkey in range(min_d, max_d+1):
-                v = agg.get(dkey, {'apt':0,'mail':0}); apt.append(v['apt']); mail.append(v['mail'])
-            # appointment hour histogram (from props.start)
-            cur = conn.execute("SELECT props FROM events WHERE ts>=? AND event IN ('appointment','appointment_gcal','appointment_api')", (span30,))
-            hours = [0]*24
-            import json as _j
-            for (pstr,) in cur.fetchall():
-                try:
-                    pobj = _j.loads(pstr or '{}');
-                    s = pobj.get('start')
-                    if s and len(s)>=13:
-                        hh = int(s[11:13]); hours[hh] += 1
-                except Exception:
-                    pass
-            out['tops'] = {'blogs': blogs, 'searches': searches, 'subs': subs}
-            out['timeseries'] = {'appointments': apt, 'emails': mail}
-            out['appointmentHours'] = {'labels': [f"{i:02d}" for i in range(24)], 'values': hours}
-            self.send_response(200)
-            self._set_cors()
-            self.send_header('Content-Type', 'application/json')
-            self.end_headers()
-            self.wfile.write(json.dumps(out).encode('utf-8'))
-            return
-        # CSV exports
-        if parsed.path.startswith('/api/export/'):
-            if not ok_token(self.headers):
-                self.send_response(401); self._set_cors(); self.end_headers(); return
-            conn = get_db();
-            qs = parse_qs(urlparse(self.path).query)
-            def get_int(name, default):
-                try:
-                    return int((qs.get(name) or [default])[0])
-                except Exception:
-                    return default
-            days = get_int('days', 7)
-            now = int(time.time()); since = now - days*24*3600
-            import csv, io
-            def write_csv(filename, header, rows):
-                buf = io.StringIO(); w = csv.writer(buf)
-                w.writerow(header)
-                for r in rows: w.writerow(r)
-                data = buf.getvalue().encode('utf-8')
-                self.send_response(200)
-                self._set_cors()
-                self.send_header('Content-Type', 'text/csv; charset=utf-8')
-                self.send_header('Content-Disposition', f'attachment; filename="{filename}"')
-                self.end_headers(); self.wfile.write(data)
-            # routes
-            if parsed.path == '/api/export/top_blogs':
-                cur = conn.execute("SELECT page, COUNT(*) c FROM events WHERE ts>=? AND event LIKE 'view%' AND page LIKE '%/blog/%' GROUP BY page ORDER BY c DESC LIMIT 100", (since,))
-                rows = [(r[0], r[1]) for r in cur.fetchall()]
-                write_csv('top_blogs.csv', ['page','views'], rows); return
-            if parsed.path == '/api/export/top_searches':
-                cur = conn.execute("SELECT value, COUNT(*) c FROM events WHERE ts>=? AND event='search' AND value IS NOT NULL GROUP BY value ORDER BY c DESC LIMIT 100", (since,))
-                rows = [(r[0], r[1]) for r in cur.fetchall()]
-                write_csv('top_searches.csv', ['query','count'], rows); return
-            if parsed.path == '/api/export/sub_clicks':
-                cur = conn.execute("SELECT COALESCE(page,'(yok)') p, COUNT(*) c FROM events WHERE ts>=? AND event='click' AND (element LIKE '%subscribe%' OR props LIKE '%youtube.com/%') GROUP BY page ORDER BY c DESC LIMIT 200", (since,))
-                rows = [(r[0], r[1]) for r in cur.fetchall()]
-                write_csv('subscribe_clicks.csv', ['page','clicks'], rows); return
-            if parsed.path == '/api/export/timeseries':
-                from_dt = since
-                cur = conn.execute("SELECT (ts/86400) d, event, COUNT(*) c FROM events WHERE ts>=? AND event IN ('appointment','appointment_gcal','appointment_api','email_send') GROUP BY d, event", (from_dt,))
-                agg = {}
-                for drow in cur.fetchall():
-                    dkey = int(drow[0]); evt = drow[1]; c = drow[2]; agg.setdefault(dkey, {'apt':0,'mail':0});
-                    if evt.startswith('appointment'): agg[dkey]['apt'] += c
-                    if evt=='email_send': agg[dkey]['mail'] += c
-                rows=[]
-                if agg:
-                    min_d=min(agg.keys()); max_d=max(agg.keys())
+
+def month_bounds(month):
+    y, m = int(month[:4]), int(month[4:])
+    lo = calendar.timegm((y, m, 1, 0, 0, 0))
+    hi = calendar.timegm((y + (m == 12), m % 12 + 1, 1, 0, 0, 0))
+    return lo, hi
+
+
+def main_path(conn):
+    return next(row[2] for row in conn.execute("PRAGMA database_list;") if row[1] == 'main')
+
+
+def partition_dir(path):
+    stem = os.path.splitext(os.path.abspath(path))[0]
+    return stem + '-events'
+
+
+def file_size(path):
+    """Bytes on disk for a database file including its -wal."""
+    return sum(os.path.getsize(p) for p in (path, path + '-wal') if os.path.exists(p))
+
+
+def migrate_file(conn, migrations):
+    """Apply numbered migrations tracked in the file's PRAGMA user_version; returns the old version."""
+    version = conn.execute("PRAGMA user_version;").fetchone()[0]
+    for target, statements in migrations:
+        if target <= version:
+            continue
+        with conn:
+            for step in statements:
+                if callable(step):
+                    step(conn)
                 else:
-                    min_d=int(from_dt/86400); max_d=int(now/86400)
-                import datetime
-                for dkey in range(min_d, max_d+1):
-                    date = datetime.datetime.utcfromtimestamp(dkey*86400).strftime('%Y-%m-%d')
-                    v = agg.get(dkey, {'apt':0,'mail':0}); rows.append((date, v['apt'], v['mail']))
-                write_csv('timeseries.csv', ['date','appointments','emails'], rows); return
-            if parsed.path == '/api/export/appointment_hours':
-                cur = conn.execute("SELECT props FROM events WHERE ts>=? AND event IN ('appointment','appointment_gcal','appointment_api')", (since,))
-                hours=[0]*24; import json as _j
-                for (pstr,) in cur.fetchall():
+                    conn.execute(step)
+            conn.execute(f"PRAGMA user_version={int(target)};")
+    return version
+
+
+def open_partition(conn, month):
+    """Create (or upgrade) the partition file for `month`, register it, return its path."""
+    row = conn.execute("SELECT file, state FROM partitions WHERE month = ?", (month,)).fetchone()
+    base = os.path.dirname(main_path(conn))
+    if row is None:
+        rel = os.path.join(os.path.basename(partition_dir(main_path(conn))), f"{month[:4]}-{month[4:]}.db")
+        state = 'hot'
+    else:
+        rel, state = row
+    path = os.path.join(base, rel)
+    if state in LIVE_STATES:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        before = file_size(path)
+        pc = sqlite3.connect(path)
+        try:
+            if state == 'hot':
+                pc.execute("PRAGMA journal_mode=WAL;")
+            if 0 < migrate_file(pc, PARTITION_MIGRATIONS) < 3:
+                # existing rows were rewritten into the dictionary layout: reclaim the old pages
+                pc.execute("PRAGMA wal_checkpoint(TRUNCATE);")
+                pc.execute("VACUUM")
+                pc.execute("PRAGMA wal_checkpoint(TRUNCATE);")
+                after = file_size(path)
+                print(f"[migrate] {os.path.basename(path)}: {before} -> {after} bytes "
+                      f"({100 * (after - before) // max(before, 1)}%)")
+        finally:
+            pc.close()
+    if row is None:
+        lo, hi = month_bounds(month)
+        conn.execute("INSERT OR IGNORE INTO partitions(month, lo, hi, file) VALUES (?,?,?,?)", (month, lo, hi, rel))
+    return path, state
+
+
+def attach(conn, month, path):
+    alias = f"p_{month}"
+    conn.execute("ATTACH DATABASE ? AS " + alias, (path,))
+    return alias
+
+
+def detach_all(conn):
+    for row in conn.execute("PRAGMA database_list;").fetchall():
+        if row[1].startswith('p_'):
+            conn.execute("DETACH DATABASE " + row[1])
+
+
+def each_partition(conn, since, until, desc=False):
+    """Attach the live partitions overlapping [since, until) one at a time.
+
+    Yields the table name to put in `{events}`; the partition is detached again when
+    the caller moves on, so a full-history scan keeps at most one file attached.
+    """
+    base = os.path.dirname(main_path(conn))
+    order = 'DESC' if desc else 'ASC'
+    rows = conn.execute(
+        f"SELECT month, file FROM partitions WHERE hi > ? AND lo < ? AND state IN ('hot','cold') ORDER BY month {order}",
+        (since, until),
+    ).fetchall()
+    for month, rel in rows:
+        alias = attach(conn, month, os.path.join(base, rel))
+        try:
+            yield alias + '.events'
+        finally:
+            if conn.in_transaction:
+                conn.commit()
+            conn.execute("DETACH DATABASE " + alias)
+
+
+def copy_into_facts(conn, schema, src, where="1", params=(), extracted=True):
+    """Copy rows of an old-layout events table `src` into `schema`.facts, interning strings."""
+    for col in DICT_COLUMNS:
+        conn.execute(f"INSERT OR IGNORE INTO {schema}.dict_{col}(s) "
+                     f"SELECT DISTINCT {col} FROM {src} WHERE ({where}) AND {col} IS NOT NULL", params)
+    ids = ", ".join(f"(SELECT id FROM {schema}.dict_{col} WHERE s = x.{col})" for col in DICT_COLUMNS)
+    extra = "x.start_hour, x.href_host, x.tag" if extracted else "NULL, NULL, NULL"
+    conn.execute(f"INSERT OR IGNORE INTO {schema}.facts({FACT_COLS}) "
+                 f"SELECT x.id, x.ts, x.client_id, x.session_id, x.ip, {ids}, x.value, x.props, {extra} "
+                 f"FROM {src} AS x WHERE {where}", params)
+
+
+def split_events_into_partitions(conn):
+    """Migration 4: move rows of the legacy `events` table into monthly files (idempotent)."""
+    has_legacy = conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='events'").fetchone()
+    next_id = 1
+    if has_legacy:
+        conn.commit()
+        months = [r[0] for r in conn.execute("SELECT DISTINCT strftime('%Y%m', ts, 'unixepoch') FROM events WHERE ts IS NOT NULL")]
+        next_id = (conn.execute("SELECT MAX(id) FROM events").fetchone()[0] or 0) + 1
+        for month in months:
+            path, _state = open_partition(conn, month)
+            conn.commit()
+            lo, hi = month_bounds(month)
+            alias = attach(conn, month, path)
+            with conn:
+                copy_into_facts(conn, alias, 'main.events', "ts >= ? AND ts < ?", (lo, hi), extracted=False)
+                backfill_props_fields(conn, f"{alias}.events", f"{alias}.facts")
+                conn.execute("DELETE FROM events WHERE ts >= ? AND ts < ?", (lo, hi))
+                n = conn.execute(f"SELECT COUNT(*) FROM {alias}.facts").fetchone()[0]
+                conn.execute("UPDATE partitions SET rows = ? WHERE month = ?", (n, month))
+            conn.execute("DETACH DATABASE " + alias)
+        conn.execute("DROP TABLE events;")
+    conn.execute("INSERT OR IGNORE INTO meta(key, value) VALUES ('next_event_id', ?)", (next_id,))
+
+
+class Database:
+    """Owns the SQLite file: one-time schema bootstrap plus reusable connections.
+
+    The ingestion writer gets its own connection via writer(). Request threads borrow
+    read-only connections from a small pool with acquire()/release(); connections are
+    never reopened per request, so pragmas and the statement cache stay warm.
+    """
+
+    def __init__(self, path, readers=READER_POOL, bootstrap=True):
+        self.path = os.path.abspath(path)
+        self.readers = max(1, readers)
+        self._pool = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._open = 0
+        self.closed = False
+        if bootstrap:
+            self.bootstrap()
+
+    def bootstrap(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        conn = sqlite3.connect(self.path)
+        try:
+            conn.execute("PRAGMA journal_mode=WAL;")
+            migrate_file(conn, MIGRATIONS)
+            # bring every live partition file up to the current partition schema
+            next_id = conn.execute("SELECT value FROM meta WHERE key = 'next_event_id'").fetchone()[0]
+            for (month,) in conn.execute("SELECT month FROM partitions WHERE state IN ('hot','cold')").fetchall():
+                path, state = open_partition(conn, month)
+                if state == 'hot':
+                    # a crash between file commits could leave ids past the stored counter
+                    alias = attach(conn, month, path)
+                    top = conn.execute(f"SELECT MAX(id) FROM {alias}.facts").fetchone()[0]
+                    next_id = max(next_id, (top or 0) + 1)
+                    conn.commit()
+                    detach_all(conn)
+            conn.execute("UPDATE meta SET value = ? WHERE key = 'next_event_id'", (next_id,))
+            conn.commit()
+            # moving the legacy table out leaves mostly free pages behind; give them back once
+            free, pages = (conn.execute(f"PRAGMA {p}").fetchone()[0] for p in ('freelist_count', 'page_count'))
+            if free * 2 > pages:
+                before = file_size(self.path)
+                conn.execute("VACUUM")
+                conn.execute("PRAGMA wal_checkpoint(TRUNCATE);")
+                print(f"[migrate] {os.path.basename(self.path)}: {before} -> {file_size(self.path)} bytes")
+        finally:
+            conn.close()
+
+    def _connect(self, readonly):
+        conn = sqlite3.connect(self.path, check_same_thread=False, cached_statements=STMT_CACHE)
+        for pragma in CONN_PRAGMAS:
+            conn.execute(pragma)
+        if readonly:
+            conn.execute("PRAGMA query_only=ON;")
+        return conn
+
+    def writer(self):
+        """New read-write connection, owned by the caller (the ingest writer thread)."""
+        return self._connect(readonly=False)
+
+    def acquire(self):
+        try:
+            return self._pool.get_nowait()
+        except queue.Empty:
+            pass
+        conn = self._connect(readonly=True)
+        with self._lock:
+            self._open += 1
+        return conn
+
+    def release(self, conn):
+        # a read that raised may leave a transaction open; drop it before reuse
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+            detach_all(conn)
+        except sqlite3.Error:
+            conn.close(); self._discard(); return
+        if not self.closed and self._pool.qsize() < self.readers:
+            self._pool.put(conn)
+        else:
+            conn.close(); self._discard()
+
+    def _discard(self):
+        with self._lock:
+            self._open -= 1
+
+    def open_readers(self):
+        with self._lock:
+            return self._open
+
+    def rebuild_rollups(self):
+        conn = self.writer()
+        try:
+            return rebuild_rollups(conn)
+        finally:
+            conn.close()
+
+    def maintain(self, conn, now=None, retention_months=RETENTION_MONTHS, retention_mode=RETENTION_MODE):
+        """Checkpoint WAL files, compact closed months and apply the retention policy.
+
+        Runs on the writer connection (between batches), so nothing else writes meanwhile.
+        Files replaced here are deleted on the next pass, giving readers that attached
+        them a full maintenance interval to finish.
+        """
+        now = int(now or time.time())
+        report = {'compacted': [], 'retired': [], 'removed': []}
+        detach_all(conn)
+        base = os.path.dirname(self.path)
+        pdir = partition_dir(self.path)
+        live = {os.path.join(base, r[0]) for r in conn.execute("SELECT file FROM partitions WHERE state IN ('hot','cold')")}
+        trash = getattr(self, '_trash', None)
+        if trash is None:
+            # first pass after start: anything in the partition dir the catalog forgot
+            trash = []
+            if os.path.isdir(pdir):
+                trash = [os.path.join(pdir, f) for f in os.listdir(pdir)
+                         if f.endswith('.db') and os.path.join(pdir, f) not in live]
+        else:
+            for path in trash:
+                for suffix in ('', '-wal', '-shm', '-journal'):
                     try:
-                        pobj=_j.loads(pstr or '{}'); s=pobj.get('start');
-                        if s and len(s)>=13:
-                            hh=int(s[11:13]); hours[hh]+=1
-                    except Exception: pass
-                rows=[(f"{i:02d}", hours[i]) for i in range(24)]
-                write_csv('appointment_hours.csv', ['hour','count'], rows); return
-            if parsed.path == '/api/export/events':
-                limit = get_int('limit', 10000)
-                cur = conn.execute("SELECT ts, client_id, session_id, ip, ua, ref, page, event, element, value, props FROM events ORDER BY ts DESC LIMIT ?", (limit,))
-                rows = cur.fetchall()
-                write_csv('events.csv', ['ts','client_id','session_id','ip','ua','ref','page','event','element','value','props'], rows); return
-        self.send_response(404)
-        self._set_cors()
-        self.end_headers()
+                        os.remove(path + suffix)
+                    except FileNotFoundError:
+                        pass
+                report['removed'].append(os.path.basename(path))
+            trash = []
+        # compact months that can no longer receive events into a cold, vacuumed file
+        for month, rel in conn.execute(
+                "SELECT month, file FROM partitions WHERE state = 'hot' AND hi + ? <= ?", (COLD_GRACE, now)).fetchall():
+            src = os.path.join(base, rel)
+            cold_rel = rel[:-len('.db')] + '.cold.db'
+            dst = os.path.join(base, cold_rel)
+            if os.path.exists(dst):
+                os.remove(dst)
+            pc = sqlite3.connect(src)
+            try:
+                pc.execute("PRAGMA wal_checkpoint(TRUNCATE);")
+                pc.execute("VACUUM INTO ?", (dst,))
+            finally:
+                pc.close()
+            dc = sqlite3.connect(dst)
+            try:
+                dc.execute("PRAGMA journal_mode=DELETE;")
+            finally:
+                dc.close()
+            with conn:
+                conn.execute("UPDATE partitions SET file = ?, state = 'cold' WHERE month = ?", (cold_rel, month))
+            trash.append(src)
+            report['compacted'].append(month)
+        # retention: raw months older than the window go away; their rollups stay
+        if retention_months > 0:
+            t = _time.gmtime(now)
+            months_back = t.tm_year * 12 + (t.tm_mon - 1) - retention_months
+            cutoff = month_bounds(f"{months_back // 12:04d}{months_back % 12 + 1:02d}")[0]
+            for month, rel in conn.execute(
+                    "SELECT month, file FROM partitions WHERE state = 'cold' AND hi <= ?", (cutoff,)).fetchall():
+                src = os.path.join(base, rel)
+                new_rel, state = rel, 'dropped'
+                if retention_mode == 'archive':
+                    new_rel = os.path.join(os.path.basename(pdir), 'archive', f"{month[:4]}-{month[4:]}.db")
+                    os.makedirs(os.path.join(pdir, 'archive'), exist_ok=True)
+                    shutil.copy2(src, os.path.join(base, new_rel))
+                    state = 'archived'
+                with conn:
+                    conn.execute("UPDATE partitions SET file = ?, state = ? WHERE month = ?", (new_rel, state, month))
+                trash.append(src)
+                report['retired'].append(month)
+        self._trash = trash
+        # keep -wal files from growing between checkpoints
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE);")
+        for (rel,) in conn.execute("SELECT file FROM partitions WHERE state = 'hot'").fetchall():
+            pc = sqlite3.connect(os.path.join(base, rel))
+            try:
+                pc.execute("PRAGMA busy_timeout=5000;")
+                pc.execute("PRAGMA wal_checkpoint(TRUNCATE);")
+            finally:
+                pc.close()
+        return report
 
-    def do_POST(self):
-        parsed = urlparse(self.path)
-        if parsed.path == '/api/collect':
-            if not ok_token(self.headers):
-                self.send_response(401); self._set_cors(); self.end_headers(); return
-            length = int(self.headers.get('Content-Length', '0') or 0)
-            raw = self.rfile.read(length) if length else b''
+    def close(self):
+        # connections still borrowed are closed when they come back
+        self.closed = True
+        while True:
             try:
-                ev = json.loads(raw.decode('utf-8')) if raw else {}
-            except Exception:
-                self.send_response(400); self._set_cors(); self.end_headers(); return
-            # Insert (single or batch)
-            now = int(time.time())
-            conn = get_db()
-            def insert_one(eo):
-                try:
-                    conn.execute(
-                        "INSERT INTO events(ts, client_id, session_id, ip, ua, ref, page, event, element, value, props) VALUES (?,?,?,?,?,?,?,?,?,?,?)",
-                        (
-                            int(eo.get('ts') or now),
-                            eo.get('cid'), eo.get('sid'),
-                            self.client_address[0], self.headers.get('User-Agent',''),
-                            eo.get('ref'), eo.get('page'),
-                            eo.get('event'), eo.get('element'), eo.get('value'),
-                            json.dumps(eo.get('props') or {}, ensure_ascii=False),
-                        )
-                    )
-                except Exception:
-                    pass
-            if isinstance(ev, dict) and 'batch' in ev and isinstance(ev['batch'], list):
-                for item in ev['batch']:
-                    if isinstance(item, dict):
-                        insert_one(item)
-                try: conn.commit()
-                except Exception: pass
-            else:
-                insert_one(ev)
-                try: conn.commit()
-                except Exception: pass
-            self.send_response(204)
-            self._set_cors()
-            self.end_headers()
-            return
-        self.send_response(404)
-        self._set_cors()
-        self.end_headers()
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                break
+            self._discard()
 
 
-def main():
-    import argparse
-    p = argparse.ArgumentParser()
-    p.add_argument('--host', default='127.0.0.1')
-    p.add_argument('--port', type=int, default=8787)
-    p.add_argument('--db', default=DB_PATH)
-    args = p.parse_args()
-    os.environ['ANALYTICS_DB'] = args.db
-    httpd = ThreadingHTTPServer((args.host, args.port), Handler)
-    print(f"Analytics server running on http://{args.host}:{args.port}  db={args.db}")
-    # Background watcher: convert site/bulten_doc/*.html to bulletins
-    def bulten_watcher():
-        docs_dir = os.path.join(ROOT, 'site', 'bulten_doc')
-        data_dir = os.path.join(ROOT, 'data', 'bultenler')
-        site_bulten_assets = os.path.join(ROOT, 'site', 'bultenler', 'assets')
-        os.makedirs(docs_dir, exist_ok=True)
-        os.makedirs(data_dir, exist_ok=True)
-        os.makedirs(site_bulten_assets, exist_ok=True)
-        snap = {}
-        def monday_of(dt):
-            from datetime import timedelta
-            return dt - timedelta(days=dt.weekday())
-        TR_MONTHS = {1:'Ocak',2:'Şubat',3:'Mart',4:'Nisan',5:'Mayıs',6:'Haziran',7:'Temmuz',8:'Ağustos',9:'Eylül',10:'Ekim',11:'Kasım',12:'Aralık'}
-        def weekly_title_slug(dt):
-            t = f"Verinin Dünyası {dt.day} {TR_MONTHS.get(dt.month, dt.strftime('%b'))}"
-            slug = f"verinin-dunyasi-{dt.strftime('%Y-%m-%d')}"
-            return t, slug, dt.strftime('%Y-%m-%d')
-        def extract_title_body(html):
-            import re
-            m = re.search(r"<title>(.*?)</title>", html, re.IGNORECASE|re.DOTALL)
-            title = (m.group(1).strip() if m else 'Haftalık Bülten')
-            m2 = re.search(r"<body[^>]*>([\s\S]*?)</body>", html, re.IGNORECASE)
-            body = m2.group(1) if m2 else html
-            body = re.sub(r"<!--.*?-->", " ", body, flags=re.DOTALL)
-            body = re.sub(r"<style[\s\S]*?</style>", " ", body, flags=re.IGNORECASE)
-            body = re.sub(r"\sstyle=\"[^\"]*\"", "", body)
-            return title, body.strip()
-        def rewrite_assets(body, src_dir, slug):
-            import re
-            out_assets = os.path.join(site_bulten_assets, slug)
-            os.makedirs(out_assets, exist_ok=True)
-            def repl(m):
-                attr, url = m.group(1), m.group(2)
-                if url.startswith(('http:','https:','data:','assets/','../','/')):
-                    return m.group(0)
-                src_path = os.path.join(src_dir, url)
-                base = os.path.basename(url)
-                dst_path = os.path.join(out_assets, base)
-                try:
-                    if os.path.isfile(src_path): shutil.copy2(src_path, dst_path)
-                except Exception: pass
-                new_url = f"assets/{slug}/{base}"
-                return f'{attr}="{new_url}"'
-            body = re.sub(r"(src)=\"([^\"]+)\"", repl, body, flags=re.IGNORECASE)
-            body = re.sub(r"(href)=\"([^\"]+)\"", repl, body, flags=re.IGNORECASE)
-            return body
-        def find_folder_cover(src_dir):
+# ---- Rollups -------------------------------------------------------------------
+# Event counts pre-aggregated per hour and per day, keyed by (event, page) and
+# (event, value). The ingest writer updates them in the same transaction as the raw
+# insert, so stats read O(window) rollup rows instead of scanning `events`.
+HOUR = 3600
+DAY = 86400
+GRAINS = (HOUR, DAY)
+APPOINTMENT_EVENTS = ('appointment', 'appointment_gcal', 'appointment_api')
+# Derived rollup keys. '#' keeps them clear of the LIKE 'view%'/'click%' categories.
+SUB_CLICK = '#subscribe_click'     # rollup_pages: click on a subscribe button / YouTube link
+APPOINTMENT_HOUR = '#appointment_hour'   # rollup_values: value is the HH of props.start
+
+ROLLUP_UPSERT_SQL = {
+    'pages': "INSERT INTO rollup_pages(grain, bucket, event, page, n) VALUES (?,?,?,?,?) "
+             "ON CONFLICT(grain, bucket, event, page) DO UPDATE SET n = n + excluded.n",
+    'values': "INSERT INTO rollup_values(grain, bucket, event, value, n) VALUES (?,?,?,?,?) "
+              "ON CONFLICT(grain, bucket, event, value) DO UPDATE SET n = n + excluded.n",
+}
+RAW_ROLLUP_COLS = "ts, page, event, element, value, start_hour, href_host"
+
+
+def props_fields(event, props):
+    """(start_hour, href_host, tag) pulled out of a props dict; None where absent.
+
+    start_hour is the HH of props.start for appointment events, href_host the
+    lower-cased host of props.href.
+    """
+    if not isinstance(props, dict):
+        return None, None, None
+    hh = None
+    if event in APPOINTMENT_EVENTS:
+        s = props.get('start')
+        try:
+            if isinstance(s, str) and len(s) >= 13 and 0 <= int(s[11:13]) < 24:
+                hh = int(s[11:13])
+        except ValueError:
+            pass
+    host = None
+    href = props.get('href')
+    if isinstance(href, str) and href:
+        try:
+            host = urlparse(href).hostname
+        except ValueError:
+            pass
+    tag = props.get('tag')
+    return hh, host or None, tag if isinstance(tag, str) else None
+
+
+def backfill_props_fields(conn, table='events', target=None, chunk=10000):
+    """Partition migration 2: fill start_hour/href_host/tag for existing rows, in id batches.
+
+    Rows are read from `table` and updated in `target` (default: the same table).
+    """
+    last_id = 0
+    while True:
+        rows = conn.execute(
+            f"SELECT id, event, props FROM {table} WHERE id > ? AND props IS NOT NULL AND props <> '{{}}' ORDER BY id LIMIT ?",
+            (last_id, chunk),
+        ).fetchall()
+        if not rows:
+            return
+        last_id = rows[-1][0]
+        updates = []
+        for rid, event, props in rows:
             try:
-                names = os.listdir(src_dir)
-            except Exception:
-                names = []
-            cand = []
-            for name in names:
-                p = os.path.join(src_dir, name)
-                if os.path.isdir(p) and name.lower() in ('image','images','res','assets'):
-                    try:
-                        for fn in os.listdir(p):
-                            if fn.lower().endswith(('.jpg','.jpeg','.png','.webp','.gif')):
-                                cand.append(os.path.join(name, fn))
-                    except Exception:
-                        pass
-            if cand:
-                return cand[0], os.path.basename(cand[0])
-            return None, None
-        import importlib, sys
+                fields = props_fields(event, json.loads(props))
+            except ValueError:
+                continue
+            if fields != (None, None, None):
+                updates.append(fields + (rid,))
+        conn.executemany(f"UPDATE {target or table} SET start_hour = ?, href_host = ?, tag = ? WHERE id = ?", updates)
+
+
+def is_youtube(host):
+    return bool(host) and (host == 'youtube.com' or host.endswith('.youtube.com'))
+
+
+def rollup_keys(page, event, element, value, start_hour, href_host):
+    """(page keys, value keys) one raw event contributes to, as (event, key) pairs."""
+    event = event or ''
+    pages = [(event, page or '')]
+    values = []
+    if value is not None:
+        values.append((event, str(value)))
+    if event == 'click' and ('subscribe' in (element or '').lower() or is_youtube(href_host)):
+        pages.append((SUB_CLICK, page or ''))
+    if start_hour is not None and event in APPOINTMENT_EVENTS:
+        values.append((APPOINTMENT_HOUR, f"{start_hour:02d}"))
+    return pages, values
+
+
+def apply_rollups(conn, rows):
+    """Add raw rows (ts, page, event, element, value, start_hour, href_host) to the rollup tables."""
+    from collections import Counter
+    acc = {'pages': Counter(), 'values': Counter()}
+    for ts, page, event, element, value, start_hour, href_host in rows:
+        pages, values = rollup_keys(page, event, element, value, start_hour, href_host)
+        for grain in GRAINS:
+            bucket = ts - ts % grain
+            for ev, key in pages:
+                acc['pages'][(grain, bucket, ev, key)] += 1
+            for ev, key in values:
+                acc['values'][(grain, bucket, ev, key)] += 1
+    for kind, counter in acc.items():
+        if counter:
+            conn.executemany(ROLLUP_UPSERT_SQL[kind], [k + (n,) for k, n in counter.items()])
+
+
+# HyperLogLog with 2^12 one-byte registers: standard error 1.04 / sqrt(4096) ~ 1.6%,
+# so ~95% of estimates fall within +-3.3% of the true distinct count. Sketches are
+# stored zlib-compressed (a day/page with few visitors is mostly zero registers and
+# takes tens of bytes), or as the 4096 raw registers once that is smaller; merging
+# is a register-wise max.
+HLL_P = 12
+HLL_M = 1 << HLL_P
+HLL_ALPHA = 0.7213 / (1 + 1.079 / HLL_M)
+HLL_POW = [2.0 ** -r for r in range(66)]
+SKETCH_KINDS = (('visitor', 1), ('session', 2))   # kind, index of the id in (ts, client_id, session_id, page)
+
+
+def hll_point(ident):
+    """(register, rank) for one id: 64-bit hash, top HLL_P bits pick the register."""
+    h = int.from_bytes(hashlib.blake2b(str(ident).encode('utf-8', 'surrogatepass'), digest_size=8).digest(), 'big')
+    rest = h & ((1 << (64 - HLL_P)) - 1)
+    return h >> (64 - HLL_P), 64 - HLL_P - rest.bit_length() + 1
+
+
+def hll_decode(blob):
+    return bytearray(blob if len(blob) == HLL_M else zlib.decompress(blob))
+
+
+def hll_encode(regs):
+    packed = zlib.compress(regs, 1)
+    return packed if len(packed) < HLL_M else bytes(regs)
+
+
+def hll_merge(a, b):
+    return bytearray(map(max, a, b))
+
+
+def hll_estimate(regs):
+    """Distinct count for the registers, with linear counting for small cardinalities."""
+    e = HLL_ALPHA * HLL_M * HLL_M / sum(HLL_POW[r] for r in regs)
+    zeros = regs.count(0)
+    if e <= 2.5 * HLL_M and zeros:
+        e = HLL_M * math.log(HLL_M / zeros)
+    return int(round(e))
+
+
+def apply_sketches(conn, rows, cache=None):
+    """Add raw rows (ts, client_id, session_id, page) to the day and day/page sketches.
+
+    `cache` (an LRU of key -> registers) lets the writer skip reading back sketches it
+    wrote itself; it must be cleared when the transaction rolls back.
+    """
+    points = {}
+    for row in rows:
+        day, page = row[0] // DAY, row[3]
+        for kind, col in SKETCH_KINDS:
+            if not row[col]:
+                continue
+            idx, rank = hll_point(row[col])
+            for key in ((day, kind, ''), (day, kind, page)) if page else ((day, kind, ''),):
+                regs = points.setdefault(key, {})
+                if regs.get(idx, 0) < rank:
+                    regs[idx] = rank
+    for key, updates in points.items():
+        regs = cache.get(key) if cache is not None else None
+        if regs is None:
+            row = conn.execute("SELECT sketch FROM hll_sketches WHERE day = ? AND kind = ? AND page = ?", key).fetchone()
+            regs = hll_decode(row[0]) if row else bytearray(HLL_M)
+            if cache is not None:
+                cache.put(key, regs)
+        changed = False
+        for idx, rank in updates.items():
+            if regs[idx] < rank:
+                regs[idx] = rank
+                changed = True
+        if changed:
+            conn.execute("INSERT OR REPLACE INTO hll_sketches(day, kind, page, sketch) VALUES (?, ?, ?, ?)",
+                         key + (hll_encode(regs),))
+
+
+def load_sketches(conn, table, chunk=50000):
+    """Add every row of a partition's `events` to the sketches; returns rows read."""
+    last_id = 0
+    total = 0
+    while True:
+        rows = conn.execute(
+            f"SELECT id, ts, client_id, session_id, page FROM {table} WHERE id > ? ORDER BY id LIMIT ?",
+            (last_id, chunk),
+        ).fetchall()
+        if not rows:
+            return total
+        last_id = rows[-1][0]
+        total += len(rows)
+        apply_sketches(conn, (r[1:] for r in rows))
+
+
+def rebuild_sketches(conn, chunk=50000):
+    """Recompute hll_sketches for the days of every live partition (migration 5)."""
+    total = 0
+    bounds = dict((r[0], (r[1], r[2])) for r in conn.execute("SELECT month, lo, hi FROM partitions"))
+    for table in each_partition(conn, 0, 1 << 62):
+        lo, hi = bounds[table.split('.')[0][2:]]
+        conn.execute("DELETE FROM hll_sketches WHERE day >= ? AND day < ?", (lo // DAY, hi // DAY))
+        total += load_sketches(conn, table, chunk)
+    return total
+
+
+def rebuild_rollups(conn, chunk=50000, legacy=False):
+    """Recompute both rollup tables from raw events; returns the number of events read.
+
+    Each live partition is rebuilt in its own transaction: its month's buckets and
+    day sketches are deleted and re-added from its rows. Rollups of retired months
+    are final and kept.
+    `legacy` rebuilds everything from the pre-partition `events` table (migration 2).
+    """
+    def load(table, cols=RAW_ROLLUP_COLS, convert=lambda r: r[1:]):
+        last_id = 0
+        total = 0
         while True:
+            rows = conn.execute(
+                f"SELECT id, {cols} FROM {table} WHERE id > ? ORDER BY id LIMIT ?",
+                (last_id, chunk),
+            ).fetchall()
+            if not rows:
+                return total
+            last_id = rows[-1][0]
+            total += len(rows)
+            apply_rollups(conn, (convert(r) for r in rows))
+
+    if legacy:
+        # the legacy table has no extracted columns; derive them from props
+        def convert(r):
             try:
-                # Recursively discover all .html files under site/bulten_doc
-                cur = {}
-                for root, _dirs, files in os.walk(docs_dir):
-                    for fn in files:
-                        if not fn.lower().endswith('.html'):
-                            continue
-                        p = os.path.join(root, fn)
-                        try:
-                            cur[p] = os.path.getmtime(p)
-                        except FileNotFoundError:
-                            pass
-                changed = (set(cur.keys()) != set(snap.keys())) or any(cur.get(k)!=snap.get(k) for k in cur)
-                if changed:
-                    for p, mt in cur.items():
-                        try:
-                            raw = open(p, 'r', encoding='utf-8', errors='ignore').read()
-                        except Exception:
-                            continue
-                        title_src, body = extract_title_body(raw)
-                        dt = monday_of(datetime.fromtimestamp(mt))
-                        title, slug, date_iso = weekly_title_slug(dt)
-                        src_dir = os.path.dirname(p)
-                        body2 = rewrite_assets(body, src_dir, slug)
-                        # cover from image folder if available
-                        cover_rel, cover_base = find_folder_cover(src_dir)
-                        hero = '../assets/img/covers/default.jpg'
-                        if cover_rel and cover_base:
-                            try:
-                                dst_dir = os.path.join(site_bulten_assets, slug)
-                                os.makedirs(dst_dir, exist_ok=True)
-                                shutil.copy2(os.path.join(src_dir, cover_rel), os.path.join(dst_dir, cover_base))
-                                hero = f'assets/{slug}/{cover_base}'
-                            except Exception:
-                                pass
-                        rec = {
-                            'title': title,
-                            'date': date_iso,
-                            'slug': slug,
-                            'hero': hero,
-                            'intro': '',
-                            'blog': [],
-                            'youtube': [],
-                            'notes': [],
-                            'doc_html': body2,
-                        }
-                        out_json = os.path.join(data_dir, f'{slug}.json')
-                        with open(out_json, 'w', encoding='utf-8') as f:
-                            json.dump(rec, f, ensure_ascii=False, indent=2)
-                    # rebuild bulten pages
-                    try:
-                        if ROOT not in sys.path:
-                            sys.path.insert(0, ROOT)
-                        mod = importlib.import_module('scripts.build_bulten')
-                        mod.main()
-                    except Exception as e:
-                        try:
-                            print('[bulten-watcher] build error:', e)
-                        except Exception:
-                            pass
-                    snap = cur
-            except Exception as e:
-                # do not crash server
-                pass
-            _time.sleep(10)
+                props = json.loads(r[6] or '{}')
+            except ValueError:
+                props = None
+            return r[1:6] + props_fields(r[3], props)[:2]
+        conn.execute("DELETE FROM rollup_pages;")
+        conn.execute("DELETE FROM rollup_values;")
+        return load('events', "ts, page, event, element, value, props", convert)
+    total = 0
+    bounds = dict((r[0], (r[1], r[2])) for r in conn.execute("SELECT month, lo, hi FROM partitions"))
+    for table in each_partition(conn, 0, 1 << 62):
+        lo, hi = bounds[table.split('.')[0][2:]]
+        with conn:
+            conn.execute("DELETE FROM rollup_pages WHERE bucket >= ? AND bucket < ?", (lo, hi))
+            conn.execute("DELETE FROM rollup_values WHERE bucket >= ? AND bucket < ?", (lo, hi))
+            conn.execute("DELETE FROM hll_sketches WHERE day >= ? AND day < ?", (lo // DAY, hi // DAY))
+            total += load(table)
+            load_sketches(conn, table, chunk)
+    return total
+
+
+def window_segments(since, until=None):
+    """Split [since, until) into [(grain, lo, hi)] pieces; grain None is a raw piece.
+
+    Open windows (until None) are a raw head, full hours up to the next day boundary
+    and full days. Closed windows mirror that at the far end: full days, full hours
+    and a raw tail up to `until`.
+    """
+    h0 = -(-since // HOUR) * HOUR
+    if until is None:
+        d0 = -(-h0 // DAY) * DAY
+        return [(None, since, h0), (HOUR, h0, d0), (DAY, d0, 1 << 62)]
+    h1 = until // HOUR * HOUR
+    if h0 >= h1:
+        return [(None, since, until)]
+    d0 = -(-h0 // DAY) * DAY
+    d1 = h1 // DAY * DAY
+    if d0 >= d1:
+        return [(None, since, h0), (HOUR, h0, h1), (None, h1, until)]
+    return [(None, since, h0), (HOUR, h0, d0), (DAY, d0, d1), (HOUR, d1, h1), (None, h1, until)]
+
+
+def rollup_totals(conn, kind, since, events=None, like=None, by_key=True, by_day=False, until=None):
+    """Event counts for since <= ts (< until), read from rollups (exact, not bucket-aligned).
+
+    The window is split by window_segments(); raw pieces (< 1 hour each) are read
+    from `events`, the rest from hourly and daily buckets. Returns a Counter keyed by
+    (event, key), (event,) without by_key, with the UTC day number prepended by_day.
+    `events` restricts to exact event names, `like` to a LIKE pattern.
+    """
+    from collections import Counter
+    col = 'page' if kind == 'pages' else 'value'
+    segments = window_segments(since, until)
+    raw_ranges = [(lo, hi) for grain, lo, hi in segments if grain is None and lo < hi]
+    out = Counter()
+    if kind == 'pages' and like is not None and events is None and not by_day:
+        # plain event/page counts: aggregate raw pieces in SQL on the covering idx_facts_ts
+        for lo, hi in raw_ranges:
+            for table in each_partition(conn, lo, hi):
+                for ev, page, n in conn.execute(HOT_QUERIES['head_pages_like'][0].format(events=table), (like, lo, hi)):
+                    out[(ev, page or '') if by_key else (ev,)] += n
+        raw = ()
+    elif kind == 'values' and events == (APPOINTMENT_HOUR,) and not by_day:
+        # appointment hours: one GROUP BY on the extracted start_hour column
+        for lo, hi in raw_ranges:
+            for table in each_partition(conn, lo, hi):
+                for hh, n in conn.execute(HOT_QUERIES['head_appointment_hours'][0].format(events=table),
+                                          (lo, hi)):
+                    out[(APPOINTMENT_HOUR, f"{hh:02d}") if by_key else (APPOINTMENT_HOUR,)] += n
+        raw = ()
+    else:
+        raw = []
+        for lo, hi in raw_ranges:
+            for table in each_partition(conn, lo, hi):
+                raw += conn.execute(HOT_QUERIES['head_raw'][0].format(events=table), (lo, hi)).fetchall()
+    # raw pieces: classified exactly like the ingest path
+    for ts, page, event, element, value, start_hour, href_host in raw:
+        pages, values = rollup_keys(page, event, element, value, start_hour, href_host)
+        for ev, key in (pages if kind == 'pages' else values):
+            if events is not None and ev not in events:
+                continue
+            if like is not None and not _like_prefix(ev, like):
+                continue
+            k = (ev, key) if by_key else (ev,)
+            out[((ts // DAY),) + k if by_day else k] += 1
+    cols = ['event'] + ([col] if by_key else [])
+    if by_day:
+        cols.insert(0, f'bucket / {DAY}')
+    where = "grain = ? AND bucket >= ? AND bucket < ?"
+    extra = []
+    if events is not None:
+        where += f" AND event IN ({','.join('?' * len(events))})"
+        extra += list(events)
+    if like is not None:
+        where += " AND event LIKE ?"
+        extra.append(like)
+    sql = f"SELECT {', '.join(cols)}, SUM(n) FROM rollup_{kind} WHERE {where} GROUP BY {', '.join(cols)}"
+    for grain, lo, hi in segments:
+        if grain is None or lo >= hi:
+            continue
+        for row in conn.execute(sql, [grain, lo, hi] + extra):
+            out[tuple(row[:-1])] += row[-1]
+    return out
+
+
+# Card categories for the single-pass window counters (SUM(CASE ...) per window).
+WINDOW_CATEGORIES = (
+    ('views', "event LIKE 'view%'"),
+    ('searches', "event LIKE 'search%'"),
+    ('clicks', "event LIKE 'click%'"),
+    ('appointments', "event IN ('appointment','appointment_gcal','appointment_api')"),
+    ('emails', "event = 'email_send'"),
+)
+
+
+def card_categories(event):
+    """WINDOW_CATEGORIES names one event counts towards, evaluated in Python (live deltas)."""
+    low = (event or '').lower()   # LIKE is case-insensitive, IN and = are not
+    out = [name for name, prefix in (('views', 'view'), ('searches', 'search'), ('clicks', 'click'))
+           if low.startswith(prefix)]
+    if event in APPOINTMENT_EVENTS:
+        out.append('appointments')
+    if event == 'email_send':
+        out.append('emails')
+    return out
+
+
+def window_counts_sql(windows):
+    """(rollup_sql, raw_sql) counting every card category for `windows` windows at once.
+
+    raw_sql runs once per partition covering a window head (`{events}` placeholder).
+
+    rollup_sql params: one full-hour start per window, then grain and the earliest start.
+    raw_sql params: (since, first full hour) per window for the CASEs, then again for
+    the WHERE, whose OR of ts ranges runs as a MULTI-INDEX OR on idx_facts_ts.
+    """
+    r_cols = []
+    e_cols = []
+    for _ in range(windows):
+        for _name, cond in WINDOW_CATEGORIES:
+            r_cols.append(f"SUM(CASE WHEN bucket >= ? AND {cond} THEN n ELSE 0 END)")
+            e_cols.append(f"SUM(CASE WHEN ts >= ? AND ts < ? AND {cond} THEN 1 ELSE 0 END)")
+    rollup_sql = f"SELECT {', '.join(r_cols)} FROM rollup_pages WHERE grain = ? AND bucket >= ?"
+    ranges = ' OR '.join(['(ts >= ? AND ts < ?)'] * windows)
+    raw_sql = f"SELECT {', '.join(e_cols)} FROM {{events}} WHERE {ranges}"
+    return rollup_sql, raw_sql
+
+
+# Hot-path statements with the index EXPLAIN QUERY PLAN must report for them.
+# `{events}` is a partition table (p_YYYYMM.events); the plan text names it too.
+# scripts/check_query_plans.py fails when the planner stops using one.
+_WC_ROLLUP, _WC_RAW = window_counts_sql(3)
+HOT_QUERIES = {
+    'window_counts_rollup': (_WC_ROLLUP, 'SEARCH rollup_pages USING PRIMARY KEY'),
+    'window_counts_raw': (_WC_RAW, 'SEARCH f USING COVERING INDEX idx_facts_ts ('),
+    'head_pages_like': (
+        "SELECT event, page, COUNT(*) FROM {events} WHERE event LIKE ? AND ts >= ? AND ts < ? GROUP BY event, page",
+        'SEARCH f USING COVERING INDEX idx_facts_ts (',
+    ),
+    'head_raw': (f"SELECT {RAW_ROLLUP_COLS} FROM {{events}} WHERE ts >= ? AND ts < ?", 'SEARCH f USING INDEX idx_facts_ts ('),
+    'head_appointment_hours': (
+        # start_hour is only extracted for APPOINTMENT_EVENTS, so no event filter is needed
+        "SELECT start_hour, COUNT(*) FROM {events} WHERE ts >= ? AND ts < ? AND start_hour IS NOT NULL GROUP BY start_hour",
+        'SEARCH f USING COVERING INDEX idx_facts_ts_start_hour',
+    ),
+    # keyset pages for /api/export/events: (ts, id) strictly after / before the cursor
+    'export_page_asc': (
+        "SELECT ts, client_id, session_id, ip, ua, ref, page, event, element, value, props, id FROM {events} "
+        "WHERE ts >= ? AND ts < ? AND (ts > ? OR id > ?) ORDER BY ts, id LIMIT ?",
+        'SEARCH f USING INDEX idx_facts_ts (',
+    ),
+    'export_page_desc': (
+        "SELECT ts, client_id, session_id, ip, ua, ref, page, event, element, value, props, id FROM {events} "
+        "WHERE ts >= ? AND ts <= ? AND (ts < ? OR id < ?) ORDER BY ts DESC, id DESC LIMIT ?",
+        'SEARCH f USING INDEX idx_facts_ts (',
+    ),
+}
+
+
+def _like_prefix(event, pattern):
+    # only the 'prefix%' patterns the stats handlers use
+    return event.lower().startswith(pattern.rstrip('%').lower())
+
+
+# ---- Stats (read from rollups) --------------------------------------------------
+
+def window_counts(conn, sinces):
+    """Dashboard card counters for each ts >= since, in one rollup and one raw scan."""
+    if len(sinces) == 3:
+        rollup_sql, raw_sql = _WC_ROLLUP, _WC_RAW
+    else:
+        rollup_sql, raw_sql = window_counts_sql(len(sinces))
+    heads = [(since, -(-since // HOUR) * HOUR) for since in sinces]
+    per = len(WINDOW_CATEGORIES)
+    r_params = [h for _s, h in heads for _ in range(per)] + [HOUR, min(h for _s, h in heads)]
+    e_params = [x for s_h in heads for _ in range(per) for x in s_h] + [x for s_h in heads for x in s_h]
+    r = conn.execute(rollup_sql, r_params).fetchone()
+    e = [0] * len(r)
+    for table in each_partition(conn, min(sinces), max(h for _s, h in heads)):
+        part = conn.execute(raw_sql.format(events=table), e_params).fetchone()
+        e = [a + (b or 0) for a, b in zip(e, part)]
+    out = []
+    for i in range(len(sinces)):
+        out.append({name: (r[i*per + j] or 0) + e[i*per + j] for j, (name, _c) in enumerate(WINDOW_CATEGORIES)})
+    return out
+
+
+def top_pages(conn, since, limit, blog_only=False, until=None):
+    """[(page, views)] for view* events, most viewed first."""
+    from collections import Counter
+    agg = Counter()
+    for (_ev, page), n in rollup_totals(conn, 'pages', since, like='view%', until=until).items():
+        if not page or (blog_only and '/blog/' not in page.lower()):
+            continue
+        agg[page] += n
+    return agg.most_common(limit)
+
+
+def top_values(conn, since, event, limit, until=None):
+    """[(value, count)] for one event name, e.g. search queries."""
+    from collections import Counter
+    agg = Counter()
+    for (_ev, value), n in rollup_totals(conn, 'values', since, events=(event,), until=until).items():
+        agg[value] += n
+    return agg.most_common(limit)
+
+
+def top_sub_clicks(conn, since, limit, until=None):
+    """[(page, clicks)] for subscribe / YouTube link clicks."""
+    from collections import Counter
+    agg = Counter()
+    for (_ev, page), n in rollup_totals(conn, 'pages', since, events=(SUB_CLICK,), until=until).items():
+        agg[page or '(yok)'] += n
+    return agg.most_common(limit)
+
+
+def daily_series(conn, since, now, until=None):
+    """[(utc_day, appointments, emails)] for every day from the first active day."""
+    agg = {}
+    counts = rollup_totals(conn, 'pages', since, events=APPOINTMENT_EVENTS + ('email_send',), by_key=False, by_day=True,
+                           until=until)
+    for (dkey, evt), c in counts.items():
+        dkey = int(dkey); agg.setdefault(dkey, {'apt':0,'mail':0})
+        if evt.startswith('appointment'): agg[dkey]['apt'] += c
+        if evt=='email_send': agg[dkey]['mail'] += c
+    if agg:
+        min_d = min(agg.keys()); max_d = max(agg.keys())
+    else:
+        min_d = int(since/86400); max_d = int(now/86400)
+    out = []
+    for dkey in range(min_d, max_d+1):
+        v = agg.get(dkey, {'apt':0,'mail':0}); out.append((dkey, v['apt'], v['mail']))
+    return out
+
+
+def appointment_hours(conn, since, until=None):
+    """24 counters of appointment start hours (from props.start)."""
+    hours = [0]*24
+    for (_ev, hh), n in rollup_totals(conn, 'values', since, events=(APPOINTMENT_HOUR,), until=until).items():
+        hours[int(hh)] += n
+    return hours
+
+
+def stats_summary(conn, now):
+    last24 = now - 24*3600
+    last7 = now - 7*24*3600
+    c24, c7 = window_counts(conn, (last24, last7))
+    keep = ('views', 'searches', 'clicks')
+    data = {'last24': {k: c24[k] for k in keep}, 'last7': {k: c7[k] for k in keep}}
+    # top pages & searches (7d)
+    pages = [{'page': p, 'c': c} for p, c in top_pages(conn, last7, 10)]
+    searches = [{'k': k, 'c': c} for k, c in top_values(conn, last7, 'search', 10)]
+    data['tops'] = {'pages': pages, 'searches': searches}
+    return data
+
+
+def merged_sketches(conn, kind, d0, d1, by_page=False):
+    """{page: registers} merged over UTC days [d0, d1); the site-wide sketch is page ''."""
+    out = {}
+    where = "page != ''" if by_page else "page = ''"
+    for page, blob in conn.execute(f"SELECT page, sketch FROM hll_sketches WHERE kind = ? AND day >= ? AND day < ? "
+                                   f"AND {where}", (kind, d0, d1)):
+        regs = hll_decode(blob)
+        out[page] = hll_merge(out[page], regs) if page in out else regs
+    return out
+
+
+def unique_counts(conn, since, until=None, by_page=False):
+    """{page: (visitors, sessions)} estimated for the UTC days overlapping [since, until).
+
+    Without by_page the only key is '' (whole site). Sketches are per day, so the
+    window is widened to whole days; see HLL_P for the error bounds.
+    """
+    d0 = since // DAY
+    d1 = (until - 1) // DAY + 1 if until is not None else 1 << 40
+    visitors = merged_sketches(conn, 'visitor', d0, d1, by_page)
+    sessions = merged_sketches(conn, 'session', d0, d1, by_page)
+    return {page: (hll_estimate(visitors[page]) if page in visitors else 0,
+                   hll_estimate(sessions[page]) if page in sessions else 0)
+            for page in set(visitors) | set(sessions)}
+
+
+def unique_series(conn, since, now, until=None):
+    """[(utc_day, visitors, sessions)] for every day of the window."""
+    d0 = since // DAY
+    d1 = (until - 1) // DAY + 1 if until is not None else now // DAY + 1
+    agg = {}
+    for day, kind, blob in conn.execute("SELECT day, kind, sketch FROM hll_sketches WHERE page = '' AND day >= ? AND day < ?",
+                                        (d0, d1)):
+        agg[(day, kind)] = hll_estimate(hll_decode(blob))
+    return [(d, agg.get((d, 'visitor'), 0), agg.get((d, 'session'), 0)) for d in range(d0, d1)]
+
+
+def stats_dashboard(conn, now):
+    span24 = now - 24*3600; span7 = now - 7*24*3600; span30 = now - 30*24*3600
+    c24, c7, c30 = window_counts(conn, (span24, span7, span30))
+    out = {'last24': c24, 'last7': c7, 'last30': c30}
+    blogs = [{'page': p, 'c': c} for p, c in top_pages(conn, span7, 10, blog_only=True)]
+    searches = [{'q': q, 'c': c} for q, c in top_values(conn, span7, 'search', 10)]
+    subs = [{'k': k, 'c': c} for k, c in top_sub_clicks(conn, span7, 10)]
+    # timeseries (14d) appointments & emails
+    series = daily_series(conn, now - 14*24*3600, now)
+    out['tops'] = {'blogs': blogs, 'searches': searches, 'subs': subs}
+    out['timeseries'] = {'appointments': [r[1] for r in series], 'emails': [r[2] for r in series],
+                         'days': [r[0] for r in series]}
+    out['appointmentHours'] = {'labels': [f"{i:02d}" for i in range(24)], 'values': appointment_hours(conn, span30)}
+    # approximate distinct visitors/sessions (HyperLogLog, whole UTC days)
+    out['uniques'] = {}
+    for name, since in (('last24', span24), ('last7', span7), ('last30', span30)):
+        visitors, sessions = unique_counts(conn, since).get('', (0, 0))
+        out['uniques'][name] = {'visitors': visitors, 'sessions': sessions}
+    useries = unique_series(conn, now - 13*24*3600, now)
+    out['uniquesDaily'] = {'visitors': [r[1] for r in useries], 'sessions': [r[2] for r in useries]}
+    return out
+
+
+def stats_realtime(topk, now, k=10):
+    """Top-k blogs, searches and subscribe clicks per TOPK_WINDOWS window, from memory only.
+
+    Windows are bucket aligned (1h = current and previous clock hour); `err` is the
+    most a count may overstate.
+    """
+    out = {'capacity': topk.capacity, 'windows': {}}
+    for name, grain, span in TOPK_WINDOWS:
+        since = now - span
+        out['windows'][name] = {
+            'blogs': [{'page': p, 'c': c, 'err': e}
+                      for p, c, e in topk.top('pages', grain, since, k, lambda p: '/blog/' in p.lower())],
+            'searches': [{'q': q, 'c': c, 'err': e} for q, c, e in topk.top('searches', grain, since, k)],
+            'subs': [{'k': key, 'c': c, 'err': e} for key, c, e in topk.top('subs', grain, since, k)],
+        }
+    return out
+
+
+# ---- Funnel and retention (NumPy) --------------------------------------------------
+# Per-visitor reports cannot come from rollups. One pass over the partitions that
+# overlap the window loads three columns into arrays (dictionary-encoded client or
+# session id, ts, event code); ordering, step matching and cohort bucketing are then
+# array operations. NumPy is optional: without it /api/stats/funnel and
+# /api/stats/retention answer 501 and nothing else changes.
+
+FUNNEL_STEPS = ('views', 'clicks', 'appointments')   # WINDOW_CATEGORIES names, in order
+FUNNEL_WINDOW_DAYS = 7    # later steps must follow the first view within this many days
+RETENTION_DAYS = 30       # day-N retention columns 0..N
+LOAD_CHUNK = 100000       # rows fetched per cursor round trip
+
+
+def numpy_or_none():
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+
+def load_event_arrays(conn, since, until, categories=None, by='client'):
+    """(ident, ts, code, n_idents) arrays for events in [since, until), sorted by (ident, ts).
+
+    `ident` is client_id (by='session': session_id) interned to 0..n_idents-1, `code`
+    the index in `categories` of the first card category the event counts towards.
+    Events in none of them are filtered out in SQL; categories=None keeps every event
+    with code 0. Rows without an id are skipped.
+    """
+    np = numpy_or_none()
+    col = 'session_id' if by == 'session' else 'client_id'
+    index = {}
+    parts = []
+    for table in each_partition(conn, since, until):
+        schema = table.split('.')[0]
+        # event ids are per partition file: map this file's dictionary onto codes
+        lut = {}
+        for eid, name in conn.execute(f"SELECT id, s FROM {schema}.dict_event"):
+            if categories is None:
+                lut[eid] = 0
+                continue
+            hits = [categories.index(c) for c in card_categories(name) if c in categories]
+            if hits:
+                lut[eid] = min(hits)
+        if not lut:
+            continue
+        case = "CASE event_id " + " ".join(f"WHEN {e} THEN {c}" for e, c in lut.items()) + " END"
+        # a window covering the whole month reads the table in rowid order instead of
+        # jumping from idx_facts_ts to the row for every client_id
+        lo, hi = conn.execute("SELECT lo, hi FROM partitions WHERE month = ?", (schema[2:],)).fetchone()
+        hint = "NOT INDEXED" if since <= lo and hi <= until else ""
+        cur = conn.execute(f"SELECT {col}, ts, {case} FROM {schema}.facts {hint} "
+                           f"WHERE ts >= ? AND ts < ? AND event_id IN ({','.join(map(str, lut))}) AND {col} IS NOT NULL",
+                           (since, until))
+        while True:
+            rows = cur.fetchmany(LOAD_CHUNK)
+            if not rows:
+                break
+            ids, ts, codes = zip(*rows)
+            parts.append((np.array([index.setdefault(x, len(index)) for x in ids], dtype=np.int64),
+                          np.array(ts, dtype=np.int64), np.array(codes, dtype=np.int8)))
+    if not parts:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, np.zeros(0, dtype=np.int8), 0
+    ident, ts, code = (np.concatenate(a) for a in zip(*parts))
+    order = np.lexsort((ts, ident))
+    return ident[order], ts[order], code[order], len(index)
+
+
+def _group_starts(np, ident):
+    """Positions of the first row of every ident in an ident-sorted array."""
+    if not len(ident):
+        return np.zeros(0, dtype=np.int64)
+    return np.flatnonzero(np.concatenate(([True], ident[1:] != ident[:-1])))
+
+
+def funnel_report(conn, since, until, window=FUNNEL_WINDOW_DAYS * DAY, by='client'):
+    """Ordered view -> click -> appointment funnel over [since, until).
+
+    A visitor enters at their first view in the window; each later step counts at the
+    first matching event at or after the previous step and within `window` seconds of
+    entering. Earliest matches are taken, so a visitor is counted whenever some
+    ordered path exists.
+    """
+    np = numpy_or_none()
+    ident, ts, code, n = load_event_arrays(conn, since, until, FUNNEL_STEPS, by)
+    never = np.iinfo(np.int64).max
+    steps, entry, prev = [], None, None
+    for k, name in enumerate(FUNNEL_STEPS):
+        sel = code == k
+        i, t = ident[sel], ts[sel]
+        if prev is not None:
+            ok = (t >= prev[i]) & (t - entry[i] <= window)   # prev[i] == never fails the first test
+            i, t = i[ok], t[ok]
+        first = np.full(n, never, dtype=np.int64)
+        # still sorted by (ident, ts): the first row per ident is its earliest match
+        starts = _group_starts(np, i)
+        first[i[starts]] = t[starts]
+        hit = first != never
+        count = int(hit.sum())
+        row = {'step': name, 'count': count}
+        if prev is None:
+            entry = first
+        else:
+            gap = first[hit] - prev[hit]
+            row['rate'] = round(count / steps[0]['count'], 4) if steps[0]['count'] else None
+            row['step_rate'] = round(count / steps[-1]['count'], 4) if steps[-1]['count'] else None
+            row['median_sec'] = int(np.median(gap)) if count else None
+        steps.append(row)
+        prev = first
+    return {'since': since, 'until': until, 'by': by, 'window_sec': window, 'events': int(len(ts)), 'steps': steps}
+
+
+def retention_report(conn, since, until, max_day=RETENTION_DAYS, by='client'):
+    """Day-N retention and weekly cohorts for visitors first seen in [since, until).
+
+    A visitor's cohort is the UTC day (and Monday-based week) of their first event in
+    the window, so visitors who were also active before `since` start a cohort on
+    their first day inside it. Day N counts visitors active again exactly N days
+    after that day, over visitors whose day N lies inside the window.
+    """
+    np = numpy_or_none()
+    ident, ts, _code, n = load_event_arrays(conn, since, until, None, by)
+    d0, d1 = since // DAY, (until - 1) // DAY + 1
+    span = d1 - d0
+    day = ts // DAY - d0
+    first = np.zeros(n, dtype=np.int64)
+    starts = _group_starts(np, ident)
+    first[ident[starts]] = day[starts]
+    # one row per (ident, active day)
+    active_id, active_day = np.divmod(np.unique(ident * span + day), span)
+    offset = active_day - first[active_id]
+    near = offset <= max_day
+    retained = np.bincount(offset[near], minlength=max_day + 1)[:max_day + 1]
+    # visitors whose day N is still inside the window: first day <= span - 1 - N
+    by_first = np.cumsum(np.bincount(first, minlength=span))
+    eligible = [int(by_first[span - 1 - k]) if span - 1 - k >= 0 else 0 for k in range(max_day + 1)]
+    days = [{'day': k, 'active': int(retained[k]), 'eligible': eligible[k],
+             'rate': round(int(retained[k]) / eligible[k], 4) if eligible[k] else None}
+            for k in range(max_day + 1)]
+    # weeks start on Monday; 1970-01-01 (day 0) was a Thursday
+    w0 = (d0 + 3) // 7
+    weeks = (d1 - 1 + 3) // 7 - w0 + 1
+    week = (ts // DAY + 3) // 7 - w0
+    first_week = (first + d0 + 3) // 7 - w0
+    active_id, active_week = np.divmod(np.unique(ident * weeks + week), weeks)
+    cohort = first_week[active_id]
+    grid = np.bincount(cohort * weeks + (active_week - cohort), minlength=weeks * weeks).reshape(weeks, weeks)
+    cohorts = []
+    for c in range(weeks):
+        size = int(grid[c, 0])
+        if not size:
+            continue
+        active = grid[c, :weeks - c].tolist()
+        cohorts.append({'week': time.strftime('%Y-%m-%d', time.gmtime(((w0 + c) * 7 - 3) * DAY)), 'visitors': size,
+                        'active': active, 'rate': [round(a / size, 4) for a in active]})
+    return {'since': since, 'until': until, 'by': by, 'events': int(len(ts)), 'visitors': n,
+            'days': days, 'cohorts': cohorts}
 
-    t = threading.Thread(target=bulten_watcher, daemon=True)
-    t.start()
-    httpd.serve_forever()
+
+class LRU:
+    """Bounded least-recently-used map; the writer's string -> dictionary id cache."""
+
+    def __init__(self, size):
+        from collections import OrderedDict
+        self.size = max(1, size)
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        value = self.data.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.data.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self.data[key] = value
+        self.data.move_to_end(key)
+        if len(self.data) > self.size:
+            self.data.popitem(last=False)
+
+    def clear(self):
+        self.data.clear()
+
+
+TOPK_CAPACITY = int(os.environ.get("ANALYTICS_TOPK_CAPACITY", "200"))   # counters per category and bucket
+TOPK_KEEP = {HOUR: 26, DAY: 8}     # buckets kept per grain, enough for TOPK_WINDOWS
+TOPK_CHECKPOINT_SEC = 30
+TOPK_WINDOWS = (('1h', HOUR, HOUR), ('24h', HOUR, DAY), ('7d', DAY, 7 * DAY))   # name, grain, span
+
+
+def topk_items(page, event, element, value, start_hour, href_host):
+    """(category, item) pairs one raw event feeds into the heavy-hitter summaries."""
+    pages, values = rollup_keys(page, event, element, value, start_hour, href_host)
+    out = []
+    for ev, key in pages:
+        if ev == SUB_CLICK:
+            out.append(('subs', key or '(yok)'))
+        elif key and _like_prefix(ev, 'view%'):
+            out.append(('pages', key))
+    out += [('searches', key) for ev, key in values if ev == 'search']
+    return out
+
+
+class TopK:
+    """Space-Saving heavy hitters per (category, grain, bucket), fed by the ingest writer.
+
+    Each summary keeps at most `capacity` counters {item: [count, error]}; an unseen
+    item replaces the smallest counter and inherits its count as error, so
+    count - error <= true count <= count. A window merges the summaries of the buckets
+    it overlaps. The state is checkpointed to topk_state with the id of the first event
+    it has not counted (meta 'topk_next_id'); load() replays the events after that.
+    """
+
+    def __init__(self, capacity=TOPK_CAPACITY):
+        self.capacity = max(1, capacity)
+        self.summaries = {}   # (category, grain, bucket) -> {item: [count, error]}
+        self.dirty = set()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _cutoff(grain, now):
+        return now - now % grain - (TOPK_KEEP[grain] - 1) * grain
+
+    def add(self, rows, now=None):
+        """Count raw rows (ts, page, event, element, value, start_hour, href_host)."""
+        now = int(time.time()) if now is None else now
+        cutoffs = {grain: self._cutoff(grain, now) for grain in GRAINS}
+        with self.lock:
+            for row in rows:
+                items = topk_items(*row[1:])
+                for grain in GRAINS if items else ():
+                    bucket = row[0] - row[0] % grain
+                    if not cutoffs[grain] <= bucket <= now:
+                        continue
+                    for category, item in items:
+                        key = (category, grain, bucket)
+                        summary = self.summaries.get(key)
+                        if summary is None:
+                            summary = self.summaries[key] = {}
+                        self._offer(summary, item)
+                        self.dirty.add(key)
+            for key in [k for k in self.summaries if k[2] < cutoffs[k[1]]]:
+                del self.summaries[key]
+                self.dirty.discard(key)
+
+    def _offer(self, summary, item):
+        counter = summary.get(item)
+        if counter is not None:
+            counter[0] += 1
+        elif len(summary) < self.capacity:
+            summary[item] = [1, 0]
+        else:
+            victim = min(summary, key=lambda k: summary[k][0])
+            floor = summary.pop(victim)[0]
+            summary[item] = [floor + 1, floor]
+
+    def top(self, category, grain, since, k, keep=None):
+        """[(item, count, error)] over the `grain` buckets overlapping [since, now), largest first.
+
+        Merging adds, for summaries that are full and lack an item, their smallest
+        count to that item's count and error (the most it could have had there).
+        """
+        with self.lock:
+            parts = [s for (c, g, b), s in self.summaries.items() if c == category and g == grain and b + grain > since]
+            floors = [min(c for c, _e in s.values()) if len(s) >= self.capacity else 0 for s in parts]
+            merged = {}
+            for summary, floor in zip(parts, floors):
+                for item, (count, error) in summary.items():
+                    acc = merged.setdefault(item, [0, 0])
+                    acc[0] += count - floor
+                    acc[1] += error - floor
+        base = sum(floors)
+        out = [(item, c + base, e + base) for item, (c, e) in merged.items() if keep is None or keep(item)]
+        out.sort(key=lambda r: (-r[1], r[0]))
+        return out[:k]
+
+    def checkpoint(self, conn, next_id, now=None):
+        """Write the summaries changed since the last checkpoint; events < next_id are counted."""
+        now = int(time.time()) if now is None else now
+        with self.lock:
+            rows = {key: [(item, c, e) for item, (c, e) in self.summaries[key].items()] for key in self.dirty}
+            self.dirty.clear()
+        try:
+            with conn:
+                for grain in TOPK_KEEP:
+                    conn.execute("DELETE FROM topk_state WHERE grain = ? AND bucket < ?", (grain, self._cutoff(grain, now)))
+                for key, items in rows.items():
+                    conn.execute("DELETE FROM topk_state WHERE category = ? AND grain = ? AND bucket = ?", key)
+                    conn.executemany("INSERT INTO topk_state(category, grain, bucket, item, count, error) "
+                                     "VALUES (?, ?, ?, ?, ?, ?)", [key + it for it in items])
+                conn.execute("INSERT OR REPLACE INTO meta(key, value) VALUES ('topk_next_id', ?)", (next_id,))
+        except Exception:
+            with self.lock:
+                self.dirty.update(k for k in rows if k in self.summaries)
+            raise
+
+    def load(self, conn, chunk=50000, now=None):
+        """Restore the last checkpoint and count the events written after it; returns their number."""
+        now = int(time.time()) if now is None else now
+        with self.lock:
+            self.summaries.clear()
+            self.dirty.clear()
+            for category, grain, bucket, item, count, error in conn.execute(
+                    "SELECT category, grain, bucket, item, count, error FROM topk_state"):
+                if grain in TOPK_KEEP and bucket >= self._cutoff(grain, now):
+                    self.summaries.setdefault((category, grain, bucket), {})[item] = [count, error]
+        row = conn.execute("SELECT value FROM meta WHERE key = 'topk_next_id'").fetchone()
+        since = min(self._cutoff(grain, now) for grain in TOPK_KEEP)
+        total = 0
+        for table in each_partition(conn, since, 1 << 62):
+            last_id = (row[0] if row else 0) - 1
+            while True:
+                rows = conn.execute(f"SELECT id, {RAW_ROLLUP_COLS} FROM {table} WHERE id > ? AND ts >= ? "
+                                    f"ORDER BY id LIMIT ?", (last_id, since, chunk)).fetchall()
+                if not rows:
+                    break
+                last_id = rows[-1][0]
+                total += len(rows)
+                self.add((r[1:] for r in rows), now)
+        return total
+
+
+LIVE_INTERVAL = 1.0    # seconds between /api/stream deltas
+LIVE_HEARTBEAT = 15    # seconds between keep-alive comments on an idle stream
+LIVE_BACKLOG = 64      # undelivered events per subscriber before it is dropped as too slow
+LIVE_WINDOWS = (('last24', 24*3600), ('last7', 7*24*3600), ('last30', 30*24*3600))
+
+
+class LiveFeed:
+    """Fans per-second dashboard deltas out to /api/stream subscribers (Server-Sent Events).
+
+    The writer hands every committed batch to feed(). Once per `interval` one thread
+    turns the rows gathered since the last tick into a single encoded event and offers
+    the same bytes to every subscriber, so the work per tick does not grow with the
+    number of open dashboards. Without subscribers feed() drops the rows.
+    """
+
+    def __init__(self, ingest, interval=LIVE_INTERVAL, heartbeat=LIVE_HEARTBEAT):
+        self.ingest = ingest
+        self.interval = interval
+        self.heartbeat = heartbeat
+        self.subscribers = set()   # push(data) callables; False means "too slow, drop me"
+        self.rows = []
+        self.lock = threading.Lock()
+        self.stop = threading.Event()
+        self.thread = None
+
+    def subscribe(self, push):
+        with self.lock:
+            self.subscribers.add(push)
+
+    def unsubscribe(self, push):
+        with self.lock:
+            self.subscribers.discard(push)
+
+    def feed(self, rows):
+        """Raw rows (ts, page, event, element, value, start_hour, href_host) just committed."""
+        if self.subscribers:
+            with self.lock:
+                self.rows.extend(rows)
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name='live-feed', daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.stop.set()
+        with self.lock:
+            subscribers = list(self.subscribers)
+            self.subscribers.clear()
+        for push in subscribers:
+            push(None)
+
+    def delta(self, rows, now):
+        """Card, appointment-hour and per-day increments for `rows`, shaped like stats_dashboard()."""
+        from collections import Counter
+        cards = {name: Counter() for name, _span in LIVE_WINDOWS}
+        hours = Counter()
+        days = {}
+        for ts, _page, event, _element, _value, start_hour, _host in rows:
+            for name, span in LIVE_WINDOWS:
+                if ts >= now - span:
+                    cards[name].update(card_categories(event))
+            if event in APPOINTMENT_EVENTS and start_hour is not None and ts >= now - 30*24*3600:
+                hours[f"{start_hour:02d}"] += 1
+            if event in APPOINTMENT_EVENTS or event == 'email_send':
+                day = days.setdefault(ts // DAY, {'appointments': 0, 'emails': 0})
+                day['appointments' if event in APPOINTMENT_EVENTS else 'emails'] += 1
+        return {'ts': now, 'events': len(rows), 'cards': {k: dict(v) for k, v in cards.items()},
+                'appointmentHours': dict(hours), 'days': days}
+
+    def _run(self):
+        quiet = 0.0
+        while not self.stop.wait(self.interval):
+            with self.lock:
+                rows, self.rows = self.rows, []
+                subscribers = list(self.subscribers)
+            if not subscribers:
+                continue
+            if rows:
+                data = json.dumps(self.delta(rows, int(time.time())))
+                msg = f"id: {self.ingest.watermark()}\nevent: delta\ndata: {data}\n\n".encode('utf-8')
+                quiet = 0.0
+            else:
+                quiet += self.interval
+                if quiet < self.heartbeat:
+                    continue
+                msg = b': ping\n\n'   # lets dead connections fail their write
+                quiet = 0.0
+            for push in subscribers:
+                if not push(msg):
+                    self.unsubscribe(push)
+
+    def snapshot(self):
+        with self.lock:
+            return {'subscribers': len(self.subscribers)}
+
+
+class ResultCache:
+    """Rendered stats/export bodies keyed by route + query, bounded by LRU and TTL.
+
+    Each entry remembers the ingest watermark it was computed at and the [since, until)
+    window it covers, and is dropped only once a later batch wrote an event inside that
+    window. Open windows also expire after `ttl` seconds; closed ones (until in the past)
+    stay until evicted.
+    """
+
+    def __init__(self, size=RESULT_CACHE, ttl=RESULT_TTL):
+        from collections import OrderedDict
+        self.size = max(0, size)
+        self.ttl = max(0, ttl)
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'invalidated': 0, 'expired': 0, 'evicted': 0}
+
+    def get(self, key, ingest):
+        """Cached body for `key`, or None when missing, expired or touched by ingest."""
+        with self.lock:
+            entry = self.data.get(key)
+            if entry is None:
+                self.stats['misses'] += 1
+                return None
+            body, mark, since, until, expires = entry
+            if expires is not None and _time.monotonic() >= expires:
+                del self.data[key]
+                self.stats['expired'] += 1
+                self.stats['misses'] += 1
+                return None
+            # read before checking: batches up to `current` are covered by the check
+            current = ingest.watermark()
+            if ingest.touched_since(mark, since, until):
+                del self.data[key]
+                self.stats['invalidated'] += 1
+                self.stats['misses'] += 1
+                return None
+            self.data[key] = (body, current, since, until, expires)
+            self.data.move_to_end(key)
+            self.stats['hits'] += 1
+            return body
+
+    def put(self, key, body, mark, since, until, closed):
+        if not self.size:
+            return
+        expires = None if closed else _time.monotonic() + self.ttl
+        with self.lock:
+            self.data[key] = (body, mark, since, until, expires)
+            self.data.move_to_end(key)
+            while len(self.data) > self.size:
+                self.data.popitem(last=False)
+                self.stats['evicted'] += 1
+
+    def snapshot(self):
+        with self.lock:
+            out = dict(self.stats)
+            out['entries'] = len(self.data)
+            out['capacity'] = self.size
+            out['ttl_sec'] = self.ttl
+            lookups = out['hits'] + out['misses']
+            out['hit_ratio'] = round(out['hits'] / lookups, 4) if lookups else None
+            return out
+
+
+class Snapshot:
+    """One generation of the read snapshot: its directory, reader pool and age."""
+
+    def __init__(self, gen, path, db, taken, mark):
+        self.gen = gen
+        self.path = path
+        self.db = db
+        self.taken = taken     # unix time the copy started
+        self.mark = mark       # ingest watermark at that time
+
+    def age(self, now=None):
+        return max(0, int((now or time.time()) - self.taken))
+
+
+class SnapshotReplica:
+    """Periodic online copy of the database that heavy reports read instead of the primary.
+
+    Long exports and dashboard aggregations on analytics.db hold WAL read marks that
+    keep checkpoints from resetting the -wal file. Every `interval` seconds one thread
+    copies the main file and each live partition with the sqlite3 backup API into a
+    new generation directory (<db stem>-snapshot/<n>/, same relative layout, so
+    each_partition resolves inside it) and swaps it in. Partitions whose file and -wal
+    did not change since the last copy are hard-linked from the previous generation.
+
+    The main file and partitions are copied one after another, so a snapshot may hold
+    a few rows newer than its rollups. A replaced generation is deleted at the following
+    refresh, giving reads that started on it a full interval to finish.
+    """
+
+    def __init__(self, db, interval=SNAPSHOT_SEC, readers=READER_POOL, ingest=None):
+        self.db = db
+        self.interval = interval
+        self.readers = readers
+        self.ingest = ingest
+        self.dir = os.path.splitext(db.path)[0] + '-snapshot'
+        self.lock = threading.Lock()
+        self.stop = threading.Event()
+        self.thread = None
+        self.snap = None
+        self.retired = []     # older generations, deleted on the refresh after next
+        self.stamps = {}      # partition file -> (size, mtime) pairs of the last copy
+        self.stats = {'refreshes': 0, 'failed': 0, 'last_seconds': None, 'copied': 0, 'linked': 0, 'last_error': None}
+
+    def current(self):
+        return self.snap
+
+    def start(self):
+        # generations of a previous run are never reused
+        shutil.rmtree(self.dir, ignore_errors=True)
+        self.thread = threading.Thread(target=self._run, name='snapshot', daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.stop.set()
+        if self.thread is not None:
+            self.thread.join(60)
+        snap, self.snap = self.snap, None
+        if snap is not None:
+            snap.db.close()
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    @staticmethod
+    def _stamp(path):
+        return tuple((st.st_size, st.st_mtime_ns) for st in (os.stat(p) for p in (path, path + '-wal') if os.path.exists(p)))
+
+    @staticmethod
+    def _backup(src_path, dst_path):
+        """Copy one database file in a single backup step (a consistent read of the source)."""
+        src = sqlite3.connect(src_path)
+        dst = sqlite3.connect(dst_path)
+        try:
+            src.execute("PRAGMA busy_timeout=5000;")
+            src.backup(dst)
+            # a plain file: readers of the copy need no -wal/-shm next to it
+            dst.execute("PRAGMA journal_mode=DELETE;")
+        finally:
+            dst.close()
+            src.close()
+
+    def refresh(self):
+        """Take a new generation and make it current; returns it."""
+        started = time.perf_counter()
+        prev = self.snap
+        gen = prev.gen + 1 if prev else 1
+        path = os.path.join(self.dir, str(gen))
+        os.makedirs(path, exist_ok=True)
+        taken = time.time()
+        mark = self.ingest.watermark() if self.ingest else 0
+        main_copy = os.path.join(path, os.path.basename(self.db.path))
+        self._backup(self.db.path, main_copy)
+        base = os.path.dirname(self.db.path)
+        conn = sqlite3.connect(main_copy)
+        try:
+            parts = conn.execute("SELECT file FROM partitions WHERE state IN ('hot','cold')").fetchall()
+        finally:
+            conn.close()
+        stamps, copied, linked = {}, 0, 0
+        for (rel,) in parts:
+            src, dst = os.path.join(base, rel), os.path.join(path, rel)
+            if not os.path.exists(src):
+                continue
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            stamp = self._stamp(src)
+            if prev is not None and self.stamps.get(rel) == stamp:
+                try:
+                    os.link(os.path.join(prev.path, rel), dst)
+                    stamps[rel] = stamp
+                    linked += 1
+                    continue
+                except OSError:
+                    pass
+            self._backup(src, dst)
+            stamps[rel] = stamp
+            copied += 1
+        snap = Snapshot(gen, path, Database(main_copy, self.readers, bootstrap=False), taken, mark)
+        with self.lock:
+            self.snap = snap
+            self.stamps = stamps
+            self.stats.update(refreshes=self.stats['refreshes'] + 1, copied=copied, linked=linked,
+                              last_seconds=round(time.perf_counter() - started, 3))
+        if prev is not None:
+            prev.db.close()
+            self.retired.append(prev)
+        while len(self.retired) > 1:
+            shutil.rmtree(self.retired.pop(0).path, ignore_errors=True)
+        return snap
+
+    def _run(self):
+        while not self.stop.is_set():
+            try:
+                self.refresh()
+            except Exception as e:
+                with self.lock:
+                    self.stats['failed'] += 1
+                    self.stats['last_error'] = repr(e)
+                print(f'[snapshot] refresh failed: {e!r}', file=sys.stderr)
+            self.stop.wait(self.interval)
+
+    def snapshot(self):
+        snap = self.snap
+        with self.lock:
+            out = dict(self.stats)
+        out.update(enabled=True, interval_sec=self.interval, generation=snap.gen if snap else None,
+                   taken=int(snap.taken) if snap else None, age_sec=snap.age() if snap else None,
+                   watermark=snap.mark if snap else None,
+                   bytes=sum(file_size(os.path.join(r, f)) for r, _d, fs in os.walk(snap.path)
+                             for f in fs if f.endswith('.db')) if snap else 0)
+        return out
+
+
+class BultenWatcher:
+    """Runs the bulletin watcher (scripts/bulten_worker.py) in a child process.
+
+    Scanning site/bulten_doc, copying assets and rendering pages happen in the child,
+    so they never hold this process's GIL. Jobs go down a multiprocessing queue; the
+    child answers every job with a status dict, which one thread here copies into
+    `state` and the watcher metrics. The child is started with "spawn": forking a
+    process that holds SQLite connections and a writer thread is not safe.
+    """
+
+    def __init__(self, interval=BULTEN_SEC, debounce=BULTEN_DEBOUNCE, metrics=None):
+        self.interval = interval
+        self.debounce = debounce
+        self.metrics = metrics
+        self.proc = None
+        self.jobs = None
+        self.lock = threading.Lock()
+        self.state = {'running': False, 'interval_sec': interval, 'debounce_sec': debounce}
+
+    def start(self):
+        if self.interval <= 0:
+            return
+        try:
+            import bulten_worker
+        except ImportError as e:
+            # e.g. the analytics-only Docker image ships without the site build scripts
+            self.state['error'] = f'watcher unavailable: {e}'
+            print(f'[bulten-watcher] disabled: {e}', file=sys.stderr)
+            return
+        import multiprocessing
+        ctx = multiprocessing.get_context('spawn')
+        self.jobs = ctx.Queue()
+        events = ctx.Queue()
+        self.proc = ctx.Process(target=bulten_worker.run, name='bulten-worker', daemon=True,
+                                args=(self.jobs, events), kwargs={'interval': self.interval, 'debounce': self.debounce})
+        self.proc.start()
+        threading.Thread(target=self._status, args=(events,), name='bulten-status', daemon=True).start()
+
+    def submit(self, job):
+        """Queue a job for the child; False when the watcher is not running."""
+        if self.proc is None or not self.proc.is_alive():
+            return False
+        self.jobs.put(job)
+        return True
+
+    def _status(self, events):
+        while True:
+            try:
+                st = events.get()
+            except (EOFError, OSError):
+                return
+            cycle, errors = st.pop('cycle'), st.pop('new_errors')
+            if self.metrics is not None:
+                if cycle is not None:
+                    self.metrics.observe('analytics_bulten_watcher_cycle_seconds', cycle)
+                if errors:
+                    self.metrics.inc('analytics_bulten_watcher_errors_total', n=errors)
+            with self.lock:
+                self.state.update(st)
+
+    def snapshot(self):
+        with self.lock:
+            out = dict(self.state)
+        out['running'] = self.proc is not None and self.proc.is_alive()
+        return out
+
+    def close(self, timeout=10):
+        if self.proc is None:
+            return
+        try:
+            self.jobs.put(None)
+        except (OSError, ValueError):
+            pass
+        self.proc.join(timeout)
+        if self.proc.is_alive():
+            self.proc.terminate()
+            self.proc.join()
+
+
+# Prometheus metrics (GET /metrics). Families observed on the hot path; everything
+# that can be read off another object (queue depth, file sizes, cache counters) is
+# computed at scrape time by metrics_text() instead.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+METRIC_FAMILIES = (
+    ('analytics_http_requests_total', 'counter', 'HTTP requests by route, method and status code', None),
+    ('analytics_http_request_duration_seconds', 'histogram', 'HTTP request handling time by route', LATENCY_BUCKETS),
+    ('analytics_open_connections', 'gauge', 'Client connections currently open', None),
+    ('analytics_events_invalid_total', 'counter', 'Collected events rejected by validation', None),
+    ('analytics_ingest_insert_duration_seconds', 'histogram', 'Time spent inserting one batch (facts, dictionaries, rollups)', LATENCY_BUCKETS),
+    ('analytics_ingest_commit_duration_seconds', 'histogram', 'Time spent committing one batch', LATENCY_BUCKETS),
+    ('analytics_bulten_watcher_cycle_seconds', 'histogram', 'Duration of one bulletin watcher scan', LATENCY_BUCKETS),
+    ('analytics_bulten_watcher_errors_total', 'counter', 'Bulletin watcher scans or rebuilds that failed', None),
+)
+# label values for routes outside this set are folded into "other"
+METRIC_ROUTES = frozenset((
+    '/admin', '/metrics', '/api/collect', '/api/ingest/bulk', '/api/stats/summary', '/api/stats/ingest', '/api/stats/dashboard',
+    '/api/stats/cache', '/api/stats/realtime', '/api/stream', '/api/export/events', '/api/export/top_blogs', '/api/export/top_searches',
+    '/api/export/sub_clicks', '/api/export/timeseries', '/api/export/appointment_hours', '/api/export/uniques',
+    '/api/bulten/status', '/api/bulten/rebuild', '/api/stats/funnel', '/api/stats/retention', '/api/stats/snapshot',
+))
+
+
+def _prom_number(v):
+    if v == float('inf'):
+        return '+Inf'
+    return repr(v) if isinstance(v, float) else str(v)
+
+
+def _prom_labels(labels):
+    if not labels:
+        return ''
+    esc = lambda v: str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{' + ','.join(f'{k}="{esc(v)}"' for k, v in labels) + '}'
+
+
+def _prom_family(lines, name, kind, help, samples, buckets=None):
+    """Append one family; histogram samples are (labels, per-bucket counts + [+Inf], sum)."""
+    lines.append(f'# HELP {name} {help}')
+    lines.append(f'# TYPE {name} {kind}')
+    for labels, value in samples:
+        if kind != 'histogram':
+            lines.append(f'{name}{_prom_labels(labels)} {_prom_number(value)}')
+            continue
+        counts, total = value
+        acc = 0
+        for le, c in zip(tuple(buckets) + (float('inf'),), counts):
+            acc += c
+            lines.append(f'{name}_bucket{_prom_labels(labels + (("le", _prom_number(le)),))} {acc}')
+        lines.append(f'{name}_sum{_prom_labels(labels)} {_prom_number(total)}')
+        lines.append(f'{name}_count{_prom_labels(labels)} {acc}')
+
+
+class Metrics:
+    """Counters, gauges and histograms of METRIC_FAMILIES, kept in one dict.
+
+    An observation is a bisect plus a couple of additions under one lock, cheap
+    enough for every /api/collect request. Labels are tuples of (name, value) pairs.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.families = {name: (kind, help, buckets) for name, kind, help, buckets in METRIC_FAMILIES}
+        self.values = {}   # (name, labels) -> number, or [bucket counts..., sum] for histograms
+
+    def inc(self, name, labels=(), n=1):
+        key = (name, labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + n
+
+    def observe(self, name, value, labels=()):
+        buckets = self.families[name][2]
+        i = bisect.bisect_left(buckets, value)
+        key = (name, labels)
+        with self.lock:
+            h = self.values.get(key)
+            if h is None:
+                h = self.values[key] = [0] * (len(buckets) + 2)
+            h[i] += 1
+            h[-1] += value
+
+    def render(self, lines):
+        with self.lock:
+            values = {k: list(v) if isinstance(v, list) else v for k, v in self.values.items()}
+        for name, (kind, help, buckets) in self.families.items():
+            samples = sorted((labels, (v[:-1], v[-1]) if kind == 'histogram' else v)
+                             for (n, labels), v in values.items() if n == name)
+            _prom_family(lines, name, kind, help, samples, buckets)
+
+
+def metrics_text(server):
+    """Prometheus text exposition (format 0.0.4) for the running server."""
+    lines = []
+    server.metrics.render(lines)
+    ingest = server.ingest.snapshot()
+    _prom_family(lines, 'analytics_ingest_events_total', 'counter', 'Events leaving the ingest queue by outcome',
+                 [((('result', r),), ingest[k]) for r, k in
+                  (('written', 'rows_written'), ('expired', 'expired'), ('dropped', 'dropped'), ('failed', 'failed'))])
+    _prom_family(lines, 'analytics_ingest_batch_rows', 'histogram', 'Rows per committed batch',
+                 [((), (list(ingest['batch_hist'].values()), ingest['rows_written'] + ingest['expired']))],
+                 IngestQueue.HIST_BOUNDS)
+    _prom_family(lines, 'analytics_ingest_queue_depth', 'gauge', 'Events queued but not yet written',
+                 [((), ingest['queue_depth'])])
+    _prom_family(lines, 'analytics_ingest_queue_capacity', 'gauge', 'Max queued /api/collect requests',
+                 [((), ingest['queue_capacity'])])
+    cache = server.cache.snapshot()
+    _prom_family(lines, 'analytics_result_cache_total', 'counter', 'Result cache lookups and removals by outcome',
+                 [((('result', k),), cache[k]) for k in ('hits', 'misses', 'invalidated', 'expired', 'evicted')])
+    _prom_family(lines, 'analytics_result_cache_entries', 'gauge', 'Bodies held in the result cache',
+                 [((), cache['entries'])])
+    _prom_family(lines, 'analytics_stream_subscribers', 'gauge', 'Open /api/stream dashboards',
+                 [((), server.live.snapshot()['subscribers'])])
+    _prom_family(lines, 'analytics_threads', 'gauge', 'Live Python threads', [((), threading.active_count())])
+    path = server.db.path
+    pdir = partition_dir(path)
+    parts = [os.path.join(pdir, fn) for fn in os.listdir(pdir) if fn.endswith('.db')] if os.path.isdir(pdir) else []
+    size = lambda p: os.path.getsize(p) if os.path.exists(p) else 0
+    _prom_family(lines, 'analytics_db_file_bytes', 'gauge', 'Size of the SQLite files (partitions summed)',
+                 [((('file', 'main'),), size(path)),
+                  ((('file', 'main_wal'),), size(path + '-wal')),
+                  ((('file', 'partitions'),), sum(size(f) for f in parts)),
+                  ((('file', 'partitions_wal'),), sum(size(f + '-wal') for f in parts))])
+    return '\n'.join(lines) + '\n'
+
+
+class IngestQueue:
+    """Bounded write-behind queue drained by one writer thread.
+
+    Each queue item is the list of rows from one /api/collect request. The writer
+    collects items until it has `batch_size` rows or `max_delay` seconds passed since
+    the first one, then writes them with a single executemany + commit. A batch that
+    spans more than WRITER_ATTACHED months (a backfill) is committed in groups of that
+    many months, since every month written in a transaction must stay attached.
+    """
+
+    # upper bounds of the batch size histogram exposed in /api/stats/ingest
+    HIST_BOUNDS = (1, 10, 50, 100, 500, 1000, 5000)
+
+    def __init__(self, db, maxsize=QUEUE_SIZE, batch_size=BATCH_SIZE, max_delay=BATCH_DELAY_MS / 1000.0,
+                 maintenance_interval=MAINTENANCE_SEC, retention_months=RETENTION_MONTHS, retention_mode=RETENTION_MODE,
+                 dict_cache=DICT_CACHE, metrics=None, topk_capacity=TOPK_CAPACITY):
+        from collections import deque
+        self.db = db
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.q = queue.Queue(maxsize=max(1, maxsize))
+        self.batch_size = max(1, batch_size)
+        self.max_delay = max(0.0, max_delay)
+        self.maintenance_interval = max(0, maintenance_interval)
+        self.retention_months = retention_months
+        self.retention_mode = retention_mode
+        self.last_maintenance = None
+        self.interned = LRU(dict_cache)
+        self.sketches = LRU(SKETCH_CACHE)
+        self.topk = TopK(topk_capacity)
+        self.live = None   # LiveFeed, set by main()
+        self.next_id = 0
+        # (first_id, end_id, min_ts, max_ts) of recent commits, see touched_since()
+        self.batch_log = deque(maxlen=BATCH_LOG)
+        self.lock = threading.Lock()
+        self.closed = False
+        self.thread = None
+        self.pending = 0
+        self.stats = {
+            'batches': 0,
+            'rows_written': 0,
+            'last_batch': 0,
+            'largest_batch': 0,
+            'dropped': 0,
+            'failed': 0,
+            'expired': 0,
+        }
+        self.hist = [0] * (len(self.HIST_BOUNDS) + 1)
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name='ingest-writer', daemon=True)
+        self.thread.start()
+
+    def put(self, rows, wait=None):
+        """Enqueue rows; False means the queue is full or closed.
+
+        Without `wait` this never blocks (the /api/collect path); bulk loads wait up
+        to `wait` seconds for room instead.
+        """
+        if not rows:
+            return True
+        with self.lock:
+            if self.closed:
+                self.stats['dropped'] += len(rows)
+                return False
+            try:
+                self.q.put_nowait(rows)
+                self.pending += len(rows)
+                return True
+            except queue.Full:
+                if wait is None:
+                    self.stats['dropped'] += len(rows)
+                    return False
+            self.pending += len(rows)
+        try:
+            # outside the lock: the writer takes it after every batch
+            self.q.put(rows, timeout=wait)
+        except queue.Full:
+            with self.lock:
+                self.pending -= len(rows)
+                self.stats['dropped'] += len(rows)
+            return False
+        return True
+
+    def close(self, timeout=30):
+        """Stop accepting events, flush what is queued and wait for the writer."""
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+        if self.thread is None:
+            return
+        self.q.put(None)
+        self.thread.join(timeout)
+
+    def watermark(self):
+        """Id the next written event will get; changes exactly when new events are committed."""
+        return self.next_id
+
+    def touched_since(self, mark, since, until=None):
+        """True if a batch committed after watermark `mark` wrote an event in [since, until).
+
+        Also True when `mark` is older than the remembered batches, so callers never
+        keep a result the log can no longer vouch for.
+        """
+        with self.lock:
+            if mark >= self.next_id:
+                return False
+            if not self.batch_log or self.batch_log[0][0] > mark:
+                return True
+            for first, end, lo, hi in reversed(self.batch_log):
+                if end <= mark:
+                    return False
+                if hi >= since and (until is None or lo < until):
+                    return True
+            return False
+
+    def snapshot(self):
+        with self.lock:
+            out = dict(self.stats)
+            out['queue_depth'] = self.pending
+            out['queue_items'] = self.q.qsize()
+            out['queue_capacity'] = self.q.maxsize
+            out['batch_size'] = self.batch_size
+            out['batch_delay_ms'] = int(self.max_delay * 1000)
+            labels = [f"<={b}" for b in self.HIST_BOUNDS] + [f">{self.HIST_BOUNDS[-1]}"]
+            out['batch_hist'] = dict(zip(labels, self.hist))
+            out['last_maintenance'] = self.last_maintenance
+            out['dict_cache'] = {'entries': len(self.interned.data), 'capacity': self.interned.size,
+                                 'hits': self.interned.hits, 'misses': self.interned.misses}
+        return out
+
+    def _collect(self, first):
+        """Gather one batch starting with `first`; returns (rows, stop_seen, bulk chunks in it)."""
+        rows = list(first)
+        chunks = [first] if isinstance(first, BulkChunk) else []
+        deadline = _time.monotonic() + self.max_delay
+        while len(rows) < self.batch_size:
+            remaining = deadline - _time.monotonic()
+            try:
+                item = self.q.get(timeout=remaining) if remaining > 0 else self.q.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                return rows, True, chunks
+            rows.extend(item)
+            if isinstance(item, BulkChunk):
+                chunks.append(item)
+        return rows, False, chunks
+
+    def _partition(self, conn, month, keep=()):
+        """Schema alias of `month` on the writer connection; None once retired.
+
+        Must be called outside a transaction. Months in `keep` (the rest of the
+        transaction being prepared) are not detached to make room.
+        """
+        alias = self.attached.get(month)
+        if alias is not None or month in self.retired:
+            return alias
+        path, state = open_partition(conn, month)
+        conn.commit()
+        if state not in LIVE_STATES:
+            self.retired.add(month)
+            return None
+        if len(self.attached) >= WRITER_ATTACHED:
+            # late events for old months: do not pile up attachments
+            for m in [m for m in self.attached if m not in keep]:
+                conn.execute("DETACH DATABASE " + self.attached.pop(m))
+        alias = self.attached[month] = attach(conn, month, path)
+        return alias
+
+    def _intern(self, conn, alias, month, col, s):
+        """Dictionary id of string `s` in the partition's dict_<col> table (inserted on first use)."""
+        if s is None:
+            return None
+        if not isinstance(s, str):
+            s = str(s)
+        key = (month, col, s)
+        sid = self.interned.get(key)
+        if sid is None:
+            conn.execute(f"INSERT OR IGNORE INTO {alias}.dict_{col}(s) VALUES (?)", (s,))
+            sid = conn.execute(f"SELECT id FROM {alias}.dict_{col} WHERE s = ?", (s,)).fetchone()[0]
+            self.interned.put(key, sid)
+        return sid
+
+    def _write(self, conn, rows):
+        """Write one batch; returns the set of months whose rows were rolled back."""
+        n = len(rows)
+        by_month = {}
+        for r in rows:
+            by_month.setdefault(month_key(r[0]), []).append(r)
+        months = sorted(by_month)
+        failed = set()
+        expired = 0
+        fed = []
+        for i in range(0, len(months), WRITER_ATTACHED):
+            group = months[i:i + WRITER_ATTACHED]
+            done = self._commit_months(conn, group, by_month, fed)
+            if done is None:
+                failed.update(group)
+            else:
+                expired += done
+        if fed:
+            self.topk.add(fed)
+            if self.live is not None:
+                self.live.feed(fed)
+        lost = sum(len(by_month[m]) for m in failed)
+        with self.lock:
+            self.pending -= n
+            if lost < n:
+                self.stats['batches'] += 1
+                self.stats['rows_written'] += n - expired - lost
+                self.stats['expired'] += expired
+                self.stats['last_batch'] = n
+                self.stats['largest_batch'] = max(self.stats['largest_batch'], n)
+                i = 0
+                while i < len(self.HIST_BOUNDS) and n > self.HIST_BOUNDS[i]:
+                    i += 1
+                self.hist[i] += 1
+            self.stats['failed'] += lost
+        return failed
+
+    def _commit_months(self, conn, months, by_month, fed):
+        """One transaction for the rows of `months`; returns the expired row count, None on failure."""
+        expired = 0
+        try:
+            tables = {month: self._partition(conn, month, months) for month in months}
+            next_id = self.next_id
+            lo = hi = None
+            raw_all = []
+            t0 = time.perf_counter()
+            with conn:
+                for month in months:
+                    mrows = by_month[month]
+                    alias = tables[month]
+                    if alias is None:
+                        expired += len(mrows)
+                        continue
+                    facts = []
+                    for i, r in enumerate(mrows):
+                        # r[4:9] are ua, ref, page, event, element (DICT_COLUMNS order)
+                        ids = tuple(self._intern(conn, alias, month, col, v) for col, v in zip(DICT_COLUMNS, r[4:9]))
+                        facts.append((next_id + i,) + r[:4] + ids + r[9:])
+                    conn.executemany(INSERT_FACT_SQL.format(schema=alias), facts)
+                    next_id += len(mrows)
+                    conn.execute("UPDATE partitions SET rows = rows + ? WHERE month = ?", (len(mrows), month))
+                    raw = [(r[0], r[6], r[7], r[8], r[9], r[11], r[12]) for r in mrows]
+                    apply_rollups(conn, raw)
+                    raw_all += raw
+                    apply_sketches(conn, ((r[0], r[1], r[2], r[6]) for r in mrows), self.sketches)
+                    ts = [r[0] for r in mrows]
+                    lo = min(ts) if lo is None else min(lo, min(ts))
+                    hi = max(ts) if hi is None else max(hi, max(ts))
+                conn.execute("UPDATE meta SET value = ? WHERE key = 'next_event_id'", (next_id,))
+                t1 = time.perf_counter()
+            self.metrics.observe('analytics_ingest_insert_duration_seconds', t1 - t0)
+            self.metrics.observe('analytics_ingest_commit_duration_seconds', time.perf_counter() - t1)
+            with self.lock:
+                if next_id > self.next_id:
+                    self.batch_log.append((self.next_id, next_id, lo, hi))
+                self.next_id = next_id
+        except Exception as e:
+            # dictionary rows and sketch updates of the rolled back transaction are gone too
+            self.interned.clear()
+            self.sketches.clear()
+            print(f'[ingest] {sum(len(by_month[m]) for m in months)} rows of {", ".join(months)} failed: {e}',
+                  file=sys.stderr)
+            return None
+        fed += raw_all
+        return expired
+
+    def _maintain(self, conn):
+        try:
+            report = self.db.maintain(conn, retention_months=self.retention_months, retention_mode=self.retention_mode)
+        except Exception as e:
+            print(f'[maintenance] failed: {e}', file=sys.stderr)
+            return
+        finally:
+            self.attached.clear()
+        if any(report.values()):
+            print(f'[maintenance] {report}')
+        with self.lock:
+            self.last_maintenance = dict(report, ts=int(time.time()))
+
+    def _run(self):
+        conn = self.db.writer()
+        self.attached = {}
+        self.retired = set()
+        self.next_id = conn.execute("SELECT value FROM meta WHERE key = 'next_event_id'").fetchone()[0]
+        try:
+            replayed = self.topk.load(conn)
+            if replayed:
+                print(f'[topk] counted {replayed} events written after the last checkpoint')
+        except Exception as e:
+            print(f'[topk] restore failed: {e}', file=sys.stderr)
+        interval = self.maintenance_interval
+        next_maintenance = _time.monotonic() + interval
+        next_checkpoint = _time.monotonic() + TOPK_CHECKPOINT_SEC
+        try:
+            while True:
+                try:
+                    item = self.q.get(timeout=max(0.0, next_maintenance - _time.monotonic()) if interval else None)
+                except queue.Empty:
+                    item = ()
+                if item is None:
+                    break
+                stop = False
+                if item:
+                    rows, stop, chunks = self._collect(item)
+                    failed = self._write(conn, rows)
+                    for chunk in chunks:
+                        chunk.finish(failed, self.retired)
+                if self.topk.dirty and (stop or _time.monotonic() >= next_checkpoint):
+                    self._checkpoint(conn)
+                    next_checkpoint = _time.monotonic() + TOPK_CHECKPOINT_SEC
+                if interval and _time.monotonic() >= next_maintenance:
+                    self._maintain(conn)
+                    next_maintenance = _time.monotonic() + interval
+                if stop:
+                    break
+            if self.topk.dirty:
+                self._checkpoint(conn)
+        finally:
+            conn.close()
+
+    def _checkpoint(self, conn):
+        try:
+            self.topk.checkpoint(conn, self.next_id)
+        except Exception as e:
+            print(f'[topk] checkpoint failed: {e}', file=sys.stderr)
+
+
+MAX_TS = 253402300800   # 10000-01-01: beyond what gmtime/month partitions accept
+
+
+def event_row(eo, now, ip, ua):
+    """Map one client event dict to an `events` row tuple (None if unusable)."""
+    try:
+        ts = int(eo.get('ts') or now)
+        if not 0 <= ts < MAX_TS:
+            ts = now
+        props = eo.get('props') or {}
+        return (
+            ts,
+            eo.get('cid'), eo.get('sid'),
+            ip, ua,
+            eo.get('ref'), eo.get('page'),
+            eo.get('event'), eo.get('element'), eo.get('value'),
+            json.dumps(props, ensure_ascii=False),
+        ) + props_fields(eo.get('event'), props)
+    except Exception:
+        return None
+
+
+# ---- bulk ingest ----------------------------------------------------------------
+# /api/ingest/bulk and `--load` share everything below: lines are parsed into rows,
+# grouped into BULK_CHUNK-row chunks and handed to the same IngestQueue writer, so a
+# backfill updates partitions, rollups, sketches and top-k exactly like live traffic.
+BULK_MAX_LINE = 64 * 1024   # longer lines are rejected without being parsed
+BULK_INFLIGHT = 2           # chunks of one load queued or being written at a time
+BULK_WAIT = 300             # seconds an upload waits for queue room or a commit
+BULK_SAMPLES = 20           # rejected lines reported by line number
+BULK_FIELDS = (('client_id', 'cid'), ('session_id', 'sid'), ('ip', None), ('ua', None), ('ref', None),
+               ('page', None), ('event', None), ('element', None), ('value', None))
+
+
+class BulkChunk(list):
+    """Rows of one bulk transaction; `done` is set once the writer has handled them."""
+
+    def __init__(self, rows):
+        super().__init__(rows)
+        self.done = threading.Event()
+        self.failed = 0
+        self.expired = 0
+
+    def finish(self, failed, retired):
+        """`failed`: months whose rows the writer rolled back; `retired`: months no longer written."""
+        if failed or retired:
+            months = [month_key(r[0]) for r in self]
+            self.failed = sum(1 for m in months if m in failed)
+            self.expired = sum(1 for m in months if m in retired and m not in failed)
+        self.done.set()
+
+
+def bulk_row(rec, csv=False):
+    """(`events` row, None) for one bulk record, or (None, reason) when it is rejected.
+
+    Records are /api/export/events rows (client_id, session_id, ip, ua, ...) or
+    /api/collect events (cid, sid). `id` is ignored, rows get new ids. Unlike
+    /api/collect a missing or out of range `ts` rejects the line instead of dating
+    it to now. For CSV input empty cells are NULL, as the export writes them.
+    """
+    if not isinstance(rec, dict):
+        return None, 'not_object'
+    ts = rec.get('ts')
+    if isinstance(ts, str) and ts.isdigit():
+        ts = int(ts)
+    if type(ts) is not int or not 0 <= ts < MAX_TS:
+        return None, 'ts'
+    vals = []
+    for key, alias in BULK_FIELDS:
+        v = rec.get(key)
+        if v is None and alias:
+            v = rec.get(alias)
+        if csv and v == '':
+            v = None
+        elif not (v is None or isinstance(v, (str, int, float))):
+            return None, 'type'
+        vals.append(v)
+    props = rec.get('props')
+    if isinstance(props, str):
+        # CSV cell, or a props text the export could not parse: stored as it was
+        text = props or '{}'
+        try:
+            props = json.loads(text)
+        except ValueError:
+            props = None
+    elif props is None or isinstance(props, dict):
+        props = props or {}
+        text = json.dumps(props, ensure_ascii=False)
+    else:
+        return None, 'type'
+    return (ts, *vals, text) + props_fields(vals[6], props), None
+
+
+def request_blocks(rfile, headers, size=64 * 1024):
+    """Request body in blocks as it arrives, from Content-Length or chunked coding."""
+    if 'chunked' in (headers.get('Transfer-Encoding') or '').lower():
+        while True:
+            n = int(rfile.readline(1024).split(b';')[0], 16)
+            if n == 0:
+                while rfile.readline(1024) not in (b'\r\n', b'\n', b''):
+                    pass   # trailers
+                return
+            while n > 0:
+                data = rfile.read(min(n, size))
+                if not data:
+                    raise ConnectionError('request body truncated')
+                n -= len(data)
+                yield data
+            rfile.readline(1024)
+    left = int(headers.get('Content-Length') or 0)
+    while left > 0:
+        data = rfile.read(min(left, size))
+        if not data:
+            raise ConnectionError('request body truncated')
+        left -= len(data)
+        yield data
+
+
+def gunzip_blocks(blocks, force=False):
+    """Inflate gzip/zlib blocks (concatenated gzip members too); plain input passes through.
+
+    Without `force` the stream is inflated only if it starts with the gzip magic.
+    Output comes in pieces of at most 1 MB, so a small compressed line cannot expand
+    into one huge buffer.
+    """
+    blocks = iter(blocks)
+    first = next(blocks, b'')
+    if not (force or first[:2] == b'\x1f\x8b'):
+        if first:
+            yield first
+        yield from blocks
+        return
+    d = zlib.decompressobj(47)   # 32 + 15: gzip or zlib header, detected
+    fed = False
+    for data in itertools.chain((first,), blocks):
+        while data:
+            fed = True
+            out = d.decompress(data, 1 << 20)
+            if out:
+                yield out
+            if d.eof:
+                data = d.unused_data
+                d = zlib.decompressobj(47)
+                fed = False
+            else:
+                data = d.unconsumed_tail
+    if fed and not d.eof:
+        raise zlib.error('compressed stream truncated')
+
+
+def bulk_lines(blocks, max_line=BULK_MAX_LINE):
+    """(line number, bytes) per line; over-long lines come as None and are skipped unread."""
+    n, buf, skipping = 0, b'', False
+    for block in blocks:
+        start = 0
+        while True:
+            nl = block.find(b'\n', start)
+            if nl < 0:
+                if not skipping:
+                    buf += block[start:]
+                    if len(buf) > max_line:
+                        buf, skipping = b'', True
+                break
+            n += 1
+            if skipping or len(buf) + nl - start > max_line:
+                yield n, None
+                skipping = False
+            else:
+                yield n, buf + block[start:nl]
+            buf, start = b'', nl + 1
+    if skipping:
+        yield n + 1, None
+    elif buf:
+        yield n + 1, buf
+
+
+def ndjson_records(lines):
+    """(line number, record, reason) per non-blank NDJSON line."""
+    for n, line in lines:
+        if line is None:
+            yield n, None, 'too_long'
+        elif line.strip():
+            try:
+                yield n, json.loads(line), None
+            except ValueError:
+                yield n, None, 'json'
+
+
+def csv_records(lines):
+    """(line number, record, reason) per CSV row; the first row names the columns.
+
+    Quoted cells may span lines, so numbers are the line the row ends on.
+    """
+    import csv
+    too_long = []
+    def text():
+        for n, line in lines:
+            if line is None:
+                too_long.append(n)
+            else:
+                yield line.decode('utf-8', 'replace') + '\n'
+    reader = csv.reader(text())
+    header = None
+    while True:
+        try:
+            row = next(reader, None)
+        except csv.Error as e:
+            raise ValueError(f'CSV line {reader.line_num}: {e}')
+        for n in too_long:
+            yield n, None, 'too_long'
+        too_long.clear()
+        if row is None:
+            return
+        if header is None:
+            header = [h.lstrip('\ufeff') for h in row]
+        elif any(row):
+            yield reader.line_num, dict(zip(header, row)), None
+
+
+def bulk_records(blocks, fmt='ndjson', gzip=False):
+    """Records of a bulk body or file given as byte blocks, gzip detected or forced."""
+    lines = bulk_lines(gunzip_blocks(blocks, gzip))
+    return csv_records(lines) if fmt == 'csv' else ndjson_records(lines)
+
+
+class BulkLoad:
+    """Feeds one bulk load to an IngestQueue in BulkChunks and counts what happened.
+
+    At most BULK_INFLIGHT chunks are queued or being written at a time, so a large
+    upload keeps a bounded number of rows in memory and is paced by the writer. If
+    the input breaks off, rows parsed so far are still written: `lines` then tells
+    how far a retry can skip.
+    """
+
+    def __init__(self, ingest, chunk=BULK_CHUNK, wait=BULK_WAIT):
+        from collections import deque
+        self.ingest = ingest
+        self.chunk = max(1, chunk)
+        self.wait = wait
+        self.inflight = deque()
+        self.lines = self.written = self.expired = self.failed = self.pending = 0
+        self.errors = {}
+        self.samples = []
+
+    def run(self, records, csv=False):
+        """Load (line number, record, reason) triples; returns once every chunk is settled."""
+        rows = []
+        try:
+            for n, rec, reason in records:
+                self.lines = n
+                if reason is None:
+                    row, reason = bulk_row(rec, csv)
+                if reason is not None:
+                    self.errors[reason] = self.errors.get(reason, 0) + 1
+                    if len(self.samples) < BULK_SAMPLES:
+                        self.samples.append({'line': n, 'error': reason})
+                    continue
+                rows.append(row)
+                if len(rows) >= self.chunk:
+                    batch, rows = rows, []
+                    self._submit(batch)
+        finally:
+            try:
+                if rows:
+                    self._submit(rows)
+            finally:
+                while self.inflight:
+                    self._settle(self.inflight.popleft())
+
+    def _submit(self, rows):
+        while len(self.inflight) >= BULK_INFLIGHT:
+            self._settle(self.inflight.popleft())
+        chunk = BulkChunk(rows)
+        if not self.ingest.put(chunk, wait=self.wait):
+            self.failed += len(chunk)
+            raise queue.Full('ingest queue full or closed')
+        self.inflight.append(chunk)
+
+    def _settle(self, chunk):
+        if not chunk.done.wait(self.wait):
+            self.pending += len(chunk)
+        else:
+            self.written += len(chunk) - chunk.expired - chunk.failed
+            self.expired += chunk.expired
+            self.failed += chunk.failed
+
+    def report(self):
+        return {
+            'lines': self.lines,
+            'written': self.written,
+            'invalid': sum(self.errors.values()),
+            'errors': dict(self.errors),
+            'samples': self.samples,
+            'expired': self.expired,
+            'failed': self.failed,
+            'pending': self.pending,
+        }
+
+
+def query_int(qs, name, default):
+    """Integer query parameter from parse_qs() output; `default` when absent or not a number."""
+    try:
+        return int((qs.get(name) or [default])[0])
+    except Exception:
+        return default
+
+
+def ok_token(headers):
+    if not TOKEN:
+        return True
+    return headers.get('X-Analytics-Token', '') == TOKEN
+
+
+class ChunkedWriter:
+    """HTTP/1.1 chunked body writer with optional streaming gzip/deflate.
+
+    Writes are buffered up to `chunk` bytes so each cursor page becomes a handful of
+    frames instead of one frame per row.
+    """
+
+    def __init__(self, wfile, coding=None, chunk=64 * 1024):
+        self.wfile = wfile
+        self.chunk = chunk
+        self.buf = []
+        self.size = 0
+        self.z = zlib.compressobj(6, zlib.DEFLATED, CODING_WBITS[coding]) if coding else None
+
+    def write(self, data):
+        if self.z is not None:
+            data = self.z.compress(data)
+        if data:
+            self.buf.append(data)
+            self.size += len(data)
+            if self.size >= self.chunk:
+                self.flush()
+
+    def flush(self):
+        if self.size:
+            data = b''.join(self.buf)
+            self.wfile.write(b'%x\r\n' % len(data) + data + b'\r\n')
+            self.buf = []
+            self.size = 0
+
+    def close(self):
+        if self.z is not None:
+            tail = self.z.flush()
+            if tail:
+                self.buf.append(tail)
+                self.size += len(tail)
+        self.flush()
+        self.wfile.write(b'0\r\n\r\n')
+
+
+EXPORT_COLUMNS = ['ts','client_id','session_id','ip','ua','ref','page','event','element','value','props','id']
+EXPORT_PAGE = 5000
+
+
+def export_pages(conn, since, until, after, desc, limit):
+    """Yield lists of export rows in (ts, id) keyset order, EXPORT_PAGE rows per query.
+
+    `after` is a (ts, id) cursor to resume strictly after. Each page is its own short
+    statement, so a full-history export never holds one long read transaction.
+    """
+    sql = HOT_QUERIES['export_page_desc' if desc else 'export_page_asc'][0]
+    if after is None:
+        # a cursor just outside the window makes the first page start at its edge
+        after = (until, 0) if desc else (since - 1, 0)
+    cur_ts, cur_id = after
+    left = limit if limit > 0 else None
+    # partitions are disjoint month ranges, so walking them in order keeps (ts, id) order
+    lo, hi = (since, min(cur_ts + 1, until)) if desc else (max(cur_ts, since), until)
+    for table in each_partition(conn, lo, hi, desc):
+        while left is None or left > 0:
+            n = EXPORT_PAGE if left is None else min(EXPORT_PAGE, left)
+            if desc:
+                params = (since, min(cur_ts, until - 1), cur_ts, cur_id, n)
+            else:
+                params = (max(cur_ts, since), until, cur_ts, cur_id, n)
+            rows = conn.execute(sql.format(events=table), params).fetchall()
+            if rows:
+                yield rows
+                cur_ts, cur_id = rows[-1][0], rows[-1][-1]
+                if left is not None:
+                    left -= len(rows)
+            if len(rows) < n:
+                break
+        if left is not None and left <= 0:
+            return
+
+
+# zlib wbits per HTTP content coding: gzip container, or zlib-wrapped "deflate" (RFC 9110)
+CODING_WBITS = {'gzip': 31, 'deflate': 15}
+COMPRESS_MIN = 512        # smaller bodies are not worth a Content-Encoding
+
+
+def accept_encoding(headers, offers=('gzip', 'deflate')):
+    """Preferred coding among `offers` per Accept-Encoding q-values; None means identity."""
+    prefs = {}
+    for part in (headers.get('Accept-Encoding') or '').split(','):
+        name, _, params = part.strip().partition(';')
+        name = name.strip().lower()
+        if not name:
+            continue
+        q = 1.0
+        for param in params.split(';'):
+            k, _, v = param.strip().partition('=')
+            if k.strip().lower() == 'q':
+                try:
+                    q = float(v)
+                except ValueError:
+                    q = 0.0
+        prefs['gzip' if name == 'x-gzip' else name] = q
+    best, best_q = None, 0.0
+    for coding in offers:
+        q = prefs.get(coding, prefs.get('*', 0.0))
+        if q > best_q:
+            best, best_q = coding, q
+    return best
+
+
+def encode_body(body, coding):
+    z = zlib.compressobj(6, zlib.DEFLATED, CODING_WBITS[coding])
+    return z.compress(body) + z.flush()
+
+
+# /admin is static: compress it once per coding and serve it with a content ETag
+ADMIN_BODIES = {None: ADMIN_HTML.encode('utf-8')}
+ADMIN_BODIES.update((coding, encode_body(ADMIN_BODIES[None], coding)) for coding in CODING_WBITS)
+ADMIN_ETAG = 'W/"admin-%08x"' % zlib.crc32(ADMIN_BODIES[None])
+# Stats bodies depend on the data (last event id) and on `now`; `now` is rounded down
+# to STATS_TICK seconds so that repeated dashboard loads can be answered with 304.
+STATS_TICK = max(1, int(os.environ.get("ANALYTICS_STATS_TICK", "10")))
+STATS_CACHE_CONTROL = 'private, no-cache'
+BOOT_ID = '%x' % int(time.time())   # stats ETags from a previous process never match
+
+
+class Handler(BaseHTTPRequestHandler):
+    server_version = "VMAnalytics/1.0"
+    # 1.1 for chunked export streams and keep-alive; every reply sets its framing
+    protocol_version = "HTTP/1.1"
+
+    def _set_cors(self):
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.send_header('Access-Control-Allow-Headers', 'Content-Type, X-Analytics-Token')
+        self.send_header('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
+
+    def _reply(self, code, body=b'', ctype=None, headers=None, compress=True):
+        headers = dict(headers or {})
+        if compress and code == 200 and body:
+            headers['Vary'] = 'Accept-Encoding'
+            coding = accept_encoding(self.headers) if len(body) >= COMPRESS_MIN else None
+            if coding:
+                body = encode_body(body, coding)
+                headers['Content-Encoding'] = coding
+        self.send_response(code)
+        self._set_cors()
+        if ctype:
+            self.send_header('Content-Type', ctype)
+        for k, v in headers.items():
+            self.send_header(k, v)
+        if code not in (204, 304):
+            self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if body and self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def _json(self, data, headers=None):
+        self._reply(200, json.dumps(data).encode('utf-8'), 'application/json', headers)
+
+    def _not_modified(self, etag, cache_control):
+        """Answer 304 and return True when If-None-Match already names `etag`."""
+        inm = self.headers.get('If-None-Match')
+        if not inm:
+            return False
+        weak = etag[2:] if etag.startswith('W/') else etag
+        for tag in inm.split(','):
+            tag = tag.strip()
+            if tag == '*' or (tag[2:] if tag.startswith('W/') else tag) == weak:
+                self._reply(304, headers={'ETag': etag, 'Cache-Control': cache_control})
+                return True
+        return False
+
+    def _stats_etag(self):
+        """(etag, now) for stats responses: same last event id and time tick, same body."""
+        now = int(time.time()) // STATS_TICK * STATS_TICK
+        snap = self.__dict__.get('_snap')
+        gen = f'-s{snap.gen}' if snap is not None else ''
+        return f'W/"{BOOT_ID}-{self.server.ingest.watermark()}-{now}{gen}"', now
+
+    def _cached(self, key, now, since, until, render):
+        """Body for `key` from the result cache, else render(conn) and remember it.
+
+        Windows ending at or before `now` are closed: keyed without the tick and kept
+        until an ingested event lands inside them. Open windows are keyed by the tick.
+        """
+        cache, ingest = self.server.cache, self.server.ingest
+        closed = until is not None and until <= now
+        key = key + (None if closed else now,)
+        snap = self.__dict__.get('_snap')
+        if snap is not None:
+            key = key + ('snapshot', snap.gen)
+        body = cache.get(key, ingest)
+        if body is None:
+            mark = ingest.watermark()   # before reading, so a racing batch only invalidates
+            body = render(self.read_db())
+            cache.put(key, body, mark, since, until, closed)
+        return body
+
+    def handle(self):
+        # threaded engine: one call per connection (AsyncHTTPServer counts its own)
+        self.server.metrics.inc('analytics_open_connections')
+        try:
+            super().handle()
+        finally:
+            self.server.metrics.inc('analytics_open_connections', n=-1)
+
+    def parse_request(self):
+        self._started = time.perf_counter()
+        return super().parse_request()
+
+    def send_response(self, code, message=None):
+        self._status = code
+        super().send_response(code, message)
+        snap = self.__dict__.get('_snap')
+        if snap is not None:
+            self.send_header('X-Snapshot-Age', str(snap.age()))
+
+    def handle_one_request(self):
+        try:
+            super().handle_one_request()
+        finally:
+            self._finish_request()
+
+    def _finish_request(self):
+        """Return the pooled read connection and record route, status and latency."""
+        conn = self.__dict__.pop('_conn', None)
+        snap = self.__dict__.pop('_snap', None)
+        if conn is not None:
+            (snap.db if snap is not None else self.server.db).release(conn)
+        started = self.__dict__.pop('_started', None)
+        if started is None:
+            return
+        route = urlparse(getattr(self, 'path', '')).path
+        route = route if route in METRIC_ROUTES else 'other'
+        method = self.command if self.command in ('GET', 'POST', 'OPTIONS', 'HEAD') else 'other'
+        metrics = self.server.metrics
+        metrics.inc('analytics_http_requests_total',
+                    (('route', route), ('method', method), ('code', str(self.__dict__.pop('_status', 0)))))
+        metrics.observe('analytics_http_request_duration_seconds', time.perf_counter() - started, (('route', route),))
+
+    def read_db(self):
+        """Read-only pooled connection for this request, returned after the response."""
+        conn = self.__dict__.get('_conn')
+        if conn is None:
+            snap = self.__dict__.get('_snap')
+            conn = self._conn = (snap.db if snap is not None else self.server.db).acquire()
+        return conn
+
+    def _use_snapshot(self):
+        """Point this request's reads at the current read snapshot, when one is ready.
+
+        Call before read_db(); the generation stays pinned until the response is done
+        and every response header then carries its X-Snapshot-Age.
+        """
+        replica = self.server.snapshot
+        snap = replica.current() if replica is not None else None
+        if snap is not None and '_conn' not in self.__dict__:
+            self._snap = snap
+        return snap
+
+    def do_OPTIONS(self):
+        self._reply(204)
+
+    def do_GET(self):
+        parsed = urlparse(self.path)
+        if parsed.path == '/admin':
+            if self._not_modified(ADMIN_ETAG, 'no-cache'):
+                return
+            coding = accept_encoding(self.headers)
+            headers = {'ETag': ADMIN_ETAG, 'Cache-Control': 'no-cache', 'Vary': 'Accept-Encoding'}
+            if coding:
+                headers['Content-Encoding'] = coding
+            self._reply(200, ADMIN_BODIES[coding], 'text/html; charset=utf-8', headers, compress=False)
+            return
+        if parsed.path == '/metrics':
+            if not ok_token(self.headers):
+                self._reply(401); return
+            self._reply(200, metrics_text(self.server).encode('utf-8'), 'text/plain; version=0.0.4; charset=utf-8')
+            return
+        if parsed.path == '/api/stats/summary':
+            if not ok_token(self.headers):
+                self._reply(401); return
+            self._use_snapshot()
+            etag, now = self._stats_etag()
+            if self._not_modified(etag, STATS_CACHE_CONTROL):
+                return
+            body = self._cached(('summary',), now, now - 7*24*3600, None,
+                                lambda conn: json.dumps(stats_summary(conn, now)).encode('utf-8'))
+            self._reply(200, body, 'application/json', {'ETag': etag, 'Cache-Control': STATS_CACHE_CONTROL})
+            return
+        if parsed.path == '/api/stats/ingest':
+            if not ok_token(self.headers):
+                self._reply(401); return
+            self._json(self.server.ingest.snapshot())
+            return
+        if parsed.path == '/api/stats/dashboard':
+            if not ok_token(self.headers):
+                self._reply(401); return
+            self._use_snapshot()
+            etag, now = self._stats_etag()
+            if self._not_modified(etag, STATS_CACHE_CONTROL):
+                return
+            # unique counts come from whole-day sketches: the 30 day window starts at 00:00 UTC
+            body = self._cached(('dashboard',), now, (now - 30*24*3600) // DAY * DAY, None,
+                                lambda conn: json.dumps(stats_dashboard(conn, now)).encode('utf-8'))
+            self._reply(200, body, 'application/json', {'ETag': etag, 'Cache-Control': STATS_CACHE_CONTROL})
+            return
+        if parsed.path == '/api/stream':
+            if self._start_stream():
+                self._stream_live()
+            return
+        if parsed.path == '/api/stats/realtime':
+            if not ok_token(self.headers):
+                self._reply(401); return
+            qs = parse_qs(parsed.query)
+            try:
+                k = max(1, min(int((qs.get('k') or ['10'])[0]), self.server.ingest.topk.capacity))
+            except ValueError:
+                k = 10
+            self._json(stats_realtime(self.server.ingest.topk, int(time.time()), k))
+            return
+        if parsed.path == '/api/bulten/status':
+            if not ok_token(self.headers):
+                self._reply(401); return
+            self._json(self.server.bulten.snapshot())
+            return
+        if parsed.path in ('/api/stats/funnel', '/api/stats/retention'):
+            if not ok_token(self.headers):
+                self._reply(401); return
+            if numpy_or_none() is None:
+                self._reply(501, json.dumps({'error': 'numpy is not installed'}).encode('utf-8'), 'application/json')
+                return
+            qs = parse_qs(parsed.query)
+            by = 'session' if (qs.get('by') or [''])[0] == 'session' else 'client'
+            until = query_int(qs, 'until', 0) or None
+            self._use_snapshot()
+            etag, now = self._stats_etag()
+            if self._not_modified(etag, STATS_CACHE_CONTROL):
+                return
+            # the window starts on the tick, but an open one ends after the current second
+            # (until is exclusive): the last seconds' events count, later ones invalidate the body
+            end = until or int(time.time()) + 1
+            if parsed.path == '/api/stats/funnel':
+                days = max(1, query_int(qs, 'days', 30))
+                window = max(1, query_int(qs, 'window_days', FUNNEL_WINDOW_DAYS)) * DAY
+                since = (until or now) - days*24*3600
+                key = ('funnel', days, until, by, window)
+                render = lambda conn: json.dumps(funnel_report(conn, since, end, window, by)).encode('utf-8')
+            else:
+                days = max(1, query_int(qs, 'days', 56))
+                max_day = max(0, min(query_int(qs, 'max_day', RETENTION_DAYS), days))
+                since = (until or now) - days*24*3600
+                key = ('retention', days, until, by, max_day)
+                render = lambda conn: json.dumps(retention_report(conn, since, end, max_day, by)).encode('utf-8')
+            body = self._cached(key, now, since, until, render)
+            self._reply(200, body, 'application/json', {'ETag': etag, 'Cache-Control': STATS_CACHE_CONTROL})
+            return
+        if parsed.path == '/api/stats/snapshot':
+            if not ok_token(self.headers):
+                self._reply(401); return
+            replica = self.server.snapshot
+            self._json(replica.snapshot() if replica is not None else {'enabled': False})
+            return
+        if parsed.path == '/api/stats/cache':
+            if not ok_token(self.headers):
+                self._reply(401); return
+            self._json(self.server.cache.snapshot())
+            return
+        # CSV exports
+        if parsed.path.startswith('/api/export/'):
+            if not ok_token(self.headers):
+                self._reply(401); return
+            qs = parse_qs(parsed.query)
+            self._use_snapshot()
+            if parsed.path == '/api/export/events':
+                self._stream_events(self.read_db(), qs); return
+            days = query_int(qs, 'days', 7)
+            until = query_int(qs, 'until', 0) or None
+            by_page = (qs.get('by') or [''])[0] == 'page'
+            exports = {
+                '/api/export/top_blogs': ('top_blogs.csv', ['page','views'],
+                    lambda conn: top_pages(conn, since, 100, blog_only=True, until=until)),
+                '/api/export/top_searches': ('top_searches.csv', ['query','count'],
+                    lambda conn: top_values(conn, since, 'search', 100, until=until)),
+                '/api/export/sub_clicks': ('subscribe_clicks.csv', ['page','clicks'],
+                    lambda conn: top_sub_clicks(conn, since, 200, until=until)),
+                '/api/export/timeseries': ('timeseries.csv', ['date','appointments','emails'],
+                    lambda conn: [(time.strftime('%Y-%m-%d', time.gmtime(dkey*86400)), apt, mail)
+                                  for dkey, apt, mail in daily_series(conn, since, until or now, until)]),
+                '/api/export/appointment_hours': ('appointment_hours.csv', ['hour','count'],
+                    lambda conn: [(f"{i:02d}", n) for i, n in enumerate(appointment_hours(conn, since, until))]),
+                '/api/export/uniques': ('uniques.csv', ['page' if by_page else 'date', 'visitors', 'sessions'],
+                    lambda conn: sorted(((page, v, n) for page, (v, n) in unique_counts(conn, since, until, True).items()),
+                                        key=lambda r: (-r[1], r[0])) if by_page else
+                                 [(time.strftime('%Y-%m-%d', time.gmtime(d*86400)), v, n)
+                                  for d, v, n in unique_series(conn, since, until or now, until)]),
+            }
+            if parsed.path not in exports:
+                self._reply(404); return
+            etag, now = self._stats_etag()
+            if self._not_modified(etag, STATS_CACHE_CONTROL):
+                return
+            since = (until or now) - days*24*3600
+            filename, header, rows = exports[parsed.path]
+            def render(conn):
+                import csv
+                buf = io.StringIO(); w = csv.writer(buf)
+                w.writerow(header)
+                w.writerows(rows(conn))
+                return buf.getvalue().encode('utf-8')
+            lo, hi = since, until
+            if parsed.path == '/api/export/uniques':
+                # day sketches: an event anywhere in the first or last day changes the result
+                lo, hi = since // DAY * DAY, (-(-until // DAY) * DAY if until else None)
+            body = self._cached(('export', parsed.path, days, until, by_page), now, lo, hi, render)
+            self._reply(200, body, 'text/csv; charset=utf-8',
+                        {'Content-Disposition': f'attachment; filename="{filename}"',
+                         'ETag': etag, 'Cache-Control': STATS_CACHE_CONTROL})
+            return
+        self._reply(404)
+
+    def _start_stream(self):
+        """Write the /api/stream response head; False after answering 401.
+
+        EventSource cannot send headers, so the token may also come as ?token=.
+        """
+        token = (parse_qs(urlparse(self.path).query).get('token') or [''])[0]
+        if not (ok_token(self.headers) or token == TOKEN):
+            self._reply(401)
+            return False
+        self.close_connection = True   # the body ends when either side closes
+        self.send_response(200)
+        self._set_cors()
+        self.send_header('Content-Type', 'text/event-stream; charset=utf-8')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Connection', 'close')
+        self.send_header('X-Accel-Buffering', 'no')
+        self.end_headers()
+        self.wfile.write(b'retry: 3000\n\n')
+        return True
+
+    def _stream_live(self):
+        """Relay LiveFeed events to this client until it disconnects or falls behind."""
+        q = queue.Queue(LIVE_BACKLOG)
+        def push(data):
+            try:
+                q.put_nowait(data)
+                return True
+            except queue.Full:
+                return False
+        live = self.server.live
+        live.subscribe(push)
+        try:
+            self.wfile.flush()
+            while True:
+                # the feed sends at least a heartbeat meanwhile unless it dropped us
+                data = q.get(timeout=live.heartbeat * 2)
+                if data is None:
+                    break
+                self.wfile.write(data)
+                self.wfile.flush()
+        except (queue.Empty, OSError):
+            pass
+        finally:
+            live.unsubscribe(push)
+
+    def _stream_events(self, conn, qs):
+        """Raw events as CSV or NDJSON, streamed page by page from a keyset cursor.
+
+        Query: format=csv|ndjson, since/until (unix ts, until exclusive), order=desc|asc,
+        limit (0 = no limit), after_ts/after_id to resume after the last row received,
+        gzip=0 to disable compression when the client accepts gzip or deflate.
+        """
+        import csv, io
+        fmt = (qs.get('format') or ['csv'])[0].lower()
+        if fmt not in ('csv', 'ndjson'):
+            self._reply(400); return
+        desc = (qs.get('order') or ['desc'])[0].lower() != 'asc'
+        since = query_int(qs, 'since', 0)
+        until = query_int(qs, 'until', 1 << 62)
+        limit = query_int(qs, 'limit', 10000)
+        after = None
+        if 'after_ts' in qs:
+            after = (query_int(qs, 'after_ts', 0), query_int(qs, 'after_id', 0))
+        coding = accept_encoding(self.headers) if (qs.get('gzip') or ['1'])[0] != '0' else None
+        self.send_response(200)
+        self._set_cors()
+        if fmt == 'csv':
+            self.send_header('Content-Type', 'text/csv; charset=utf-8')
+            self.send_header('Content-Disposition', 'attachment; filename="events.csv"')
+        else:
+            self.send_header('Content-Type', 'application/x-ndjson; charset=utf-8')
+            self.send_header('Content-Disposition', 'attachment; filename="events.ndjson"')
+        if coding:
+            self.send_header('Content-Encoding', coding)
+        self.send_header('Vary', 'Accept-Encoding')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        out = ChunkedWriter(self.wfile, coding)
+        buf = io.StringIO()
+        w = csv.writer(buf)
+        if fmt == 'csv':
+            w.writerow(EXPORT_COLUMNS)
+        try:
+            for rows in export_pages(conn, since, until, after, desc, limit):
+                if fmt == 'csv':
+                    w.writerows(rows)
+                else:
+                    for r in rows:
+                        rec = dict(zip(EXPORT_COLUMNS, r))
+                        try:
+                            rec['props'] = json.loads(rec['props']) if rec['props'] else {}
+                        except ValueError:
+                            pass
+                        buf.write(json.dumps(rec, ensure_ascii=False))
+                        buf.write('\n')
+                out.write(buf.getvalue().encode('utf-8'))
+                buf.seek(0); buf.truncate()
+            out.write(buf.getvalue().encode('utf-8'))
+            out.close()
+        except Exception as e:
+            # headers are gone; drop the connection so the client sees a truncated body
+            print(f'[export] stream aborted: {e}', file=sys.stderr)
+            self.close_connection = True
+
+    def do_POST(self):
+        parsed = urlparse(self.path)
+        if parsed.path == '/api/collect':
+            if not ok_token(self.headers):
+                # body left unread: do not reuse the connection
+                self.close_connection = True
+                self._reply(401); return
+            length = int(self.headers.get('Content-Length', '0') or 0)
+            raw = self.rfile.read(length) if length else b''
+            try:
+                ev = json.loads(raw.decode('utf-8')) if raw else {}
+            except Exception:
+                self._reply(400); return
+            # Queue (single or batch); the ingest writer thread does the INSERTs
+            now = int(time.time())
+            ip = self.client_address[0]
+            ua = self.headers.get('User-Agent', '')
+            if isinstance(ev, dict) and 'batch' in ev and isinstance(ev['batch'], list):
+                items = ev['batch']
+            else:
+                items = [ev]
+            rows = [r for r in (event_row(item, now, ip, ua) for item in items if isinstance(item, dict)) if r is not None]
+            if len(rows) < len(items):
+                self.server.metrics.inc('analytics_events_invalid_total', n=len(items) - len(rows))
+            if not self.server.ingest.put(rows):
+                self._reply(503, headers={'Retry-After': '5'})
+                return
+            self._reply(204)
+            return
+        if parsed.path == '/api/ingest/bulk':
+            if not ok_token(self.headers):
+                self.close_connection = True
+                self._reply(401); return
+            self._ingest_bulk(parse_qs(parsed.query))
+            return
+        if parsed.path == '/api/bulten/rebuild':
+            if not ok_token(self.headers):
+                self.close_connection = True
+                self._reply(401); return
+            # ?slug=<slug> rebuilds one bulletin, no slug every bulletin
+            slug = (parse_qs(parsed.query).get('slug') or [None])[0]
+            if not self.server.bulten.submit(('rebuild', slug)):
+                self._reply(503); return
+            self._json({'queued': True, 'slug': slug})
+            return
+        self.close_connection = True
+        self._reply(404)
+
+    def _ingest_bulk(self, qs):
+        """Stream an NDJSON (or CSV) body into the ingest writer and reply with line counts.
+
+        Query: format=ndjson|csv (default: csv for Content-Type text/csv). The body may
+        be sent with Content-Encoding gzip/deflate, start with the gzip magic, or use
+        chunked transfer coding. Replies once every written chunk is committed.
+        """
+        ctype = (self.headers.get('Content-Type') or '').split(';')[0].strip().lower()
+        fmt = (qs.get('format') or ['csv' if ctype == 'text/csv' else 'ndjson'])[0].lower()
+        coding = (self.headers.get('Content-Encoding') or 'identity').strip().lower()
+        if fmt not in ('ndjson', 'csv') or coding not in ('identity', 'gzip', 'x-gzip', 'deflate'):
+            self.close_connection = True
+            self._reply(415 if fmt in ('ndjson', 'csv') else 400); return
+        load = BulkLoad(self.server.ingest)
+        code, error = 200, None
+        try:
+            load.run(bulk_records(request_blocks(self.rfile, self.headers), fmt, coding != 'identity'), fmt == 'csv')
+        except queue.Full as e:
+            code, error = 503, str(e)
+        except (ValueError, zlib.error, OSError) as e:
+            code, error = 400, f'{type(e).__name__}: {e}'
+        if error is not None:
+            # the rest of the body is unread
+            self.close_connection = True
+        report = load.report()
+        if report['invalid']:
+            self.server.metrics.inc('analytics_events_invalid_total', n=report['invalid'])
+        if error is not None:
+            report['error'] = error
+        self._reply(code, json.dumps(report).encode('utf-8'), 'application/json; charset=utf-8',
+                    headers={'Retry-After': '5'} if code == 503 else None)
+
+
+# ---- asyncio engine -------------------------------------------------------------
+# `--engine asyncio`: connections are parsed on one event loop, so idle keep-alive
+# visitors cost a socket and a coroutine instead of a thread. Each request is then run
+# through the same Handler methods on a small thread pool, where SQLite calls may block.
+KEEPALIVE_SEC = int(os.environ.get("ANALYTICS_KEEPALIVE_SEC", "75"))
+MAX_BODY = 1 << 20        # /api/collect bodies are a few KB
+MAX_HEADERS = 100
+WRITE_TIMEOUT = 60        # a client that reads nothing for this long is dropped
+
+
+class LoopWriter:
+    """`wfile` for Handler code: hands each write to the event loop's StreamWriter.
+
+    From a pool thread the write waits for the transport to drain, so a slow client
+    throttles a streaming export instead of piling it up in memory. On the loop thread
+    itself (parse errors, 100-continue) the bytes are only buffered.
+    """
+
+    def __init__(self, loop, writer):
+        self.loop = loop
+        self.writer = writer
+        self.loop_thread = threading.get_ident()
+
+    async def _send(self, data):
+        self.writer.write(data)
+        await self.writer.drain()
+
+    def write(self, data):
+        if not data:
+            return 0
+        if threading.get_ident() == self.loop_thread:
+            self.writer.write(bytes(data))
+        else:
+            fut = asyncio.run_coroutine_threadsafe(self._send(bytes(data)), self.loop)
+            try:
+                fut.result(WRITE_TIMEOUT)
+            except TimeoutError:
+                fut.cancel()
+                raise ConnectionResetError('client stopped reading')
+        return len(data)
+
+    def flush(self):
+        pass
+
+
+class LoopReader:
+    """`rfile` for a streamed request body: reads from the event loop's StreamReader.
+
+    Used for /api/ingest/bulk, whose body is parsed while it arrives instead of being
+    read into memory first.
+    """
+
+    def __init__(self, loop, reader, timeout):
+        self.loop = loop
+        self.reader = reader
+        self.timeout = timeout
+
+    def _call(self, coro):
+        fut = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        try:
+            return fut.result(self.timeout)
+        except TimeoutError:
+            fut.cancel()
+            raise ConnectionResetError('client stopped sending')
+
+    def read(self, n=-1):
+        return self._call(self.reader.read(n))
+
+    def readline(self, limit=-1):
+        return self._call(self.reader.readline())
+
+
+class AsyncHTTPServer:
+    """asyncio counterpart of ThreadingHTTPServer for Handler (HTTP/1.1 keep-alive).
+
+    Requests on one connection are read and answered strictly in order, which is what
+    pipelining clients expect; the next request is parsed only after the previous
+    response was written. Same interface as the threaded server as used by main():
+    attributes db/ingest/cache/metrics/live, serve_forever() and server_close().
+    """
+
+    def __init__(self, address, handler_class, workers=READER_POOL, keepalive=KEEPALIVE_SEC):
+        self.server_address = address
+        self.handler_class = handler_class
+        self.keepalive = keepalive
+        self.executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix='sqlite')
+
+    def serve_forever(self):
+        asyncio.run(self._serve())
+
+    def server_close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    async def _serve(self):
+        host, port = self.server_address
+        server = await asyncio.start_server(self._connection, host, port, backlog=1024)
+        async with server:
+            await server.serve_forever()
+
+    def _run(self, handler):
+        try:
+            method = getattr(handler, 'do_' + handler.command, None)
+            if method is None:
+                handler.close_connection = True
+                handler.send_error(501, f"Unsupported method ({handler.command!r})")
+            else:
+                method()
+            handler.wfile.flush()
+        finally:
+            handler._finish_request()
+
+    async def _stream_live(self, handler, writer):
+        loop = asyncio.get_running_loop()
+        q = asyncio.Queue()
+        def push(data):
+            if q.qsize() >= LIVE_BACKLOG:
+                return False
+            try:
+                loop.call_soon_threadsafe(q.put_nowait, data)
+            except RuntimeError:   # loop already closed
+                return False
+            return True
+        try:
+            if not handler._start_stream():
+                return
+            self.live.subscribe(push)
+            while True:
+                await writer.drain()
+                data = await asyncio.wait_for(q.get(), self.live.heartbeat * 2)
+                if data is None:
+                    break
+                writer.write(data)
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            self.live.unsubscribe(push)
+            handler._finish_request()
+
+    async def _read_request(self, reader):
+        """(request line, header bytes) of the next request; None at EOF or idle timeout."""
+        while True:
+            line = await asyncio.wait_for(reader.readline(), self.keepalive)
+            if not line:
+                return None
+            if line not in (b'\r\n', b'\n'):   # stray CRLF between pipelined requests
+                break
+        head = []
+        while True:
+            h = await asyncio.wait_for(reader.readline(), self.keepalive)
+            head.append(h)
+            if h in (b'\r\n', b'\n', b''):
+                return line, b''.join(head)
+            if len(head) > MAX_HEADERS:
+                raise ValueError('too many headers')
+
+    async def _connection(self, reader, writer):
+        loop = asyncio.get_running_loop()
+        peer = writer.get_extra_info('peername') or ('', 0)
+        wfile = LoopWriter(loop, writer)
+        self.metrics.inc('analytics_open_connections')
+        try:
+            while True:
+                try:
+                    req = await self._read_request(reader)
+                except (asyncio.TimeoutError, ValueError, ConnectionError):
+                    break
+                if req is None:
+                    break
+                handler = self.handler_class.__new__(self.handler_class)
+                handler.server = self
+                handler.client_address = peer[:2]
+                handler.request = handler.connection = None
+                handler.wfile = wfile
+                handler.rfile = io.BytesIO(req[1])
+                handler.raw_requestline = req[0]
+                handler.close_connection = True
+                if not handler.parse_request():       # error reply already buffered
+                    handler._finish_request()
+                    break
+                route = urlparse(handler.path).path
+                if handler.command == 'POST' and route == '/api/ingest/bulk':
+                    # any size: the handler pulls the body from the loop as it parses
+                    handler.rfile = LoopReader(loop, reader, self.keepalive)
+                else:
+                    try:
+                        length = int(handler.headers.get('Content-Length') or 0)
+                    except ValueError:
+                        length = -1
+                    if handler.headers.get('Transfer-Encoding') or not 0 <= length <= MAX_BODY:
+                        handler.close_connection = True
+                        handler.send_error(413 if length > MAX_BODY else 400)
+                        handler._finish_request()
+                        break
+                    try:
+                        body = await asyncio.wait_for(reader.readexactly(length), self.keepalive) if length else b''
+                    except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+                        break
+                    handler.rfile = io.BytesIO(body)
+                if handler.command == 'GET' and route == '/api/stream':
+                    # long-lived: served on the loop instead of holding a pool thread
+                    await self._stream_live(handler, writer)
+                    break
+                try:
+                    await loop.run_in_executor(self.executor, self._run, handler)
+                    await writer.drain()
+                except Exception as e:
+                    if not isinstance(e, ConnectionError):
+                        print(f'[asyncio] {handler.requestline!r} failed: {e!r}', file=sys.stderr)
+                    break
+                if handler.close_connection:
+                    break
+        except asyncio.CancelledError:
+            pass   # server shutting down with this connection still open
+        finally:
+            self.metrics.inc('analytics_open_connections', n=-1)
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except (ConnectionError, asyncio.CancelledError):
+                pass
+
+
+def main():
+    import argparse
+    p = argparse.ArgumentParser()
+    p.add_argument('--host', default='127.0.0.1')
+    p.add_argument('--port', type=int, default=8787)
+    p.add_argument('--db', default=DB_PATH)
+    p.add_argument('--queue-size', type=int, default=QUEUE_SIZE, help='max queued /api/collect requests')
+    p.add_argument('--batch-size', type=int, default=BATCH_SIZE, help='max events per write transaction')
+    p.add_argument('--batch-delay-ms', type=int, default=BATCH_DELAY_MS, help='max wait to fill a batch')
+    p.add_argument('--readers', type=int, default=READER_POOL, help='pooled read-only connections kept open')
+    p.add_argument('--result-cache', type=int, default=RESULT_CACHE, help='cached stats/export bodies (0 = off)')
+    p.add_argument('--result-ttl', type=int, default=RESULT_TTL, help='max age of an open-window cached body in seconds')
+    p.add_argument('--rebuild-rollups', action='store_true', help='recompute rollup tables from raw events and exit')
+    p.add_argument('--retention-months', type=int, default=RETENTION_MONTHS, help='raw event months to keep (0 = forever)')
+    p.add_argument('--retention-mode', choices=('archive', 'drop'), default=RETENTION_MODE, help='what to do with expired months')
+    p.add_argument('--maintenance-interval', type=int, default=MAINTENANCE_SEC, help='seconds between maintenance passes (0 = off)')
+    p.add_argument('--maintenance', action='store_true', help='run one compaction/retention/checkpoint pass and exit')
+    p.add_argument('--load', nargs='+', metavar='FILE',
+                   help='load /api/export/events CSV or NDJSON files (gzip ok, - = stdin) into --db and exit')
+    p.add_argument('--format', choices=('auto', 'csv', 'ndjson'), default='auto',
+                   help='--load input format (auto: csv for *.csv[.gz], else ndjson)')
+    p.add_argument('--engine', choices=('threads', 'asyncio'), default='threads',
+                   help='threads: one thread per connection; asyncio: event loop + keep-alive + SQLite pool')
+    p.add_argument('--workers', type=int, default=READER_POOL, help='asyncio engine: threads running request handlers')
+    p.add_argument('--keepalive', type=int, default=KEEPALIVE_SEC, help='asyncio engine: idle seconds before closing a connection')
+    p.add_argument('--snapshot-interval', type=int, default=SNAPSHOT_SEC,
+                   help='seconds between read snapshots that dashboard/export/report queries use (0 = read the primary)')
+    p.add_argument('--bulten-interval', type=int, default=BULTEN_SEC,
+                   help='seconds between site/bulten_doc scans in the watcher process (0 = no watcher)')
+    p.add_argument('--bulten-debounce', type=float, default=BULTEN_DEBOUNCE,
+                   help='seconds a changed bulletin document must stay unchanged before it is built')
+    args = p.parse_args()
+    if args.rebuild_rollups:
+        n = Database(args.db).rebuild_rollups()
+        print(f"Rebuilt rollups from {n} events  db={args.db}")
+        return
+    if args.maintenance:
+        db = Database(args.db)
+        conn = db.writer()
+        try:
+            report = db.maintain(conn, retention_months=args.retention_months, retention_mode=args.retention_mode)
+        finally:
+            conn.close()
+        print(json.dumps(report))
+        return
+    if args.load:
+        # same path as /api/ingest/bulk, with the writer thread to ourselves
+        ingest = IngestQueue(Database(args.db, 1), maintenance_interval=0)
+        ingest.start()
+        reports, status = {}, 0
+        try:
+            for path in args.load:
+                fmt = args.format
+                if fmt == 'auto':
+                    fmt = 'csv' if path.lower().endswith(('.csv', '.csv.gz')) else 'ndjson'
+                load = BulkLoad(ingest)
+                try:
+                    with (open(sys.stdin.fileno(), 'rb', closefd=False) if path == '-' else open(path, 'rb')) as f:
+                        load.run(bulk_records(iter(lambda: f.read(1 << 20), b''), fmt), fmt == 'csv')
+                    reports[path] = load.report()
+                except (ValueError, zlib.error, OSError, queue.Full) as e:
+                    reports[path] = dict(load.report(), error=f'{type(e).__name__}: {e}')
+                    status = 1
+                r = reports[path]
+                if r['invalid'] or r['failed'] or r['pending']:
+                    # the report says which lines; a script must still see that the load was partial
+                    status = 1
+        finally:
+            ingest.close(timeout=None)
+        print(json.dumps(reports, ensure_ascii=False))
+        sys.exit(status)
+    if args.engine == 'asyncio':
+        httpd = AsyncHTTPServer((args.host, args.port), Handler, args.workers, args.keepalive)
+    else:
+        httpd = ThreadingHTTPServer((args.host, args.port), Handler)
+    httpd.db = Database(args.db, args.readers)
+    httpd.metrics = Metrics()
+    httpd.ingest = IngestQueue(httpd.db, args.queue_size, args.batch_size, args.batch_delay_ms / 1000.0,
+                               args.maintenance_interval, args.retention_months, args.retention_mode,
+                               metrics=httpd.metrics)
+    httpd.cache = ResultCache(args.result_cache, args.result_ttl)
+    httpd.live = httpd.ingest.live = LiveFeed(httpd.ingest)
+    httpd.snapshot = None
+    if args.snapshot_interval > 0:
+        httpd.snapshot = SnapshotReplica(httpd.db, args.snapshot_interval, args.readers, httpd.ingest)
+        httpd.snapshot.start()
+    httpd.bulten = BultenWatcher(args.bulten_interval, args.bulten_debounce, metrics=httpd.metrics)
+    httpd.ingest.start()
+    httpd.live.start()
+    print(f"Analytics server running on http://{args.host}:{args.port}  db={args.db}  engine={args.engine}")
+    # site/bulten_doc -> bulletins, in its own process so rebuilds do not slow requests
+    httpd.bulten.start()
+    # docker stop sends SIGTERM: treat it like Ctrl+C so queued events get flushed
+    def on_term(signum, frame):
+        raise KeyboardInterrupt
+    signal.signal(signal.SIGTERM, on_term)
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.live.close()
+        httpd.bulten.close()
+        if httpd.snapshot is not None:
+            httpd.snapshot.close()
+        httpd.server_close()
+        print(f"Flushing {httpd.ingest.snapshot()['queue_depth']} queued events...")
+        httpd.ingest.close()
+        httpd.db.close()
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""
+Content-addressed store for images that pages embed as data: URIs.
+
+Exported posts and bulletins carry their images inline (data:image/...;base64,...), which
+makes every page megabytes large and keeps browsers from caching an image that several
+pages share (the author photo is in every post). The builders replace each data URI with a
+file under site/assets/img/inline/ named by the SHA-256 of its bytes, so an image is stored
+once whichever pages embed it and keeps its name from build to build.
+
+gc() deletes stored files that no page under site/ refers to any more. It reads the pages
+themselves rather than a build manifest, so blog and bulletin builds share one store and
+either can clean it; a file written or reused in the last GC_GRACE seconds is kept, in case
+the page referring to it is still being written by another build.
+
+    html = replace_data_uris(html)          # in a page under site/<dir>/
+    cover = replace_data_uris(src, '')      # a site-root-relative URL
+    removed = gc()
+"""
+import os
+import re
+import time
+import base64
+import hashlib
+import pathlib
+
+ROOT = pathlib.Path(__file__).resolve().parents[1]
+SITE_DIR = ROOT / 'site'
+STORE_URL = 'assets/img/inline'
+STORE_DIR = SITE_DIR / STORE_URL
+GC_GRACE = 600      # seconds
+
+DATA_URI_RE = re.compile(r'data:image/(png|jpe?g|gif|webp|svg\+xml);base64,([A-Za-z0-9+/]+=*)', re.IGNORECASE)
+EXT_NAMES = {'jpeg': 'jpg', 'svg+xml': 'svg'}
+REF_RE = re.compile(re.escape(STORE_URL) + r'/([0-9a-f]{64}\.[a-z]+)')
+# where references can be: pages, search indexes, feeds, stylesheets (not images, vendor code or raw exports)
+SCAN_EXTS = ('.html', '.json', '.xml', '.css', '.js')
+SCAN_SKIP = ('vendor', 'bulten_doc', os.path.join('assets', 'img'))
+
+
+def put(raw: bytes, ext: str) -> str:
+    """Store `raw` (if it is not stored yet) and return its file name."""
+    name = f'{hashlib.sha256(raw).hexdigest()}.{ext}'
+    path = STORE_DIR / name
+    try:
+        os.utime(path)      # in use again: a concurrent gc() must not take it
+        return name
+    except FileNotFoundError:
+        pass
+    STORE_DIR.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f'.{name}.{os.getpid()}.tmp')
+    tmp.write_bytes(raw)
+    os.replace(tmp, path)
+    return name
+
+
+def replace_data_uris(text: str, prefix: str = '../') -> str:
+    """`text` with every base64 image data URI replaced by the URL of its stored copy.
+
+    `prefix` leads from the page to site/ ('../' for site/blog and site/bultenler pages).
+    URIs that do not decode are left as they are.
+    """
+    if 'data:' not in text:
+        return text
+
+    def repl(m):
+        try:
+            raw = base64.b64decode(m.group(2) + '===')
+        except ValueError:
+            return m.group(0)
+        ext = m.group(1).lower()
+        return f'{prefix}{STORE_URL}/{put(raw, EXT_NAMES.get(ext, ext))}'
+    return DATA_URI_RE.sub(repl, text)
+
+
+def referenced(site_dir: pathlib.Path = SITE_DIR) -> set:
+    """Names of stored files that something under `site_dir` refers to."""
+    skip = {os.path.join(site_dir, d) for d in SCAN_SKIP}
+    names = set()
+    for dirpath, dirnames, files in os.walk(site_dir):
+        dirnames[:] = [d for d in dirnames if os.path.join(dirpath, d) not in skip]
+        for fn in files:
+            if fn.endswith(SCAN_EXTS):
+                try:
+                    with open(os.path.join(dirpath, fn), encoding='utf-8', errors='ignore') as f:
+                        names.update(REF_RE.findall(f.read()))
+                except OSError:
+                    pass
+    return names
+
+
+def gc(grace: float = GC_GRACE) -> int:
+    """Delete stored files nothing refers to; returns how many were removed."""
+    if not STORE_DIR.exists():
+        return 0
+    keep = referenced()
+    cutoff = time.time() - grace
+    removed = 0
+    for p in STORE_DIR.iterdir():
+        if p.name in keep or not p.is_file():
+            continue
+        try:
+            if p.stat().st_mtime < cutoff:
+                p.unlink()
+                removed += 1
+        except FileNotFoundError:
+            pass
+    return removed
@@ -0,0 +1,439 @@
+#!/usr/bin/env python3
+"""
+Load-generation and latency benchmark for the analytics server.
+
+Starts analytics_server.py against a temporary database, seeds it through
+/api/ingest/bulk with a synthetic event mix shaped like what analytics.js sends
+(views, clicks, searches, appointment*, email_send), then replays requests at fixed
+concurrency and records latency percentiles for each phase:
+
+  collect/single   POST /api/collect with one event per request
+  collect/batch    POST /api/collect with {"batch": [...]} of 2-20 events
+  dashboard        GET  /api/stats/dashboard
+
+Phases run once per database size (seeded cumulatively, e.g. 10k -> 1m -> 10m) and
+per concurrency level. Each worker thread keeps one keep-alive connection and sends
+its next request as soon as the previous answer arrived (closed loop). The client
+runs on the same machine and in one Python process, so very high concurrency
+measures the client as much as the server.
+
+The server runs with --result-cache 0 by default so dashboard latency reflects the
+queries rather than cache hits (--with-cache to keep it).
+
+Usage:
+  python3 scripts/bench_analytics.py                                   # 10k, 1m, 10m rows
+  python3 scripts/bench_analytics.py --sizes 10k,100k --concurrency 1,16 --duration 5 -o new.json
+  python3 scripts/bench_analytics.py --engine asyncio --compare old.json -o new.json
+
+The JSON report (stdout, or -o FILE) has stable ordering so two runs diff cleanly;
+--compare prints p50/p95/p99 ratios against an earlier report.
+"""
+import os
+import sys
+import argparse
+import http.client
+import json
+import math
+import platform
+import random
+import shutil
+import socket
+import sqlite3
+import subprocess
+import tempfile
+import threading
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+SERVER = os.path.join(HERE, 'analytics_server.py')
+
+# share of events per kind, roughly what the site produces
+EVENT_MIX = (('view', 70), ('click', 20), ('search', 6), ('appointment', 1), ('appointment_gcal', 1),
+             ('appointment_api', 1), ('email_send', 1))
+SEARCH_TERMS = ('sql', 'veri bilimi', 'python', 'makine öğrenmesi', 'staj', 'veri mühendisi', 'pandas',
+                'büyük veri', 'yapay zeka', 'dataizm', 'etl', 'dashboard')
+CLICK_LABELS = (('Abone ol', 'button', None), ('YouTube', 'a', 'https://www.youtube.com/@verininmutfagi'),
+                ('Blog', 'a', '/blog/'), ('Ana Sayfa', 'a', '/'), ('İletişim', 'a', '/contact/'),
+                ('sb-menu-btn', 'button', None), ('Bülten', 'a', '/bultenler/'))
+REFERRERS = ('', '', '', 'https://www.google.com/', 'https://www.linkedin.com/', 'https://t.co/')
+BATCH_MAX = 20     # analytics.js flushes at most 20 queued events per request
+SEED_CHUNK = 1 << 20
+PHASES = ('collect/single', 'collect/batch', 'dashboard')
+
+
+def parse_size(text):
+    text = text.strip().lower()
+    mult = {'k': 1000, 'm': 1000000}.get(text[-1:], 1)
+    return int(float(text.rstrip('km')) * mult)
+
+
+def site_pages():
+    pages = ['/', '/blog/', '/contact/', '/youtube/', '/search/', '/bultenler/']
+    blog = os.path.join(ROOT, 'site', 'blog')
+    if os.path.isdir(blog):
+        pages += sorted('/blog/' + f for f in os.listdir(blog) if f.endswith('.html') and f != 'index.html')
+    return pages
+
+
+class EventMix:
+    """Synthetic analytics.js events; the same seed gives the same stream."""
+
+    def __init__(self, seed=1, visitors=5000):
+        self.rng = random.Random(seed)
+        self.pages = site_pages()
+        # a few posts get most of the traffic
+        self.page_weights = [1.0 / (i + 1) for i in range(len(self.pages))]
+        self.kinds = [k for k, _ in EVENT_MIX]
+        self.kind_weights = [w for _, w in EVENT_MIX]
+        self.visitors = max(1, visitors)
+
+    def event(self, ts):
+        rng = self.rng
+        kind = rng.choices(self.kinds, self.kind_weights)[0]
+        visitor = rng.randrange(self.visitors)
+        ev = {'event': kind, 'ts': ts, 'cid': f'v{visitor:x}', 'sid': f's{visitor:x}.{ts // 1800:x}',
+              'ref': rng.choice(REFERRERS), 'page': rng.choices(self.pages, self.page_weights)[0]}
+        if kind == 'click':
+            label, tag, href = rng.choice(CLICK_LABELS)
+            ev['element'] = label
+            ev['props'] = {'tag': tag}
+            if href:
+                ev['props']['href'] = href if href.startswith('http') else 'https://verininmutfagi.com' + href
+        elif kind == 'search':
+            ev['value'] = rng.choice(SEARCH_TERMS)
+        elif kind.startswith('appointment') or kind == 'email_send':
+            day = time.strftime('%Y-%m-%d', time.gmtime(ts + rng.randrange(1, 14) * 86400))
+            start = f'{day}T{rng.randrange(9, 18):02d}:00:00.000Z'
+            ev['value'] = ''
+            props = {'source': 'contact-form', 'email': f'user{visitor}@example.com'}
+            if kind == 'email_send':
+                props.update(subject='Merhaba', length=rng.randrange(20, 800))
+            else:
+                props.update(start=start, end=start.replace(':00:00.000Z', ':30:00.000Z'))
+                if kind == 'appointment_api':
+                    props['ok'] = rng.random() > 0.05
+            ev['props'] = props
+        return ev
+
+    def seed_blocks(self, n, now, span):
+        """NDJSON blocks of `n` events spread over the `span` seconds before `now`."""
+        buf, size = [], 0
+        for _ in range(n):
+            line = json.dumps(self.event(now - self.rng.randrange(span)), ensure_ascii=False).encode('utf-8') + b'\n'
+            buf.append(line)
+            size += len(line)
+            if size >= SEED_CHUNK:
+                yield b''.join(buf)
+                buf, size = [], 0
+        if buf:
+            yield b''.join(buf)
+
+    def bodies(self, kind, count):
+        """Pre-encoded request bodies, so encoding is not part of the measured time."""
+        now = int(time.time())
+        out = []
+        for _ in range(count):
+            if kind == 'collect/single':
+                events = [self.event(now)]
+                out.append((json.dumps(events[0], ensure_ascii=False).encode('utf-8'), 1))
+            else:
+                events = [self.event(now) for _ in range(self.rng.randint(2, BATCH_MAX))]
+                out.append((json.dumps({'batch': events}, ensure_ascii=False).encode('utf-8'), len(events)))
+        return out
+
+
+def free_port():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+class Server:
+    """analytics_server.py subprocess on a free local port."""
+
+    def __init__(self, db, engine, extra, log):
+        self.port = free_port()
+        # ANALYTICS_* from the caller's shell would change what is measured
+        env = {k: v for k, v in os.environ.items() if not k.startswith('ANALYTICS_')}
+        cmd = [sys.executable, SERVER, '--db', db, '--port', str(self.port), '--engine', engine,
+               '--maintenance-interval', '0', '--bulten-interval', '0'] + extra
+        self.proc = subprocess.Popen(cmd, env=env, stdout=log, stderr=subprocess.STDOUT)
+        deadline = time.monotonic() + 60
+        while True:
+            try:
+                self.get('/api/stats/ingest')
+                return
+            except OSError:
+                if self.proc.poll() is not None or time.monotonic() > deadline:
+                    raise SystemExit(f'server did not start (see {log.name})')
+                time.sleep(0.1)
+
+    def connect(self, timeout=300):
+        return http.client.HTTPConnection('127.0.0.1', self.port, timeout=timeout)
+
+    def get(self, path):
+        c = self.connect(10)
+        try:
+            c.request('GET', path)
+            r = c.getresponse()
+            return r.status, r.read()
+        finally:
+            c.close()
+
+    def bulk(self, blocks):
+        c = self.connect(None)
+        try:
+            c.request('POST', '/api/ingest/bulk', body=blocks, encode_chunked=True,
+                      headers={'Content-Type': 'application/x-ndjson'})
+            r = c.getresponse()
+            return r.status, json.loads(r.read())
+        finally:
+            c.close()
+
+    def drain(self, timeout=600):
+        """Wait until the ingest queue is empty."""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            status, body = self.get('/api/stats/ingest')
+            if status == 200 and json.loads(body)['queue_depth'] == 0:
+                return
+            time.sleep(0.1)
+
+    def rss(self):
+        try:
+            with open(f'/proc/{self.proc.pid}/status') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        return int(line.split()[1]) * 1024
+        except OSError:
+            pass
+        return None
+
+    def stop(self):
+        self.proc.terminate()
+        try:
+            self.proc.wait(60)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+            self.proc.wait()
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    # nearest rank
+    rank = math.ceil(q / 100.0 * len(sorted_values))
+    return sorted_values[min(len(sorted_values), max(1, rank)) - 1]
+
+
+def run_phase(server, phase, concurrency, duration, warmup, mix):
+    """Closed-loop load from `concurrency` threads; returns the phase result dict."""
+    if phase == 'dashboard':
+        requests = [(None, 0)]
+    else:
+        requests = mix.bodies(phase, 4000)
+    stop_at = [0.0]
+    lat, status, events = [], {}, [0]
+    lock = threading.Lock()
+    start = threading.Barrier(concurrency + 1)
+
+    def worker(offset):
+        conn = server.connect()
+        mine, codes, sent = [], {}, 0
+        i = offset
+        start.wait()
+        measure_from = time.monotonic() + warmup
+        while True:
+            body, n = requests[i % len(requests)]
+            i += 1
+            t0 = time.monotonic()
+            if t0 >= stop_at[0]:
+                break
+            try:
+                if body is None:
+                    conn.request('GET', '/api/stats/dashboard')
+                else:
+                    conn.request('POST', '/api/collect', body=body, headers={'Content-Type': 'application/json'})
+                r = conn.getresponse()
+                r.read()
+                code = str(r.status)
+                if r.will_close:
+                    conn.close()
+            except (OSError, http.client.HTTPException) as e:
+                code = type(e).__name__
+                conn.close()
+                conn = server.connect()
+            t1 = time.monotonic()
+            if t0 >= measure_from:
+                mine.append(t1 - t0)
+                codes[code] = codes.get(code, 0) + 1
+                if code == '204':
+                    sent += n
+        conn.close()
+        with lock:
+            lat.extend(mine)
+            for k, v in codes.items():
+                status[k] = status.get(k, 0) + v
+            events[0] += sent
+
+    threads = [threading.Thread(target=worker, args=(k * 97,), daemon=True) for k in range(concurrency)]
+    for t in threads:
+        t.start()
+    stop_at[0] = time.monotonic() + warmup + duration
+    start.wait()
+    t_start = time.monotonic()
+    for t in threads:
+        t.join()
+    elapsed = max(1e-9, time.monotonic() - t_start - warmup)
+    lat.sort()
+    ms = lambda v: None if v is None else round(v * 1000, 3)
+    out = {
+        'phase': phase,
+        'concurrency': concurrency,
+        'requests': len(lat),
+        'seconds': round(elapsed, 3),
+        'rps': round(len(lat) / elapsed, 1),
+        'latency_ms': {
+            'p50': ms(percentile(lat, 50)),
+            'p95': ms(percentile(lat, 95)),
+            'p99': ms(percentile(lat, 99)),
+            'mean': ms(sum(lat) / len(lat)) if lat else None,
+            'max': ms(lat[-1] if lat else None),
+        },
+        'status': dict(sorted(status.items())),
+    }
+    if phase != 'dashboard':
+        out['events'] = events[0]
+        out['events_per_sec'] = round(events[0] / elapsed, 1)
+    return out
+
+
+def db_bytes(db):
+    total = os.path.getsize(db) if os.path.exists(db) else 0
+    for suffix in ('-wal', '-shm'):
+        if os.path.exists(db + suffix):
+            total += os.path.getsize(db + suffix)
+    parts = os.path.splitext(db)[0] + '-events'
+    if os.path.isdir(parts):
+        total += sum(os.path.getsize(os.path.join(parts, f)) for f in os.listdir(parts))
+    return total
+
+
+def git_revision():
+    try:
+        rev = subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=ROOT, capture_output=True, text=True)
+        return rev.stdout.strip() or None
+    except OSError:
+        return None
+
+
+def compare(old, new):
+    """Lines with latency ratios new/old for phases present in both reports."""
+    key = lambda r: (r['rows'], r['phase'], r['concurrency'])
+    before = {key(r): r for r in old.get('results', [])}
+    lines = []
+    for r in new['results']:
+        o = before.get(key(r))
+        if o is None:
+            continue
+        ratios = []
+        for q in ('p50', 'p95', 'p99'):
+            a, b = o['latency_ms'][q], r['latency_ms'][q]
+            ratios.append(f'{q} {b}/{a} ms ({b / a:.2f}x)' if a and b else f'{q} -')
+        rps = f"rps {r['rps']}/{o['rps']}"
+        lines.append(f"{r['rows']:>10} {r['phase']:<15} c={r['concurrency']:<4} " + '  '.join(ratios) + '  ' + rps)
+    return lines
+
+
+def main():
+    ap = argparse.ArgumentParser(description='Benchmark the analytics server')
+    ap.add_argument('--sizes', default='10k,1m,10m', help='database sizes in rows, seeded cumulatively (k/m suffixes)')
+    ap.add_argument('--concurrency', default='1,8,32', help='client threads per phase, comma separated')
+    ap.add_argument('--phases', default=','.join(PHASES), help='subset of ' + ', '.join(PHASES))
+    ap.add_argument('--duration', type=float, default=10.0, help='measured seconds per phase')
+    ap.add_argument('--warmup', type=float, default=1.0, help='unmeasured seconds at the start of each phase')
+    ap.add_argument('--span-days', type=int, default=90, help='seeded events are spread over this many days')
+    ap.add_argument('--engine', choices=('threads', 'asyncio'), default='threads')
+    ap.add_argument('--with-cache', action='store_true', help='keep the server result cache on')
+    ap.add_argument('--server-arg', action='append', default=[], metavar='ARG',
+                    help='extra analytics_server.py argument (repeatable), e.g. --server-arg=--batch-size=2000')
+    ap.add_argument('--seed', type=int, default=1)
+    ap.add_argument('--keep', action='store_true', help='keep the temporary directory (database and server log)')
+    ap.add_argument('--compare', metavar='REPORT', help='earlier JSON report to compare latencies with')
+    ap.add_argument('-o', '--out', help='write the JSON report here instead of stdout')
+    args = ap.parse_args()
+
+    sizes = sorted(parse_size(s) for s in args.sizes.split(','))
+    levels = [int(c) for c in args.concurrency.split(',')]
+    phases = [p.strip() for p in args.phases.split(',')]
+    unknown = set(phases) - set(PHASES)
+    if unknown:
+        ap.error(f'unknown phases: {", ".join(sorted(unknown))}')
+    extra = ([] if args.with_cache else ['--result-cache', '0']) + args.server_arg
+
+    tmp = tempfile.mkdtemp(prefix='analytics-bench-')
+    db = os.path.join(tmp, 'bench.db')
+    log = open(os.path.join(tmp, 'server.log'), 'w')
+    mix = EventMix(args.seed, visitors=max(1000, sizes[-1] // 20))
+    report = {
+        'revision': git_revision(),
+        'started': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'config': {'engine': args.engine, 'server_args': extra, 'duration': args.duration,
+                   'warmup': args.warmup, 'span_days': args.span_days, 'seed': args.seed},
+        'sizes': [],
+        'results': [],
+    }
+    server = Server(db, args.engine, extra, log)
+    seeded = 0
+    try:
+        for size in sizes:
+            t0 = time.monotonic()
+            status, seed = server.bulk(mix.seed_blocks(size - seeded, int(time.time()), args.span_days * 86400))
+            if status != 200:
+                raise SystemExit(f'seeding failed: {status} {seed}')
+            seeded = size
+            seed_sec = time.monotonic() - t0
+            print(f'[bench] {size} rows seeded in {seed_sec:.1f}s', file=sys.stderr)
+            for phase in phases:
+                for c in levels:
+                    r = run_phase(server, phase, c, args.duration, args.warmup, mix)
+                    server.drain()
+                    r = dict(rows=size, **r)
+                    report['results'].append(r)
+                    lm = r['latency_ms']
+                    print(f"[bench] {size:>10} {phase:<15} c={c:<4} {r['rps']:>9} req/s  "
+                          f"p50 {lm['p50']} p95 {lm['p95']} p99 {lm['p99']} ms  {r['status']}", file=sys.stderr)
+            report['sizes'].append({'rows': size, 'seed_seconds': round(seed_sec, 2),
+                                    'seed_rows_per_sec': round((seed['written'] or 0) / max(seed_sec, 1e-9), 1),
+                                    'db_bytes': db_bytes(db), 'server_rss_bytes': server.rss()})
+    finally:
+        server.stop()
+        log.close()
+        if args.keep:
+            print(f'[bench] kept {tmp}', file=sys.stderr)
+        else:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    text = json.dumps(report, indent=1, sort_keys=True, ensure_ascii=False) + '\n'
+    if args.out:
+        with open(args.out, 'w') as f:
+            f.write(text)
+    else:
+        sys.stdout.write(text)
+    if args.compare:
+        with open(args.compare) as f:
+            old = json.load(f)
+        print(f"[bench] new {report['revision']} vs old {old.get('revision')}", file=sys.stderr)
+        for line in compare(old, report):
+            print(line, file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,12 @@
 #!/usr/bin/env python3
+import io
 import os
 import re
+import json
+import hashlib
 import pathlib
+import html_stream
+import asset_store
 from html import unescape
 from datetime import datetime
 
@@ -13,8 +18,19 @@ TEMPLATE_DIR = SITE_DIR / "templates"
 INDEX_TEMPLATE = (TEMPLATE_DIR / "blog_index.html").read_text(encoding="utf-8")
 HOME_TEMPLATE = (TEMPLATE_DIR / "home.html").read_text(encoding="utf-8")
 BLOG_DIR = SITE_DIR / "blog"
+# Kaynak yazılar (derleme buraya asla yazmaz) ve yayınlanmış adresi başlıktan farklı olanların slug'ları
+SOURCE_DIR = ROOT / "content"
+SLUGS_PATH = SOURCE_DIR / "slugs.json"
 SITE_BASE_URL = os.environ.get("SITE_BASE_URL", "").strip().rstrip('/')
 
+# Artımlı derleme: yazı başına kaynak/şablon/dönüşüm özeti + ara adım önbelleği
+BUILD_DIR = ROOT / "data" / "build"
+MANIFEST_PATH = BUILD_DIR / "blog-manifest.json"
+CACHE_DIR = BUILD_DIR / "cache"
+CACHE_MAX_BYTES = int(os.environ.get("BLOG_CACHE_MB", "256")) * 1024 * 1024
+# build_post çıktısını bu dosyanın dışından değiştiren bir şey olursa (ör. Pillow ayarları) artırın
+TRANSFORM_VERSION = 1
+
 def turkish_to_ascii(s: str) -> str:
     table = str.maketrans({
         "ç":"c","Ç":"c","ğ":"g","Ğ":"g","ı":"i","İ":"i","ö":"o","Ö":"o","ş":"s","Ş":"s","ü":"u","Ü":"u",
@@ -43,154 +59,588 @@ def extract_body(html: str) -> str:
     # Eski: gövde çıkarımı. Artık gerek yok, postları aynen kopyalayacağız.
     return html
 
-def extract_cover(html: str, base_dir: pathlib.Path, slug: str) -> str:
-    # Helper: save data URI to file if too large
-    def save_data_uri(data_uri: str) -> str:
+def cache_key(*parts) -> str:
+    h = hashlib.sha256()
+    for part in parts:
+        h.update(part if isinstance(part, bytes) else str(part).encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+def pil_version() -> str:
+    try:
+        import PIL
+        return PIL.__version__
+    except Exception:
+        return ""
+
+class BuildCache:
+    """On-disk memo for expensive build sub-steps (cover extraction, image resizing).
+
+    Entries are files named by the hash of their inputs. A hit refreshes the entry's
+    mtime; prune() drops the least recently used entries once the total size passes
+    max_bytes. Writes go through a temp file, so concurrent builds never see a partial entry.
+    """
+
+    def __init__(self, root: pathlib.Path = CACHE_DIR, max_bytes: int = CACHE_MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+    def _path(self, key: str) -> pathlib.Path:
+        return self.root / key[:2] / key
+
+    def get(self, key: str):
+        p = self._path(key)
         try:
-            import base64, re
-            m = re.match(r"data:image/(png|jpeg|jpg|webp);base64,(.*)", data_uri, re.IGNORECASE)
-            if not m:
-                return data_uri
-            ext = m.group(1).lower()
-            b64 = m.group(2)
-            raw = base64.b64decode(b64 + '===')
-            # if large, write to file; else keep inline
-            if len(raw) < 50_000:
-                return data_uri
-            covers_dir = SITE_DIR / "assets" / "img" / "covers"
-            covers_dir.mkdir(parents=True, exist_ok=True)
-            target = covers_dir / f"{slug}.{ 'jpg' if ext=='jpeg' else ext }"
-            target.write_bytes(raw)
-            return f"assets/img/covers/{target.name}"
-        except Exception:
-            return data_uri
-    # Öncelik: .hero-image CSS kuralı
-    m = re.search(r"\.hero-image\s*\{[^}]*background-image\s*:\s*url\(['\"]?([^'\"\)]+)", html, re.IGNORECASE)
-    def optimize_copy(src_path: pathlib.Path, target_path: pathlib.Path) -> bool:
+            data = p.read_bytes()
+        except OSError:
+            self.misses += 1
+            return None
+        try:
+            os.utime(p)
+        except OSError:
+            pass
+        self.hits += 1
+        return data
+
+    def put(self, key: str, data: bytes) -> None:
+        p = self._path(key)
+        try:
+            p.parent.mkdir(parents=True, exist_ok=True)
+            tmp = p.with_name(f"{p.name}.{os.getpid()}.tmp")
+            tmp.write_bytes(data)
+            os.replace(tmp, p)
+        except OSError:
+            pass
+
+    def prune(self) -> int:
+        """Evict least recently used entries down to max_bytes; returns how many were removed."""
+        entries = []
+        total = 0
+        for p in self.root.glob("*/*"):
+            try:
+                st = p.stat()
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, p))
+            total += st.st_size
+        removed = 0
+        for _mtime, size, p in sorted(entries, key=lambda e: e[0]):
+            if total <= self.max_bytes:
+                break
+            try:
+                p.unlink()
+            except OSError:
+                continue
+            total -= size
+            removed += 1
+        return removed
+
+CACHE = BuildCache()
+
+def write_if_changed(path: pathlib.Path, data: bytes) -> None:
+    # keep mtimes of unchanged outputs stable (watchers, rsync, browser caches)
+    try:
+        if path.stat().st_size == len(data) and path.read_bytes() == data:
+            return
+    except OSError:
+        pass
+    # temp + rename: a reader (or another --jobs worker) never sees a half-written file
+    tmp = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    tmp.write_bytes(data)
+    os.replace(tmp, path)
+
+def resize_image(src_path: pathlib.Path, target_path: pathlib.Path, maxw: int = 1280) -> bool:
+    """Copy an image to target_path, scaled down to maxw pixels wide when Pillow is available."""
+    try:
+        raw = src_path.read_bytes()
+    except OSError:
+        return False
+    key = cache_key("resize", raw, target_path.suffix.lower(), maxw, pil_version())
+    data = CACHE.get(key)
+    if data is None:
+        data = raw
         try:
             from PIL import Image
-            im = Image.open(src_path)
+            im = Image.open(io.BytesIO(raw))
             w, h = im.size
-            maxw = 1280
             if w > maxw:
                 nh = int(h * (maxw / float(w)))
                 im = im.resize((maxw, nh), Image.LANCZOS)
-            im.save(target_path)
-            return True
+            fmt = Image.registered_extensions().get(target_path.suffix.lower(), im.format)
+            buf = io.BytesIO()
+            im.save(buf, format=fmt)
+            data = buf.getvalue()
         except Exception:
-            try:
-                target_path.write_bytes(src_path.read_bytes())
-                return True
-            except Exception:
-                return False
+            pass
+        CACHE.put(key, data)
+    try:
+        write_if_changed(target_path, data)
+        return True
+    except OSError:
+        return False
+
+# Kapak adayı: eski öncelik sırası (.hero-image CSS kuralı, hero-image inline style, ilk <img>, herhangi bir background-image)
+HERO_CSS_RE = re.compile(r"\.hero-image\s*\{[^}]*background-image\s*:\s*url\(['\"]?([^'\"\)]+)", re.IGNORECASE)
+HERO_INLINE_RE = re.compile(r"class=\"[^\"]*hero-image[^\"]*\"[^>]*style=\"[^\"]*background-image\s*:\s*url\(['\"]?([^'\"\)]+)", re.IGNORECASE)
+IMG_SRC_RE = re.compile(r"<img[^>]+src=\"([^\"]+)\"", re.IGNORECASE)
+BG_IMAGE_RE = re.compile(r"background-image\s*:\s*url\(['\"]?([^'\"\)]+)", re.IGNORECASE)
+DEFAULT_COVER = "assets/img/covers/default.jpg"
+
+def save_cover(src: str, base_dir: pathlib.Path, slug: str):
+    """Cover URL for one candidate: local images go to assets/img/covers/, data URIs to the
+    inline image store (the same file the page itself now refers to).
 
-    if m:
+    Returns None for a local image that does not exist (the next candidate is tried).
+    """
+    if src.startswith("data:"):
+        return asset_store.replace_data_uris(src, "")
+    img_path = (base_dir / src).resolve() if not os.path.isabs(src) else pathlib.Path(src)
+    if img_path.exists():
+        ext = img_path.suffix.lower() or ".jpg"
+        covers_dir = SITE_DIR / "assets" / "img" / "covers"
+        covers_dir.mkdir(parents=True, exist_ok=True)
+        target = covers_dir / f"{slug}{ext}"
+        if resize_image(img_path, target):
+            return f"assets/img/covers/{slug}{ext}"
+    return None
+
+def resolve_cover(src: str, base_dir: pathlib.Path, slug: str):
+    """save_cover(), memoized on the candidate, directory and slug.
+
+    The key does not cover local image files a candidate points at; after replacing
+    one in place, run with --force.
+    """
+    key = cache_key("cover", TRANSFORM_VERSION, src, base_dir, slug)
+    hit = CACHE.get(key)
+    if hit is not None:
+        cover = hit.decode("utf-8") or None
+        if cover is None or not cover.startswith("assets/") or (SITE_DIR / cover).exists():
+            return cover
+    cover = save_cover(src, base_dir, slug)
+    CACHE.put(key, (cover or "").encode("utf-8"))
+    return cover
+
+class CoverFinder:
+    """Collects cover candidates while a document streams past (see the rule order above)."""
+
+    def __init__(self, base_dir: pathlib.Path, slug: str):
+        self.base_dir = base_dir
+        self.slug = slug
+        self.found = [None, None, None, None]
+        self.cover = None
+
+    def feed(self, tok) -> None:
+        if self.found[0] is not None:
+            return
+        if tok.kind in (html_stream.RAW, html_stream.TEXT):
+            m = HERO_CSS_RE.search(tok.raw)
+            if m:
+                self.found[0] = m.group(1)
+        elif tok.kind == html_stream.START:
+            if self.found[1] is None:
+                m = HERO_INLINE_RE.search(tok.raw)
+                if m:
+                    self.found[1] = m.group(1)
+            if self.found[2] is None and tok.name == "img":
+                m = IMG_SRC_RE.search(tok.raw)
+                if m:
+                    self.found[2] = m.group(1)
+        else:
+            return
+        if self.found[3] is None:
+            m = BG_IMAGE_RE.search(tok.raw)
+            if m:
+                self.found[3] = m.group(1)
+
+    def settled(self) -> bool:
+        """True once the top-priority rule matched and resolved, so later tokens cannot change it."""
+        if self.cover is None and self.found[0] is not None:
+            self.cover = resolve_cover(self.found[0], self.base_dir, self.slug)
+        return self.cover is not None
+
+    def result(self) -> str:
+        if self.settled():
+            return self.cover
+        for src in self.found[1:]:
+            if src is not None:
+                cover = resolve_cover(src, self.base_dir, self.slug)
+                if cover is not None:
+                    self.cover = cover
+                    return cover
+        self.cover = DEFAULT_COVER
+        return self.cover
+
+def extract_cover(html: str, base_dir: pathlib.Path, slug: str) -> str:
+    """Cover image for a whole document in memory (build_post finds it while streaming)."""
+    finder = CoverFinder(base_dir, slug)
+    for tok in html_stream.Tokenizer().feed(html, final=True):
+        finder.feed(tok)
+    return finder.result()
+
+# Derlemenin eklediği her blok <!-- vm:ad --> ... <!-- /vm:ad --> ile işaretlenir; aynı belge
+# yeniden derlenirse eski blok atlanır ve yenisi aynı yere yazılır, sona eklenmez.
+BLOCK_OPEN_RE = re.compile(r"<!-- vm:([\w-]+) -->")
+
+def marked(name: str, body: str) -> str:
+    return f"\n  <!-- vm:{name} -->{body}<!-- /vm:{name} -->"
+
+# Eski yerinde derlemelerin işaretsiz eklentileri (clean_built_posts temizler)
+LEGACY_INJECTIONS = [re.compile(r"\s*" + pat, re.IGNORECASE) for pat in (
+    r"<style>\.sb-preloader,\.sb-click-effect,\.sb-load\{display:none!important\}</style>",
+    r"<meta\s+(?:name=\"(?:description|twitter:[^\"]+)\"|property=\"og:[^\"]+\")[^>]*>",
+    r"<link rel=\"canonical\"[^>]*>",
+    r"<script type=\\?\"application/ld\+json\\?\">[\s\S]*?</script>",
+    r"<link rel=\"(?:icon|apple-touch-icon|stylesheet)\"[^>]*href=\"\.\./(?:favicon[^\"]*|apple-touch-icon\.png"
+    r"|assets/img/logos/[^\"]*|vendor/starbelly/css/[^\"]*|assets/css/site\.css[^\"]*)\"[^>]*>",
+    r"<div class=\"sb-top-bar-frame\">[\s\S]*?<div class=\"sb-info-btn\"><span></span></div>"
+    r"(?:\s*</div>){5}",
+    r"<footer>\s*<div class=\"container\">\s*<div class=\"sb-footer-frame\">[\s\S]*?</footer>",
+)]
+
+def strip_legacy(doc: str) -> str:
+    for pat in LEGACY_INJECTIONS:
+        doc = pat.sub("", doc)
+    return doc
+
+# add vendor + site css if missing for consistent header
+HEAD_LINKS = [
+    ('favicon-ico', '<link rel="icon" type="image/x-icon" href="../favicon.ico">'),
+    ('favicon-32', '<link rel="icon" type="image/png" sizes="32x32" href="../favicon-32x32.png">'),
+    ('favicon-16', '<link rel="icon" type="image/png" sizes="16x16" href="../favicon-16x16.png">'),
+    ('apple-touch', '<link rel="apple-touch-icon" sizes="180x180" href="../apple-touch-icon.png">'),
+    ('font-awesome', '<link rel="stylesheet" href="../vendor/starbelly/css/plugins/font-awesome.min.css">'),
+    ('bootstrap', '<link rel="stylesheet" href="../vendor/starbelly/css/plugins/bootstrap.min.css">'),
+    ('starbelly-style', '<link rel="stylesheet" href="../vendor/starbelly/css/style.css">'),
+    ('site-css', '<link rel="stylesheet" href="../assets/css/site.css?v=4">'),
+]
+# preloader/transition disable
+PRELOADER_STYLE = '<style>.sb-preloader,.sb-click-effect,.sb-load{display:none!important}</style>'
+SITE_CSS_RE = re.compile(r"assets/\s*css/\s*site\.css", re.IGNORECASE)
+
+TOP_BAR = (
+    '\n  <div class="sb-top-bar-frame">\n'
+    '    <div class="sb-top-bar-bg"></div>\n'
+    '    <div class="container">\n'
+    '      <div class="sb-top-bar">\n'
+    '        <a href="../index.html" class="sb-logo-frame">\n'
+    '          <img src="../assets/img/logo.png" alt="Verinin Mutfağı">\n'
+    '        </a>\n'
+    '        <div class="sb-right-side">\n'
+    '          <nav class="sb-menu-transition">\n'
+    '            <ul class="sb-navigation">\n'
+    '              <li><a href="../index.html">Ana Sayfa</a></li>\n'
+    '              <li class="sb-active"><a href="index.html">Blog</a></li>\n'
+    '              <li><a href="../bultenler/index.html">Haftalık Bültenler</a></li>\n'
+    '              <li><a href="../youtube/index.html">YouTube</a></li>\n'
+    '              <li><a href="../contact/index.html">İletişim</a></li>\n'
+    '            </ul>\n'
+    '          </nav>\n'
+    '          <div class="sb-buttons-frame">\n'
+    '            <div class="sb-menu-btn"><span></span></div>\n'
+    '            <div class="sb-info-btn"><span></span></div>\n'
+    '          </div>\n'
+    '        </div>\n'
+    '      </div>\n'
+    '    </div>\n'
+    '  </div>\n'
+)
+
+FOOTER = (
+    '\n  <footer>\n'
+    '    <div class="container">\n'
+    '      <div class="sb-footer-frame">\n'
+    '        <a href="../index.html" class="sb-logo-frame">\n'
+    '          <img src="../assets/img/logo.png" alt="Verinin Mutfağı">\n'
+    '        </a>\n'
+    '        <div class="sb-copy">&copy; <a href="../index.html">Verinin Mutfağı</a></div>\n'
+    '        <nav class="vm-social">\n'
+    '          <a href="https://www.linkedin.com/in/ferhatisyapan/" target="_blank" rel="noopener">LinkedIn</a>\n'
+    '          <a href="https://github.com/ferhatisyapanys/VerininMutfagi" target="_blank" rel="noopener">GitHub</a>\n'
+    '          <a href="https://instagram.com/verininmutfagi" target="_blank" rel="noopener">Instagram</a>\n'
+    '        </nav>\n'
+    '      </div>\n'
+    '    </div>\n'
+    '  </footer>\n'
+)
+
+# Navbar'ı tüm blog yazılarında sabitle: Ana Sayfa, Blog, Haftalık Bültenler, YouTube, İletişim
+NAV_FIXED = (
+    '\n<ul class="sb-navigation">\n'
+    '  <li><a href="../index.html">Ana Sayfa</a></li>\n'
+    '  <li class="sb-active"><a href="index.html">Blog</a></li>\n'
+    '  <li><a href="../bultenler/index.html">Haftalık Bültenler</a></li>\n'
+    '  <li><a href="../youtube/index.html">YouTube</a></li>\n'
+    '  <li><a href="../contact/index.html">İletişim</a></li>\n'
+    '</ul>'
+)
+
+# Optimize inline <img> tags: copy local images into assets/img/posts/<slug>/, data URIs into the shared store, add lazy/decoding attrs
+def rewrite_img_tag(tag: str, slug: str, base_dir: pathlib.Path) -> str:
+    posts_dir = SITE_DIR / 'assets' / 'img' / 'posts' / slug
+    try:
+        m = re.search(r'src=\"([^\"]+)\"', tag, flags=re.IGNORECASE)
+        if not m:
+            return tag
         src = m.group(1)
-        if src.startswith("data:"):
-            return save_data_uri(src)
-        img_path = (base_dir / src).resolve() if not os.path.isabs(src) else pathlib.Path(src)
-        if img_path.exists():
-            ext = img_path.suffix.lower() or ".jpg"
-            covers_dir = SITE_DIR / "assets" / "img" / "covers"
-            covers_dir.mkdir(parents=True, exist_ok=True)
-            target = covers_dir / f"{slug}{ext}"
-            if optimize_copy(img_path, target):
-                return f"assets/img/covers/{slug}{ext}"
-
-    # İkinci: hero-image sınıfına sahip inline style
-    m_inline = re.search(r"class=\"[^\"]*hero-image[^\"]*\"[^>]*style=\"[^\"]*background-image\s*:\s*url\(['\"]?([^'\"\)]+)", html, re.IGNORECASE)
-    if m_inline:
-        src = m_inline.group(1)
-        if src.startswith("data:"):
-            return save_data_uri(src)
-        img_path = (base_dir / src).resolve() if not os.path.isabs(src) else pathlib.Path(src)
-        if img_path.exists():
-            ext = img_path.suffix.lower() or ".jpg"
-            covers_dir = SITE_DIR / "assets" / "img" / "covers"
-            covers_dir.mkdir(parents=True, exist_ok=True)
-            target = covers_dir / f"{slug}{ext}"
-            if optimize_copy(img_path, target):
-                return f"assets/img/covers/{slug}{ext}"
-
-    # Üçüncü: İlk <img>
-    m_img = re.search(r"<img[^>]+src=\"([^\"]+)\"", html, re.IGNORECASE)
-    if m_img:
-        src = m_img.group(1)
-        if src.startswith("data:"):
-            return save_data_uri(src)
-        img_path = (base_dir / src).resolve() if not os.path.isabs(src) else pathlib.Path(src)
-        if img_path.exists():
-            ext = img_path.suffix.lower() or ".jpg"
-            covers_dir = SITE_DIR / "assets" / "img" / "covers"
-            covers_dir.mkdir(parents=True, exist_ok=True)
-            target = covers_dir / f"{slug}{ext}"
-            if optimize_copy(img_path, target):
-                return f"assets/img/covers/{slug}{ext}"
-
-    # Dördüncü: Genel background-image
-    m_bg = re.search(r"background-image\s*:\s*url\(['\"]?([^'\"\)]+)", html, re.IGNORECASE)
-    if m_bg:
-        src = m_bg.group(1)
-        if src.startswith("data:"):
-            return save_data_uri(src)
-        img_path = (base_dir / src).resolve() if not os.path.isabs(src) else pathlib.Path(src)
-        if img_path.exists():
-            ext = img_path.suffix.lower() or ".jpg"
-            covers_dir = SITE_DIR / "assets" / "img" / "covers"
-            covers_dir.mkdir(parents=True, exist_ok=True)
-            target = covers_dir / f"{slug}{ext}"
-            if optimize_copy(img_path, target):
-                return f"assets/img/covers/{slug}{ext}"
-
-    return "assets/img/covers/default.jpg"
-
-def build_post(input_path: pathlib.Path, out_path: pathlib.Path):
-    # Blog yazılarını orijinal formatıyla aynen yayınla
-    html = input_path.read_text(encoding="utf-8", errors="ignore")
-
-    # Ortak head assetleri ve preloader kapatma
-    def ensure_head_assets(doc: str) -> str:
-        # add vendor + site css if missing for consistent header
-        head_links = [
-            ('favicon-ico', '<link rel="icon" type="image/x-icon" href="../favicon.ico">'),
-            ('favicon-32', '<link rel="icon" type="image/png" sizes="32x32" href="../favicon-32x32.png">'),
-            ('favicon-16', '<link rel="icon" type="image/png" sizes="16x16" href="../favicon-16x16.png">'),
-            ('apple-touch', '<link rel="apple-touch-icon" sizes="180x180" href="../apple-touch-icon.png">'),
-            ('font-awesome', '<link rel="stylesheet" href="../vendor/starbelly/css/plugins/font-awesome.min.css">'),
-            ('bootstrap', '<link rel="stylesheet" href="../vendor/starbelly/css/plugins/bootstrap.min.css">'),
-            ('starbelly-style', '<link rel="stylesheet" href="../vendor/starbelly/css/style.css">'),
-            ('site-css', '<link rel="stylesheet" href="../assets/css/site.css?v=4">'),
-        ]
-        # insert before </head>
+        src_l = src.lower()
+        # Skip site UI assets (logo, favicons, vendor)
+        if (
+            'vendor/' in src_l or
+            '/assets/img/logo' in src_l or
+            '/assets/img/logos/' in src_l or
+            'favicon' in src_l or
+            'apple-touch-icon' in src_l or
+            'android-chrome' in src_l
+        ):
+            # Ensure lazy for content only; do not touch UI images
+            return tag
+        # external image: just ensure lazy attrs
+        if src.startswith('http://') or src.startswith('https://'):
+            new = tag
+            if 'loading=' not in new.lower():
+                new = new.replace('<img', '<img loading="lazy"', 1)
+            if 'decoding=' not in new.lower():
+                new = new.replace('<img', '<img decoding="async"', 1)
+            return new
+        # data URI (shared store, named by content) or local path
+        target_path = None
+        if src.startswith('data:image/'):
+            stored = asset_store.replace_data_uris(src, '')
+            if stored != src:
+                target_path = SITE_DIR / stored
+                rel = f"../{stored}"
+        else:
+            ip = (base_dir / src).resolve() if not os.path.isabs(src) else pathlib.Path(src)
+            if ip.exists():
+                posts_dir.mkdir(parents=True, exist_ok=True)
+                target_path = posts_dir / os.path.basename(src)
+                resize_image(ip, target_path)
+                rel = f"../assets/img/posts/{slug}/{target_path.name}"
+        if target_path and target_path.exists():
+            new = re.sub(r'src=\"[^\"]+\"', f'src="{rel}"', tag, flags=re.IGNORECASE)
+            if 'loading=' not in new.lower():
+                new = new.replace('<img', '<img loading="lazy"', 1)
+            if 'decoding=' not in new.lower():
+                new = new.replace('<img', '<img decoding="async"', 1)
+            # add width/height if absent
+            if ('width=' not in new.lower()) or ('height=' not in new.lower()):
+                try:
+                    from PIL import Image
+                    im2 = Image.open(target_path)
+                    wh = f' width="{im2.width}" height="{im2.height}"'
+                    new = new.replace('<img', f'<img{wh}', 1)
+                except Exception:
+                    pass
+            return new
+        return tag
+    except Exception:
+        return tag
+
+class PostRewrite:
+    """Transform handlers for one post, run by html_stream.Rewriter in a single pass.
+
+    Head assets and the meta block go before </head>, the top bar after <body>, the footer
+    before </body>, each as a marked block; blocks from an earlier build are skipped on
+    input. The meta block waits in a slot until 200 characters of description text and the
+    cover are known; the top bar and footer slots are filled at the end because a page's own
+    top bar or footer may come later in the document. Embedded data: URI images are written
+    to the shared asset store (asset_store.py) and referred to by URL.
+    """
+
+    def __init__(self, input_path: pathlib.Path, out_path: pathlib.Path):
+        self.input_path = input_path
+        self.out_path = out_path
+        self.slug = out_path.stem
+        self.cover = CoverFinder(input_path.parent, self.slug)
+        self.title_parts = None     # collecting <title> text
+        self.title = None
+        self.desc = ''              # page text with collapsed whitespace, for the description
+        self.hrefs = set()
+        self.site_css = False
+        self.canonical = False
+        self.own_top_bar = False
+        self.own_footer = False
+        self.body_seen = False
+        self.head_closed = False
+        self.body_closed = False
+        self.meta_slot = None
+        self.top_bar_slot = None
+        self.footer_slot = None
+
+    def attach(self, rw) -> None:
+        S, E = html_stream.START, html_stream.END
+        rw.on(html_stream.COMMENT, None, self.skip_old_block)
+        # handlers for any tag run first: the cover sees every token before it is rewritten
+        for kind in (html_stream.RAW, html_stream.TEXT, S):
+            rw.on(kind, None, self.find_cover)
+        for kind in (html_stream.RAW, S):
+            rw.on(kind, None, self.store_data_uris)
+        rw.on(S, None, self.note_start)
+        rw.on(html_stream.RAW, None, self.note_raw)
+        rw.on(S, 'title', self.title_start)
+        rw.on(html_stream.TEXT, None, self.title_text)
+        rw.on(E, 'title', self.title_end)
+        rw.on(S, 'meta', self.drop_og_meta)
+        rw.on(E, 'head', self.head_end)
+        rw.on(S, 'body', self.body_start)
+        rw.on(E, 'body', self.body_end)
+        rw.on(S, 'div', self.remove_breadcrumb_div)
+        rw.on(S, 'a', self.remove_breadcrumb_link)
+        rw.on(S, 'ul', self.fix_nav)
+        rw.on(S, 'img', self.rewrite_img)
+        rw.observe(self.collect_text)
+        rw.at_close(self.finish)
+
+    # -- input bookkeeping
+    def skip_old_block(self, rw, tok):
+        m = BLOCK_OPEN_RE.fullmatch(tok.raw)
+        if not m:
+            return None
+        close = f"<!-- /vm:{m.group(1)} -->"
+        rw.trim_text("\n  ")
+        rw.skip_until(lambda t: t.kind == html_stream.COMMENT and t.raw == close)
+        return False
+
+    def find_cover(self, rw, tok):
+        self.cover.feed(tok)
+
+    def note_start(self, rw, tok):
+        raw = tok.raw
+        if 'sb-top-bar-frame' in raw:
+            self.own_top_bar = True
+        if 'sb-footer-frame' in raw:
+            self.own_footer = True
+        if tok.name == 'link':
+            href = tok.attr('href')
+            if href:
+                self.hrefs.add(href)
+                if SITE_CSS_RE.search(href):
+                    self.site_css = True
+            if (tok.attr('rel') or '').lower() == 'canonical':
+                self.canonical = True
+
+    def note_raw(self, rw, tok):
+        if not self.site_css and SITE_CSS_RE.search(tok.raw):
+            self.site_css = True
+
+    def title_start(self, rw, tok):
+        if self.title is None:
+            self.title_parts = []
+
+    def title_text(self, rw, tok):
+        if self.title_parts is not None:
+            self.title_parts.append(tok.raw)
+
+    def title_end(self, rw, tok):
+        if self.title_parts is not None:
+            self.title = unescape("".join(self.title_parts).strip())
+            self.title_parts = None
+
+    def collect_text(self, tok):
+        # scripts/styles and tags are not text; stop once there is enough for a description
+        if tok.kind == html_stream.TEXT and len(self.desc) < 200:
+            self.desc = re.sub(r"\s+", " ", f"{self.desc} {tok.raw}").strip()
+
+    # -- transforms
+    def drop_og_meta(self, rw, tok):
+        # remove existing og meta to avoid duplicates
+        if (tok.attr('property') or '').lower().startswith('og:'):
+            return False
+
+    def head_end(self, rw, tok):
+        if self.head_closed:
+            return None
+        self.head_closed = True
         ins = []
-        for key, tag in head_links:
-            if key == 'site-css':
-                # match by href contains assets/css/site.css
-                if re.search(r"assets/\s*css/\s*site\.css", doc, flags=re.IGNORECASE):
-                    continue
-            if 'vendor/starbelly' in tag:
-                href = re.search(r'href="([^"]+)"', tag).group(1)
-                if href and href in doc:
-                    continue
+        for key, tag in HEAD_LINKS:
+            if key == 'site-css' and self.site_css:
+                continue
+            if 'vendor/starbelly' in tag and re.search(r'href="([^"]+)"', tag).group(1) in self.hrefs:
+                continue
             ins.append(tag)
-        # preloader/transition disable
-        ins.append('<style>.sb-preloader,.sb-click-effect,.sb-load{display:none!important}</style>')
-        if '</head>' in doc:
-            return doc.replace('</head>', '\n  ' + '\n  '.join(ins) + '\n</head>')
-        return doc
-
-    def extract_plain_text(doc: str, limit: int = 220) -> str:
-        # remove scripts/styles and tags to build a short description
-        s = re.sub(r"<script[\s\S]*?</script>", " ", doc, flags=re.IGNORECASE)
-        s = re.sub(r"<style[\s\S]*?</style>", " ", s, flags=re.IGNORECASE)
-        s = re.sub(r"<[^>]+>", " ", s)
-        s = re.sub(r"\s+", " ", s).strip()
-        return s[:limit]
-
-    def inject_meta(doc: str, title: str, cover_url: str) -> str:
-        # remove existing og meta to avoid duplicates
-        doc = re.sub(r"<meta[^>]+property=\"og:[^\"]+\"[^>]*>\s*", "", doc, flags=re.IGNORECASE)
-        desc = extract_plain_text(doc, 200) or f"{title} - Verinin Mutfağı"
+        ins.append(PRELOADER_STYLE)
+        rw.insert(marked('head', '\n  ' + '\n  '.join(ins) + '\n  '))
+        if self.meta_slot is None:
+            self.meta_slot = rw.slot()
+
+    def body_start(self, rw, tok):
+        if self.body_seen:
+            return None
+        self.body_seen = True
+        if self.meta_slot is None:
+            # no </head>: meta tags go right before <body>
+            self.meta_slot = rw.slot()
+        # ensure body has blog-page class
+        m = re.match(r"<body(.*?)>", tok.raw, flags=re.IGNORECASE | re.DOTALL)
+        if m and not re.search(r'class=\"[^\"]*\bblog-page\b', tok.raw, flags=re.IGNORECASE):
+            attrs = m.group(1)
+            if 'class=' in attrs:
+                tok.raw = re.sub(r'class=\"', 'class="blog-page ', tok.raw, count=1, flags=re.IGNORECASE)
+            else:
+                tok.raw = '<body class="blog-page"' + attrs + '>'
+        rw.emit(tok)
+        # If no starbelly top bar exists, inject a consistent header at start of body
+        self.top_bar_slot = rw.slot()
+        return False
+
+    def body_end(self, rw, tok):
+        if self.footer_slot is None:
+            self.footer_slot = rw.slot()
+
+    # Breadcrumb kaldırma: "Ana Sayfa" ve "Blog" butonlarını/izlerini temizle
+    def remove_breadcrumb_div(self, rw, tok):
+        # vm-breadcrumbs kapsayıcısını kaldır
+        if 'vm-breadcrumbs' in (tok.attr('class') or ''):
+            rw.skip_until(lambda t: t.kind == html_stream.END and t.name == 'div')
+            return False
+
+    def remove_breadcrumb_link(self, rw, tok):
+        # class=breadcrumb olan bağlantıları kaldır (tek tek)
+        if re.search(r'\bbreadcrumb\b', tok.attr('class') or ''):
+            rw.skip_until(lambda t: t.kind == html_stream.END and t.name == 'a')
+            return False
+        # Eski tek parça link varsa onu da kaldır: yalnızca <a>metin</a> olabilir; metinden sonraki
+        # ilk belirteçte (en geç üç belirteçte) karar verilir
+        if rw.capture is None:
+            return rw.start_capture(tok, lambda t: t.kind != html_stream.TEXT, self._old_breadcrumb, limit=3)
+
+    @staticmethod
+    def _old_breadcrumb(rw, tokens):
+        if (len(tokens) == 3 and tokens[1].kind == html_stream.TEXT
+                and tokens[2].kind == html_stream.END and tokens[2].name == 'a'
+                and re.fullmatch(r"\s*Ana Sayfa\s*/\s*Blog\s*", tokens[1].raw, flags=re.IGNORECASE)):
+            return ""
+        return None
+
+    def fix_nav(self, rw, tok):
+        # Mevcut nav <ul class="sb-navigation"> ... </ul> bloğunu yakalayıp değiştir
+        if tok.attr('class') == 'sb-navigation' and rw.capture is None:
+            return rw.start_capture(tok, lambda t: t.kind == html_stream.END and t.name == 'ul',
+                                    lambda rw, tokens: NAV_FIXED)
+
+    def store_data_uris(self, rw, tok):
+        # embedded images (CSS backgrounds, style attributes) move to the shared store; <img> is
+        # handled by rewrite_img, scripts are left alone
+        if tok.name not in ('img', 'script'):
+            tok.raw = asset_store.replace_data_uris(tok.raw)
+
+    def rewrite_img(self, rw, tok):
+        tok.raw = asset_store.replace_data_uris(rewrite_img_tag(tok.raw, self.slug, self.input_path.parent))
+
+    # -- deferred blocks
+    def description(self) -> str:
+        return self.desc[:200].replace('"', '&quot;')
+
+    def fill_meta(self, rw, final=False) -> None:
+        if self.meta_slot is None or self.meta_slot.text is not None:
+            return
+        if not final and (len(self.desc) < 200 or not self.cover.settled()):
+            return
+        title = self.title or "Blog Yazısı"
+        cover_url = self.cover.result()
+        desc = self.description() or f"{title} - Verinin Mutfağı"
         tags = [
             f'<meta name="description" content="{desc}">',
             f'<meta property="og:title" content="{title} - Verinin Mutfağı">',
@@ -201,234 +651,31 @@ def build_post(input_path: pathlib.Path, out_path: pathlib.Path):
             f'<meta name="twitter:title" content="{title} - Verinin Mutfağı">',
             f'<meta name="twitter:description" content="{desc}">',
             f'<meta name="twitter:image" content="{cover_url}">',
-        ]
-        if '</head>' in doc:
-            return doc.replace('</head>', '\n  ' + '\n  '.join(tags) + '\n</head>')
-        return '\n'.join(tags) + doc
-
-    def ensure_body_class(doc: str) -> str:
-        # ensure body has blog-page class
-        m = re.search(r"<body(.*?)>", doc, flags=re.IGNORECASE|re.DOTALL)
-        if not m:
-            return doc
-        full = m.group(0)
-        attrs = m.group(1)
-        if re.search(r'class=\"[^\"]*\bblog-page\b', full, flags=re.IGNORECASE):
-            return doc
-        if 'class=' in attrs:
-            new = re.sub(r'class=\"', 'class="blog-page ', full, flags=re.IGNORECASE)
-        else:
-            new = '<body class="blog-page"' + attrs + '>'
-        start, end = m.span(0)
-        return doc[:start] + new + doc[end:]
-
-    def inject_top_bar(doc: str) -> str:
-        # If no starbelly top bar exists, inject a consistent header at start of body
-        if 'sb-top-bar-frame' in doc:
-            return doc
-        header = (
-            '\n  <div class="sb-top-bar-frame">\n'
-            '    <div class="sb-top-bar-bg"></div>\n'
-            '    <div class="container">\n'
-            '      <div class="sb-top-bar">\n'
-            '        <a href="../index.html" class="sb-logo-frame">\n'
-            '          <img src="../assets/img/logo.png" alt="Verinin Mutfağı">\n'
-            '        </a>\n'
-            '        <div class="sb-right-side">\n'
-            '          <nav class="sb-menu-transition">\n'
-            '            <ul class="sb-navigation">\n'
-            '              <li><a href="../index.html">Ana Sayfa</a></li>\n'
-            '              <li class="sb-active"><a href="index.html">Blog</a></li>\n'
-            '              <li><a href="../bultenler/index.html">Haftalık Bültenler</a></li>\n'
-            '              <li><a href="../youtube/index.html">YouTube</a></li>\n'
-            '              <li><a href="../contact/index.html">İletişim</a></li>\n'
-            '            </ul>\n'
-            '          </nav>\n'
-            '          <div class="sb-buttons-frame">\n'
-            '            <div class="sb-menu-btn"><span></span></div>\n'
-            '            <div class="sb-info-btn"><span></span></div>\n'
-            '          </div>\n'
-            '        </div>\n'
-            '      </div>\n'
-            '    </div>\n'
-            '  </div>\n'
-        )
-        m = re.search(r"<body[^>]*>", doc, flags=re.IGNORECASE)
-        if m:
-            end = m.end()
-            return doc[:end] + header + doc[end:]
-        return header + doc
-
-    def inject_footer(doc: str) -> str:
-        # If a footer using sb-footer-frame already exists, keep it.
-        if 'sb-footer-frame' in doc:
-            return doc
-        footer = (
-            '\n  <footer>\n'
-            '    <div class="container">\n'
-            '      <div class="sb-footer-frame">\n'
-            '        <a href="../index.html" class="sb-logo-frame">\n'
-            '          <img src="../assets/img/logo.png" alt="Verinin Mutfağı">\n'
-            '        </a>\n'
-            '        <div class="sb-copy">&copy; <a href="../index.html">Verinin Mutfağı</a></div>\n'
-            '        <nav class="vm-social">\n'
-            '          <a href="https://www.linkedin.com/in/ferhatisyapan/" target="_blank" rel="noopener">LinkedIn</a>\n'
-            '          <a href="https://github.com/ferhatisyapanys/VerininMutfagi" target="_blank" rel="noopener">GitHub</a>\n'
-            '          <a href="https://instagram.com/verininmutfagi" target="_blank" rel="noopener">Instagram</a>\n'
-            '        </nav>\n'
-            '      </div>\n'
-            '    </div>\n'
-            '  </footer>\n'
-        )
-        # insert before </body>
-        return doc.replace('</body>', footer + '\n</body>') if '</body>' in doc else (doc + footer)
+        ] + self.seo_tags(title, cover_url)
+        rw.fill(self.meta_slot, marked('meta', '\n  ' + '\n  '.join(tags) + '\n  '))
 
-    # Breadcrumb kaldırma: "Ana Sayfa" ve "Blog" butonlarını/izlerini temizle
-    def remove_breadcrumbs(doc: str) -> str:
-        # vm-breadcrumbs kapsayıcısını kaldır
-        doc = re.sub(r"<div[^>]*class=\"[^\"]*vm-breadcrumbs[^\"]*\"[^>]*>[\s\S]*?</div>", "", doc, flags=re.IGNORECASE)
-        # class=breadcrumb olan bağlantıları kaldır (tek tek)
-        doc = re.sub(r"<a[^>]*class=\"[^\"]*\bbreadcrumb\b[^\"]*\"[^>]*>[\s\S]*?</a>", "", doc, flags=re.IGNORECASE)
-        # Eski tek parça link varsa onu da kaldır
-        doc = re.sub(r"<a[^>]*>\s*Ana Sayfa\s*/\s*Blog\s*</a>", "", doc, flags=re.IGNORECASE)
-        return doc
-
-    # Navbar'ı tüm blog yazılarında sabitle: Ana Sayfa, Blog, Haftalık Bültenler, YouTube, İletişim
-    def inject_fixed_nav(doc: str) -> str:
-        nav_fixed = (
-            '\n<ul class="sb-navigation">\n'
-            '  <li><a href="../index.html">Ana Sayfa</a></li>\n'
-            '  <li class="sb-active"><a href="index.html">Blog</a></li>\n'
-            '  <li><a href="../bultenler/index.html">Haftalık Bültenler</a></li>\n'
-            '  <li><a href="../youtube/index.html">YouTube</a></li>\n'
-            '  <li><a href="../contact/index.html">İletişim</a></li>\n'
-            '</ul>'
-        )
-        # Mevcut nav <ul class="sb-navigation"> ... </ul> bloğunu yakalayıp değiştir
-        doc2 = re.sub(r"<ul\\s+class=\\\"sb-navigation\\\">[\\s\\S]*?</ul>", nav_fixed, doc, flags=re.IGNORECASE)
-        return doc2
-
-    # Optimize inline <img> tags: copy local/data images into assets/img/posts/<slug>/, add lazy/decoding attrs
-    def optimize_inline_images(doc: str, slug: str, base_dir: pathlib.Path) -> str:
-        posts_dir = SITE_DIR / 'assets' / 'img' / 'posts' / slug
-        posts_dir.mkdir(parents=True, exist_ok=True)
-
-        def process_tag(tag: str) -> str:
-            try:
-                m = re.search(r'src=\"([^\"]+)\"', tag, flags=re.IGNORECASE)
-                if not m:
-                    return tag
-                src = m.group(1)
-                src_l = src.lower()
-                # Skip site UI assets (logo, favicons, vendor)
-                if (
-                    'vendor/' in src_l or
-                    '/assets/img/logo' in src_l or
-                    '/assets/img/logos/' in src_l or
-                    'favicon' in src_l or
-                    'apple-touch-icon' in src_l or
-                    'android-chrome' in src_l
-                ):
-                    # Ensure lazy for content only; do not touch UI images
-                    return tag
-                # external image: just ensure lazy attrs
-                if src.startswith('http://') or src.startswith('https://'):
-                    new = tag
-                    if 'loading=' not in new.lower():
-                        new = new.replace('<img', '<img loading="lazy"', 1)
-                    if 'decoding=' not in new.lower():
-                        new = new.replace('<img', '<img decoding="async"', 1)
-                    return new
-                # data URI or local path
-                target_path = None
-                if src.startswith('data:image/'):
-                    import base64
-                    m2 = re.match(r'data:image/(png|jpeg|jpg|webp);base64,(.*)', src, flags=re.IGNORECASE)
-                    ext = 'png'
-                    raw = None
-                    if m2:
-                        ext = 'jpg' if m2.group(1).lower() == 'jpeg' else m2.group(1).lower()
-                        raw = base64.b64decode(m2.group(2) + '===')
-                    else:
-                        raw = base64.b64decode(src.split(',', 1)[1])
-                    target_path = posts_dir / f"img_{abs(hash(src))}.{ext}"
-                    target_path.write_bytes(raw)
-                else:
-                    ip = (base_dir / src).resolve() if not os.path.isabs(src) else pathlib.Path(src)
-                    if ip.exists():
-                        target_path = posts_dir / os.path.basename(src)
-                        try:
-                            from PIL import Image
-                            im = Image.open(ip)
-                            w, h = im.size
-                            maxw = 1280
-                            if w > maxw:
-                                nh = int(h * (maxw / float(w)))
-                                im = im.resize((maxw, nh), Image.LANCZOS)
-                            im.save(target_path)
-                        except Exception:
-                            target_path.write_bytes(ip.read_bytes())
-                if target_path and target_path.exists():
-                    rel = f"../assets/img/posts/{slug}/{target_path.name}"
-                    new = re.sub(r'src=\"[^\"]+\"', f'src="{rel}"', tag, flags=re.IGNORECASE)
-                    if 'loading=' not in new.lower():
-                        new = new.replace('<img', '<img loading="lazy"', 1)
-                    if 'decoding=' not in new.lower():
-                        new = new.replace('<img', '<img decoding="async"', 1)
-                    # add width/height if absent
-                    if ('width=' not in new.lower()) or ('height=' not in new.lower()):
-                        try:
-                            from PIL import Image
-                            im2 = Image.open(target_path)
-                            wh = f' width="{im2.width}" height="{im2.height}"'
-                            new = new.replace('<img', f'<img{wh}', 1)
-                        except Exception:
-                            pass
-                    return new
-                return tag
-            except Exception:
-                return tag
-
-        return re.sub(r'<img[^>]*?>', lambda m: process_tag(m.group(0)), doc, flags=re.IGNORECASE)
-
-    # Extract title early for meta
-    page_title = extract_title(html)
-    # Compute a cover candidate from content
-    cover_for_meta = extract_cover(html, input_path.parent, input_path.stem)
-
-    html = ensure_head_assets(html)
-    html = ensure_body_class(html)
-    html = inject_top_bar(html)
-    html = remove_breadcrumbs(html)
-    html = inject_fixed_nav(html)
-    # Optimize images inside content
-    try:
-        html = optimize_inline_images(html, out_path.stem, input_path.parent)
-    except Exception:
-        pass
-    # Inject meta tags (og + description) using computed cover and canonical if available
-    html = inject_meta(html, page_title, cover_for_meta if cover_for_meta.startswith('http') or cover_for_meta.startswith('assets/') else cover_for_meta)
-    if SITE_BASE_URL:
-        canonical = f"{SITE_BASE_URL}/blog/{out_path.name}"
-        if '</head>' in html and 'rel="canonical"' not in html:
-            html = html.replace('</head>', f'\n  <link rel="canonical" href="{canonical}">\n</head>')
+    def seo_tags(self, title: str, cover_url: str) -> list:
+        if not SITE_BASE_URL:
+            return []
+        tags = []
+        canonical = f"{SITE_BASE_URL}/blog/{self.out_path.name}"
+        if not self.canonical:
+            tags.append(f'<link rel="canonical" href="{canonical}">')
         # JSON-LD per post: BlogPosting + BreadcrumbList
-        from datetime import datetime as _dt
         try:
-            ts = int(input_path.stat().st_mtime)
+            ts = int(self.input_path.stat().st_mtime)
         except Exception:
-            ts = int(_dt.utcnow().timestamp())
-        published = _dt.utcfromtimestamp(ts).strftime('%Y-%m-%dT%H:%M:%SZ')
-        image_abs = cover_for_meta
+            ts = int(datetime.utcnow().timestamp())
+        published = datetime.utcfromtimestamp(ts).strftime('%Y-%m-%dT%H:%M:%SZ')
+        image_abs = cover_url
         if image_abs.startswith('../'):
             image_abs = image_abs[3:]
         if image_abs.startswith('assets/'):
             image_abs = f"{SITE_BASE_URL}/{image_abs}"
-        import json as _json
         post_ld = {
             "@context": "https://schema.org",
             "@type": "BlogPosting",
-            "headline": page_title,
+            "headline": title,
             "datePublished": published,
             "image": image_abs,
             "url": canonical,
@@ -440,81 +687,87 @@ def build_post(input_path: pathlib.Path, out_path: pathlib.Path):
             "itemListElement": [
                 {"@type": "ListItem", "position": 1, "name": "Ana Sayfa", "item": f"{SITE_BASE_URL}/"},
                 {"@type": "ListItem", "position": 2, "name": "Blog", "item": f"{SITE_BASE_URL}/blog/"},
-                {"@type": "ListItem", "position": 3, "name": page_title, "item": canonical}
+                {"@type": "ListItem", "position": 3, "name": title, "item": canonical}
             ]
         }
-        scripts = (
-            "<script type=\\\"application/ld+json\\\">" + _json.dumps(post_ld, ensure_ascii=False) + "</script>\n"
-            "<script type=\\\"application/ld+json\\\">" + _json.dumps(bc_ld, ensure_ascii=False) + "</script>"
-        )
-        if '</head>' in html:
-            html = html.replace('</head>', scripts + '\n</head>')
-    html = inject_footer(html)
+        tags.append('<script type="application/ld+json">' + json.dumps(post_ld, ensure_ascii=False) + '</script>')
+        tags.append('<script type="application/ld+json">' + json.dumps(bc_ld, ensure_ascii=False) + '</script>')
+        return tags
+
+    def finish(self, rw) -> None:
+        if self.meta_slot is None:
+            self.meta_slot = rw.slot()
+        self.fill_meta(rw, final=True)
+        if self.top_bar_slot is not None:
+            rw.fill(self.top_bar_slot, "" if self.own_top_bar else marked('top-bar', TOP_BAR))
+        # If the page has its own footer using sb-footer-frame, keep it; no </body>: append
+        footer = "" if self.own_footer else marked('footer', FOOTER)
+        if self.footer_slot is not None:
+            rw.fill(self.footer_slot, footer)
+        else:
+            rw.insert(footer)
+
+def build_post(input_path: pathlib.Path, out_path: pathlib.Path) -> dict:
+    """Publish one post in its original format plus the site chrome, in one streaming pass.
+
+    Returns the post's title and cover (found on the way, no second scan).
+    """
+    post = PostRewrite(input_path, out_path)
     out_path.parent.mkdir(parents=True, exist_ok=True)
-    out_path.write_text(html, encoding="utf-8")
-    return extract_title(html)
+    tmp = out_path.with_name(f".{out_path.name}.{os.getpid()}.tmp")
+    try:
+        with open(input_path, encoding="utf-8", errors="ignore") as src, \
+                open(tmp, "w", encoding="utf-8") as fh:
+            rw = html_stream.Rewriter(html_stream.StreamWriter(fh))
+            post.attach(rw)
+            # the meta block is due once enough text and the cover are known
+            rw.observe(lambda tok: post.fill_meta(rw))
+            rw.run(src)
+        os.replace(tmp, out_path)
+    finally:
+        if tmp.exists():
+            tmp.unlink()
+    return {"title": post.title or "Blog Yazısı", "cover": post.cover.result()}
 
-def main():
-    posts = []
-    BLOG_DIR.mkdir(parents=True, exist_ok=True)
-    # Öncelik: site/blog içindeki mevcut .html yazılar (index.html hariç)
-    blog_srcs = [p for p in BLOG_DIR.glob("*.html") if p.name.lower() != "index.html"]
-    if blog_srcs:
-        for src in blog_srcs:
-            try:
-                # Rebuild in-place to inject consistent header/navigation
-                build_post(src, src)
-                raw_html = src.read_text(encoding="utf-8", errors="ignore")
-            except Exception:
-                try:
-                    raw_html = src.read_text(encoding="utf-8", errors="ignore")
-                except Exception:
-                    continue
-            title = extract_title(raw_html)
-            slug = src.stem
-            ts = datetime.fromtimestamp(src.stat().st_mtime)
-            date_str = ts.strftime("%d %b %Y")
-            cover_rel = extract_cover(raw_html, BLOG_DIR, slug)
-            posts.append({
-                "title": title,
-                "slug": slug,
-                "date": date_str,
-                "cover": cover_rel,
-                "ts": int(ts.timestamp()),
-            })
-    else:
-        # Kaynak yazıları: content/*.html (opsiyonel kaynak klasörü)
-        content_dir = ROOT / 'content'
-        source_files = [p for p in content_dir.glob('*.html')] if content_dir.exists() else []
-        for src in source_files:
-            # Slug'ı başlıktan üret
-            temp_html = src.read_text(encoding="utf-8", errors="ignore")
-            title_tmp = extract_title(temp_html)
-            slug = slugify_from_title(title_tmp, src.name)
-            dst = BLOG_DIR / f"{slug}.html"
-            raw_html = src.read_text(encoding="utf-8", errors="ignore")
-            title = extract_title(raw_html)
-            # Yayınla (aynı format)
-            build_post(src, dst)
-            ts = datetime.fromtimestamp(src.stat().st_mtime)
-            date_str = ts.strftime("%d %b %Y")
-            # Kapak görseli: içerikten (img/src veya background-image) çıkar
-            cover_rel = extract_cover(raw_html, ROOT, slug)
-            posts.append({
-                "title": title,
-                "slug": slug,
-                "date": date_str,
-                "cover": cover_rel,
-                "ts": int(ts.timestamp()),
-            })
+def transform_hash() -> str:
+    """Everything besides the source document that shapes a built post."""
+    return cache_key("transform", TRANSFORM_VERSION, pathlib.Path(__file__).read_bytes(),
+                     pathlib.Path(html_stream.__file__).read_bytes(),
+                     pathlib.Path(asset_store.__file__).read_bytes(), SITE_BASE_URL, pil_version())
 
-    # Yeni: dosya tarihine göre (mtime) azalan sıralama
+def template_hash() -> str:
+    return cache_key("templates", INDEX_TEMPLATE, HOME_TEMPLATE, SITE_BASE_URL)
+
+def load_manifest() -> dict:
     try:
-        posts.sort(key=lambda p: p.get("ts", 0), reverse=True)
-    except Exception:
-        pass
+        manifest = json.loads(MANIFEST_PATH.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return {"posts": {}}
+    if not isinstance(manifest, dict) or not isinstance(manifest.get("posts"), dict):
+        return {"posts": {}}
+    return manifest
 
-    # Build index
+def save_manifest(manifest: dict) -> None:
+    MANIFEST_PATH.parent.mkdir(parents=True, exist_ok=True)
+    tmp = MANIFEST_PATH.with_suffix(".tmp")
+    tmp.write_text(json.dumps(manifest, ensure_ascii=False, indent=1, sort_keys=True), encoding="utf-8")
+    os.replace(tmp, MANIFEST_PATH)
+
+def file_stamp(path: pathlib.Path):
+    st = path.stat()
+    return [st.st_size, st.st_mtime_ns]
+
+def post_card(title: str, slug: str, mtime: float, cover: str) -> dict:
+    ts = datetime.fromtimestamp(mtime)
+    return {
+        "title": title,
+        "slug": slug,
+        "date": ts.strftime("%d %b %Y"),
+        "cover": cover,
+        "ts": int(ts.timestamp()),
+    }
+
+def render_index(posts: list, search_items: list) -> str:
     cards = []
     for p in posts:
         cover_url = p['cover']
@@ -532,8 +785,39 @@ def main():
             )
         )
     index_html = INDEX_TEMPLATE.replace("{{POST_CARDS}}", "\n".join(cards))
-    (BLOG_DIR / "index.html").write_text(index_html, encoding="utf-8")
 
+    # Embed search JSON into blog index to support file:// usage
+    index_html = index_html.replace("{{SEARCH_JSON}}", json.dumps(search_items, ensure_ascii=False))
+    # JSON-LD: BreadcrumbList
+    breadcrumb = {
+        "@context": "https://schema.org",
+        "@type": "BreadcrumbList",
+        "itemListElement": [
+            {"@type": "ListItem", "position": 1, "name": "Ana Sayfa", "item": SITE_BASE_URL+"/" if SITE_BASE_URL else "../index.html"},
+            {"@type": "ListItem", "position": 2, "name": "Blog", "item": SITE_BASE_URL+"/blog/" if SITE_BASE_URL else "index.html"}
+        ]
+    }
+    # JSON-LD: ItemList of posts
+    items_ld = []
+    for i, p in enumerate(posts, start=1):
+        url_path = f"/blog/{p['slug']}.html"
+        url = (SITE_BASE_URL + url_path) if SITE_BASE_URL else url_path
+        img = p['cover']
+        if img.startswith('../'):
+            img = img[3:]
+        if SITE_BASE_URL and (img.startswith('assets/') or img.startswith('site/assets/')):
+            img = SITE_BASE_URL + "/" + img.lstrip('/')
+        items_ld.append({
+            "@type": "ListItem",
+            "position": i,
+            "item": {"@id": url, "name": p['title'], "image": img}
+        })
+    itemlist = {"@context": "https://schema.org", "@type": "ItemList", "itemListElement": items_ld}
+    index_html = index_html.replace("{{JSONLD_BREADCRUMB}}", json.dumps(breadcrumb, ensure_ascii=False))
+    index_html = index_html.replace("{{JSONLD_INDEX}}", json.dumps(itemlist, ensure_ascii=False))
+    return index_html
+
+def render_home(posts: list) -> str:
     # Build home with latest posts (first 6)
     home_cards = []
     for p in posts[:6]:
@@ -551,10 +835,9 @@ def main():
                 "</article>\n"
             )
         )
-    home_html = HOME_TEMPLATE.replace("{{POST_CARDS}}", "\n".join(home_cards))
-    (SITE_DIR / "index.html").write_text(home_html, encoding="utf-8")
+    return HOME_TEMPLATE.replace("{{POST_CARDS}}", "\n".join(home_cards))
 
-    # Build search index
+def build_search_items(posts: list) -> list:
     def strip_html(raw: str) -> str:
         # remove scripts and styles
         raw = re.sub(r"<script[\s\S]*?</script>", " ", raw, flags=re.IGNORECASE)
@@ -570,11 +853,8 @@ def main():
         if not html_path.exists():
             continue
         raw = html_path.read_text(encoding="utf-8", errors="ignore")
-        # parse mtime to epoch seconds for recency scoring on client
-        try:
-            ts_epoch = int((html_path).stat().st_mtime)
-        except Exception:
-            ts_epoch = int(datetime.strptime(p["date"], "%d %b %Y").timestamp())
+        # recency scoring on client: the source's mtime from the card, not when this output happened to be written
+        ts_epoch = p.get("ts") or int(datetime.strptime(p["date"], "%d %b %Y").timestamp())
         search_items.append({
             "title": p["title"],
             "slug": p["slug"],
@@ -583,46 +863,176 @@ def main():
             "ts": ts_epoch,
             "content": strip_html(raw)[:60000],
         })
+    return search_items
 
-    search_dir = SITE_DIR / "search"
-    search_dir.mkdir(parents=True, exist_ok=True)
-    import json
-    import json
-    (search_dir / "index.json").write_text(json.dumps(search_items, ensure_ascii=False), encoding="utf-8")
+def render_post(src: pathlib.Path, dst: pathlib.Path, title: str):
+    """Build one post and return its card and output stamp; runs in a worker process with --jobs.
 
-    # Embed search JSON into blog index to support file:// usage
-    search_json_inline = json.dumps(search_items, ensure_ascii=False)
-    index_html = index_html.replace("{{SEARCH_JSON}}", search_json_inline)
-    # JSON-LD: BreadcrumbList
-    breadcrumb = {
-        "@context": "https://schema.org",
-        "@type": "BreadcrumbList",
-        "itemListElement": [
-            {"@type": "ListItem", "position": 1, "name": "Ana Sayfa", "item": SITE_BASE_URL+"/" if SITE_BASE_URL else "../index.html"},
-            {"@type": "ListItem", "position": 2, "name": "Blog", "item": SITE_BASE_URL+"/blog/" if SITE_BASE_URL else "index.html"}
-        ]
+    Returns None when the build failed and there is no earlier output to list, and an
+    output stamp of None when an earlier output is listed but must not be recorded as fresh.
+    """
+    slug = dst.stem
+    built = True
+    try:
+        # Kapak görseli: build_post kaynağı okurken bulur (img/src veya background-image)
+        cover_rel = build_post(src, dst)["cover"]
+    except Exception as e:
+        print(f"[blog] {src.name}: build failed: {e!r}")
+        if not dst.exists():
+            return None
+        built = False
+        cover_rel = extract_cover(src.read_text(encoding="utf-8", errors="ignore"), src.parent, slug)
+    return {
+        "card": post_card(title, slug, src.stat().st_mtime, cover_rel),
+        "output": file_stamp(dst) if built else None,
     }
-    # JSON-LD: ItemList of posts
-    items_ld = []
-    for i, p in enumerate(posts, start=1):
-        url_path = f"/blog/{p['slug']}.html"
-        url = (SITE_BASE_URL + url_path) if SITE_BASE_URL else url_path
-        img = p['cover']
-        if img.startswith('../'):
-            img = img[3:]
-        if SITE_BASE_URL and (img.startswith('assets/') or img.startswith('site/assets/')):
-            img = SITE_BASE_URL + "/" + img.lstrip('/')
-        items_ld.append({
-            "@type": "ListItem",
-            "position": i,
-            "item": {"@id": url, "name": p['title'], "image": img}
-        })
-    itemlist = {"@context": "https://schema.org", "@type": "ItemList", "itemListElement": items_ld}
-    index_html = index_html.replace("{{JSONLD_BREADCRUMB}}", json.dumps(breadcrumb, ensure_ascii=False))
-    index_html = index_html.replace("{{JSONLD_INDEX}}", json.dumps(itemlist, ensure_ascii=False))
-    (BLOG_DIR / "index.html").write_text(index_html, encoding="utf-8")
 
-    print(f"Generated {len(posts)} posts into {BLOG_DIR}")
+def load_slug_pins() -> dict:
+    try:
+        pins = json.loads(SLUGS_PATH.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return {}
+    return pins if isinstance(pins, dict) else {}
+
+def clean_built_posts() -> None:
+    """One-time cleanup after the old in-place builds, when site/blog was source and output at once.
+
+    Every rebuild appended another copy of the preloader style, description/twitter metas
+    and favicon links. Posts that have a source in content/ (matched by title) keep their
+    published slug through content/slugs.json and are rebuilt from that source; posts without
+    one are stripped of the injected markup and adopted into content/ as their source.
+    """
+    SOURCE_DIR.mkdir(parents=True, exist_ok=True)
+    pins = load_slug_pins()
+    by_title = {}
+    for src in sorted(SOURCE_DIR.glob("*.html")):
+        by_title.setdefault(extract_title(src.read_text(encoding="utf-8", errors="ignore")), src)
+    adopted = 0
+    for out in sorted(BLOG_DIR.glob("*.html")):
+        if out.name.lower() == "index.html":
+            continue
+        doc = out.read_text(encoding="utf-8", errors="ignore")
+        title = extract_title(doc)
+        src = by_title.get(title)
+        if src is None:
+            src = SOURCE_DIR / out.name
+            if src.exists():
+                print(f"[clean] {out.name}: {src} exists with another title, skipped")
+                continue
+            src.write_text(strip_legacy(doc), encoding="utf-8")
+            by_title[title] = src
+            adopted += 1
+        if slugify_from_title(title, src.name) != out.stem:
+            pins[src.name] = out.stem
+    if pins:
+        SLUGS_PATH.write_text(json.dumps(pins, ensure_ascii=False, indent=2, sort_keys=True) + "\n",
+                              encoding="utf-8")
+    print(f"[clean] {adopted} posts adopted into {SOURCE_DIR}, {len(pins)} slugs pinned; rebuilding")
+
+def main(argv=None):
+    import argparse
+    ap = argparse.ArgumentParser(description="Build blog posts from content/ into site/blog, plus the blog index, home page and search index")
+    ap.add_argument("--force", action="store_true", help="ignore the build manifest and rebuild every post and page")
+    ap.add_argument("--clean", action="store_true",
+                    help="one-time: strip duplicates left by old in-place builds, adopt posts without a source, rebuild")
+    ap.add_argument("--jobs", "-j", type=int, default=1,
+                    help="render changed posts in N worker processes (0: one per CPU)")
+    args = ap.parse_args(argv)
+    if args.jobs <= 0:
+        args.jobs = os.cpu_count() or 1
+    if args.clean:
+        clean_built_posts()
+        args.force = True
+
+    manifest = {"posts": {}} if args.force else load_manifest()
+    known = manifest["posts"]
+    thash = transform_hash()
+    pins = load_slug_pins()
+    entries = {}
+    posts = []
+    rebuilt = []
+    stale = []      # (src, dst, title, manifest key, source hash) to render
+    claimed = {}    # slug -> source file name
+    BLOG_DIR.mkdir(parents=True, exist_ok=True)
+    for src in sorted(SOURCE_DIR.glob("*.html")) if SOURCE_DIR.exists() else []:
+        try:
+            data = src.read_bytes()
+        except OSError:
+            continue
+        source_hash = hashlib.sha256(data).hexdigest()
+        title = extract_title(data.decode("utf-8", errors="ignore"))
+        # Slug'ı başlıktan üret (slugs.json'daki sabitlenmiş adresler hariç)
+        slug = pins.get(src.name) or slugify_from_title(title, src.name)
+        dst = BLOG_DIR / f"{slug}.html"
+        rel = dst.relative_to(ROOT).as_posix()
+        prev = known.get(rel)
+        try:
+            fresh = (prev is not None and prev.get("source") == source_hash
+                     and prev.get("transform") == thash and prev.get("output") == file_stamp(dst))
+        except OSError:
+            fresh = False
+        if slug in claimed:
+            # iki kaynak aynı çıktıya yazmasın (paralel derlemede görseller de çakışırdı)
+            print(f"[blog] {src.name}: slug {slug!r} already used by {claimed[slug]}, skipped")
+            continue
+        claimed[slug] = src.name
+        if fresh:
+            # Kaynak, şablon ve dönüşüm aynı: yazıya hiç dokunma
+            entries[rel] = prev
+            posts.append(prev["card"])
+            continue
+        stale.append((src, dst, title, rel, source_hash))
+
+    if args.jobs > 1 and len(stale) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=min(args.jobs, len(stale))) as pool:
+            results = list(pool.map(render_post, *zip(*[job[:3] for job in stale])))
+    else:
+        results = [render_post(src, dst, title) for src, dst, title, _rel, _h in stale]
+    # sonuçlar iş sırasıyla toplanır; kartlar aşağıda yine (tarih, slug) ile sıralanır
+    for (_src, _dst, _title, rel, source_hash), res in zip(stale, results):
+        if res is None:
+            continue
+        posts.append(res["card"])
+        rebuilt.append(res["card"]["slug"])
+        if res["output"] is not None:
+            entries[rel] = {"source": source_hash, "transform": thash, "output": res["output"], "card": res["card"]}
+
+    produced = {f"{p['slug']}.html" for p in posts}
+    stray = sorted(p.name for p in BLOG_DIR.glob("*.html") if p.name.lower() != "index.html" and p.name not in produced)
+    if stray:
+        print(f"[blog] no source in {SOURCE_DIR} for {', '.join(stray)}; run with --clean once to adopt them")
+
+    # Yeni: dosya tarihine göre (mtime) azalan sıralama
+    try:
+        posts.sort(key=lambda p: (-p.get("ts", 0), p["slug"]))
+    except Exception:
+        pass
+
+    # Sayfalar yalnızca kart verisi (başlık, tarih, kapak) ya da şablonlar değişince yeniden yazılır;
+    # arama indeksi (ve onu gömen blog index'i) ayrıca bir yazının içeriği değişince de.
+    cards = [[p["slug"], p["title"], p["date"], p["cover"]] for p in posts]
+    thpl = template_hash()
+    pages_stale = args.force or manifest.get("templates") != thpl
+    cards_changed = pages_stale or manifest.get("cards") != cards
+    home_path = SITE_DIR / "index.html"
+    index_path = BLOG_DIR / "index.html"
+    search_path = SITE_DIR / "search" / "index.json"
+    if pages_stale or manifest.get("cards", [])[:6] != cards[:6] or not home_path.exists():
+        home_path.write_text(render_home(posts), encoding="utf-8")
+    if cards_changed or rebuilt or not index_path.exists() or not search_path.exists():
+        search_items = build_search_items(posts)
+        search_path.parent.mkdir(parents=True, exist_ok=True)
+        search_path.write_text(json.dumps(search_items, ensure_ascii=False), encoding="utf-8")
+        index_path.write_text(render_index(posts, search_items), encoding="utf-8")
+
+    save_manifest({"version": 1, "templates": thpl, "cards": cards, "posts": entries})
+    CACHE.prune()
+    removed = asset_store.gc()
+    print(f"Generated {len(posts)} posts into {BLOG_DIR} "
+          f"({len(rebuilt)} rebuilt, {len(posts) - len(rebuilt)} unchanged)")
+    if removed:
+        print(f"[blog] removed {removed} unreferenced images from {asset_store.STORE_DIR}")
 
 if __name__ == "__main__":
     main()
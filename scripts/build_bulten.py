@@ -6,6 +6,7 @@ import re
 from html import escape
 import os
 import json
+import asset_store
 
 ROOT = pathlib.Path(__file__).resolve().parents[1]
 SITE = ROOT / 'site'
@@ -98,13 +99,22 @@ def build_notes_html(notes):
     return '\n'.join(out)
 
 
-def build_one(rec):
+def card_info(rec):
+    """Index/feed fields of a record, without rendering its page."""
     slug = rec.get('slug') or 'bulten'
-    title = rec.get('title') or 'Haftalık Bülten'
     hero = rec.get('hero') or '../assets/img/covers/default.jpg'
     # Prefer per-bulletin image under site/bultenler/assets/<slug>/
-    hero = pick_bulletin_hero(slug, hero)
-    date = fmt_date(rec.get('date') or '')
+    return {
+        'slug': slug,
+        'title': rec.get('title') or 'Haftalık Bülten',
+        'date': fmt_date(rec.get('date') or ''),
+        'hero': pick_bulletin_hero(slug, hero),
+    }
+
+
+def build_one(rec):
+    info = card_info(rec)
+    slug, title, hero, date = info['slug'], info['title'], info['hero'], info['date']
     intro = rec.get('intro') or ''
     page = TPL_PAGE
     page = page.replace('{{TITLE}}', escape(title))
@@ -114,7 +124,8 @@ def build_one(rec):
     page = page.replace('{{BLOG_CARDS}}', build_cards_blog(rec.get('blog') or []))
     page = page.replace('{{YT_CARDS}}', build_cards_youtube(rec.get('youtube') or []))
     page = page.replace('{{NOTES_HTML}}', build_notes_html(rec.get('notes') or []))
-    doc_html = rec.get('doc_html') or ''
+    # embedded images go to the shared store (assets/img/inline/), not into the page
+    doc_html = asset_store.replace_data_uris(rec.get('doc_html') or '')
     if doc_html:
         # Add lazy-loading to images in doc_html
         def add_lazy(s: str) -> str:
@@ -169,12 +180,7 @@ def build_one(rec):
             page_path.write_text(s, encoding='utf-8')
     except Exception:
         pass
-    return {
-        'slug': slug,
-        'title': title,
-        'date': date,
-        'hero': hero,
-    }
+    return info
 
 
 def build_index(items):
@@ -287,7 +293,12 @@ def build_rss(items):
     (BULTEN_DIR / 'feed.xml').write_text('\n'.join(lines), encoding='utf-8')
 
 
-def main():
+def build(slugs=None):
+    """Render bulletin pages, then the index and feed from every record.
+
+    With `slugs`, only those pages (and pages missing on disk) are rendered; the
+    other records contribute their card data only.
+    """
     items = []
     if DATA_DIR.exists():
         for p in sorted(DATA_DIR.glob('*.json')):
@@ -295,14 +306,22 @@ def main():
                 rec = json.loads(p.read_text(encoding='utf-8'))
             except Exception:
                 continue
-            info = build_one(rec)
-            items.append(info)
+            slug = rec.get('slug') or 'bulten'
+            if slugs is None or slug in slugs or not (BULTEN_DIR / f'{slug}.html').exists():
+                items.append(build_one(rec))
+            else:
+                items.append(card_info(rec))
     # son kayıt üstte olacak şekilde ters sırala (tarihe göre yapmadık; basitçe eklenme sırası)
     items = list(reversed(items))
     build_index(items)
     build_rss(items)
-    print(f'Generated {len(items)} bulletins into {BULTEN_DIR}')
+    asset_store.gc()
+    return items
+
 
+def main():
+    items = build()
+    print(f'Generated {len(items)} bulletins into {BULTEN_DIR}')
 
 if __name__ == '__main__':
     main()
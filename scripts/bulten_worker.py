@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+"""
+Bulletin watcher: turns site/bulten_doc/**/*.html exports into data/bultenler/<slug>.json
+records and rebuilds the matching bulletin pages.
+
+The analytics server runs run() in a separate process (see BultenWatcher in
+analytics_server.py) so scanning, copying assets and rendering pages never compete
+with request threads for the GIL. The parent sends jobs through a queue:
+
+  ('scan',)            look for changed documents now instead of at the next interval
+  ('rebuild', slug)    convert and rebuild one bulletin (slug=None: every bulletin)
+  None                 stop
+
+A changed document is converted once its mtime has been stable for `debounce`
+seconds, so an export that is still being unzipped is not built half-written. Only
+the bulletins whose document changed are re-rendered; the index and feed are
+regenerated from every record. After every scan or build the worker puts a status
+dict on the status queue.
+
+Standalone (no server):
+  python3 scripts/bulten_worker.py            # watch until Ctrl+C
+  python3 scripts/bulten_worker.py --once     # convert changed documents, rebuild, exit
+"""
+import os
+import re
+import sys
+import json
+import queue
+import shutil
+import signal
+import time
+from datetime import datetime, timedelta
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+DOCS_DIR = os.path.join(ROOT, 'site', 'bulten_doc')
+DATA_DIR = os.path.join(ROOT, 'data', 'bultenler')
+ASSETS_DIR = os.path.join(ROOT, 'site', 'bultenler', 'assets')
+INTERVAL = 10      # seconds between scans
+DEBOUNCE = 2.0     # seconds a changed document must stay unchanged before it is built
+
+TR_MONTHS = {1: 'Ocak', 2: 'Şubat', 3: 'Mart', 4: 'Nisan', 5: 'Mayıs', 6: 'Haziran', 7: 'Temmuz',
+             8: 'Ağustos', 9: 'Eylül', 10: 'Ekim', 11: 'Kasım', 12: 'Aralık'}
+COVER_DIRS = ('image', 'images', 'res', 'assets')
+IMAGE_EXTS = ('.jpg', '.jpeg', '.png', '.webp', '.gif')
+
+
+def weekly_title_slug(mtime):
+    """Title, slug and ISO date of the week (starting Monday) a document was saved in."""
+    dt = datetime.fromtimestamp(mtime)
+    dt = dt - timedelta(days=dt.weekday())
+    title = f"Verinin Dünyası {dt.day} {TR_MONTHS.get(dt.month, dt.strftime('%b'))}"
+    return title, f"verinin-dunyasi-{dt.strftime('%Y-%m-%d')}", dt.strftime('%Y-%m-%d')
+
+
+def extract_title_body(html):
+    m = re.search(r"<title>(.*?)</title>", html, re.IGNORECASE | re.DOTALL)
+    title = m.group(1).strip() if m else 'Haftalık Bülten'
+    m2 = re.search(r"<body[^>]*>([\s\S]*?)</body>", html, re.IGNORECASE)
+    body = m2.group(1) if m2 else html
+    body = re.sub(r"<!--.*?-->", " ", body, flags=re.DOTALL)
+    body = re.sub(r"<style[\s\S]*?</style>", " ", body, flags=re.IGNORECASE)
+    body = re.sub(r"\sstyle=\"[^\"]*\"", "", body)
+    return title, body.strip()
+
+
+def rewrite_assets(body, src_dir, out_assets):
+    """Copy relative src/href targets into `out_assets` and point the links at the copies."""
+    slug = os.path.basename(out_assets)
+    os.makedirs(out_assets, exist_ok=True)
+
+    def repl(m):
+        attr, url = m.group(1), m.group(2)
+        if url.startswith(('http:', 'https:', 'data:', 'assets/', '../', '/')):
+            return m.group(0)
+        src_path = os.path.join(src_dir, url)
+        base = os.path.basename(url)
+        try:
+            if os.path.isfile(src_path):
+                shutil.copy2(src_path, os.path.join(out_assets, base))
+        except OSError as e:
+            print(f'[bulten-watcher] asset copy failed: {e}', file=sys.stderr)
+        return f'{attr}="assets/{slug}/{base}"'
+    body = re.sub(r"(src)=\"([^\"]+)\"", repl, body, flags=re.IGNORECASE)
+    body = re.sub(r"(href)=\"([^\"]+)\"", repl, body, flags=re.IGNORECASE)
+    return body
+
+
+def find_folder_cover(src_dir):
+    """First image in an image/, images/, res/ or assets/ folder next to the document."""
+    try:
+        names = os.listdir(src_dir)
+    except OSError:
+        return None
+    for name in names:
+        p = os.path.join(src_dir, name)
+        if os.path.isdir(p) and name.lower() in COVER_DIRS:
+            try:
+                for fn in os.listdir(p):
+                    if fn.lower().endswith(IMAGE_EXTS):
+                        return os.path.join(name, fn)
+            except OSError:
+                pass
+    return None
+
+
+def record_path(slug, data_dir=DATA_DIR):
+    return os.path.join(data_dir, f'{slug}.json')
+
+
+def convert(path, mtime, data_dir=DATA_DIR, assets_dir=ASSETS_DIR):
+    """Write the bulletin record for one exported document; returns its slug."""
+    with open(path, 'r', encoding='utf-8', errors='ignore') as f:
+        raw = f.read()
+    _title_src, body = extract_title_body(raw)
+    title, slug, date_iso = weekly_title_slug(mtime)
+    src_dir = os.path.dirname(path)
+    out_assets = os.path.join(assets_dir, slug)
+    body = rewrite_assets(body, src_dir, out_assets)
+    hero = '../assets/img/covers/default.jpg'
+    cover = find_folder_cover(src_dir)
+    if cover:
+        try:
+            shutil.copy2(os.path.join(src_dir, cover), os.path.join(out_assets, os.path.basename(cover)))
+            hero = f'assets/{slug}/{os.path.basename(cover)}'
+        except OSError as e:
+            print(f'[bulten-watcher] cover copy failed: {e}', file=sys.stderr)
+    rec = {
+        'title': title,
+        'date': date_iso,
+        'slug': slug,
+        'hero': hero,
+        'intro': '',
+        'blog': [],
+        'youtube': [],
+        'notes': [],
+        'doc_html': body,
+    }
+    tmp = record_path(slug, data_dir) + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(rec, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, record_path(slug, data_dir))
+    return slug
+
+
+class Watcher:
+    """Scan/debounce/build state of the worker process."""
+
+    def __init__(self, docs_dir=DOCS_DIR, data_dir=DATA_DIR, assets_dir=ASSETS_DIR,
+                 interval=INTERVAL, debounce=DEBOUNCE):
+        self.docs_dir = docs_dir
+        self.data_dir = data_dir
+        self.assets_dir = assets_dir
+        self.interval = interval
+        self.debounce = debounce
+        self.seen = None      # path -> mtime at the last scan (None: nothing scanned yet)
+        self.settling = {}    # path -> monotonic time its mtime last changed
+        self.state = {'pid': os.getpid(), 'scans': 0, 'builds': 0, 'errors': 0, 'pending': 0,
+                      'last_scan': None, 'last_build': None, 'last_error': None}
+        for d in (docs_dir, data_dir, assets_dir):
+            os.makedirs(d, exist_ok=True)
+
+    def documents(self):
+        found = {}
+        for root, _dirs, files in os.walk(self.docs_dir):
+            for fn in files:
+                if fn.lower().endswith('.html'):
+                    p = os.path.join(root, fn)
+                    try:
+                        found[p] = os.path.getmtime(p)
+                    except OSError:
+                        pass
+        return found
+
+    def _current(self, path, mtime):
+        """True when the document's record is newer than the document (nothing to do at startup)."""
+        try:
+            return os.path.getmtime(record_path(weekly_title_slug(mtime)[1], self.data_dir)) >= mtime
+        except OSError:
+            return False
+
+    def scan(self, now):
+        """Note changed documents and return the ones that have settled."""
+        cur = self.documents()
+        first = self.seen is None
+        for p, mt in cur.items():
+            if first:
+                if not self._current(p, mt):
+                    self.settling[p] = now
+            elif self.seen.get(p) != mt:
+                self.settling[p] = now
+        for p in list(self.settling):
+            if p not in cur:
+                del self.settling[p]
+        self.seen = cur
+        due = sorted(p for p, t in self.settling.items() if now - t >= self.debounce or first)
+        for p in due:
+            del self.settling[p]
+        self.state['scans'] += 1
+        self.state['last_scan'] = int(time.time())
+        return [(p, cur[p]) for p in due]
+
+    def build(self, docs, every=False):
+        """Convert `docs` ((path, mtime) pairs) and rebuild their pages, index and feed."""
+        started = time.perf_counter()
+        slugs = set()
+        for path, mtime in docs:
+            try:
+                slugs.add(convert(path, mtime, self.data_dir, self.assets_dir))
+            except OSError as e:
+                self.fail(f'{path}: {e!r}')
+        if not slugs and not every:
+            return
+        if ROOT not in sys.path:
+            sys.path.insert(0, ROOT)
+        from scripts import build_bulten
+        build_bulten.build(None if every else slugs)
+        self.state['builds'] += 1
+        self.state['last_build'] = {'ts': int(time.time()), 'slugs': sorted(slugs),
+                                    'seconds': round(time.perf_counter() - started, 3)}
+
+    def fail(self, message):
+        self.state['errors'] += 1
+        # a failing scan is retried every cycle, log it once
+        if message != self.state['last_error']:
+            print(f'[bulten-watcher] {message}', file=sys.stderr)
+        self.state['last_error'] = message
+
+    def handle(self, job):
+        started = time.perf_counter()
+        errors = self.state['errors']
+        try:
+            if job[0] == 'rebuild':
+                docs = self.documents()
+                slug = job[1] if len(job) > 1 else None
+                picked = [(p, mt) for p, mt in sorted(docs.items())
+                          if slug is None or weekly_title_slug(mt)[1] == slug]
+                self.build(picked, every=slug is None)
+                self.seen = docs
+                for p, _mt in picked:
+                    self.settling.pop(p, None)
+            else:
+                self.build(self.scan(time.monotonic()))
+        except Exception as e:
+            self.fail(f'{job[0]} failed: {e!r}')
+        self.state['pending'] = len(self.settling)
+        return dict(self.state, cycle=time.perf_counter() - started, new_errors=self.state['errors'] - errors)
+
+    def timeout(self):
+        """Wait before the next scan: short while a change is settling."""
+        return min(self.interval, self.debounce) if self.settling else self.interval
+
+
+def run(jobs, status, docs_dir=DOCS_DIR, data_dir=DATA_DIR, assets_dir=ASSETS_DIR,
+        interval=INTERVAL, debounce=DEBOUNCE):
+    """Worker process main loop: jobs from `jobs`, a status dict to `status` after each."""
+    # Ctrl+C reaches the whole process group; the parent stops us with a None job
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    try:
+        os.nice(10)   # rebuilds yield the CPU to the request-serving process
+    except (AttributeError, OSError):
+        pass
+    w = Watcher(docs_dir, data_dir, assets_dir, interval, debounce)
+    status.put(dict(w.state, cycle=None, new_errors=0))
+    job = ('scan',)
+    while True:
+        status.put(w.handle(job))
+        try:
+            job = jobs.get(timeout=w.timeout())
+        except queue.Empty:
+            job = ('scan',)
+        if job is None:
+            return
+
+
+def main():
+    import argparse
+    ap = argparse.ArgumentParser(description='Convert site/bulten_doc exports to bulletins')
+    ap.add_argument('--once', action='store_true', help='build changed documents and exit')
+    ap.add_argument('--all', action='store_true', help='with --once: rebuild every bulletin')
+    ap.add_argument('--interval', type=float, default=INTERVAL)
+    ap.add_argument('--debounce', type=float, default=DEBOUNCE)
+    args = ap.parse_args()
+    w = Watcher(interval=args.interval, debounce=args.debounce)
+    if args.once:
+        state = w.handle(('rebuild', None) if args.all else ('scan',))
+        print(json.dumps(state, ensure_ascii=False))
+        return
+    try:
+        builds = 0
+        while True:
+            state = w.handle(('scan',))
+            if state['builds'] != builds:
+                builds = state['builds']
+                print(f"[bulten-watcher] rebuilt {', '.join(state['last_build']['slugs'])}")
+            time.sleep(w.timeout())
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
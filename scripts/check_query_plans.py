@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+"""
+Query plan checker for the analytics server.
+
+Bootstraps a throwaway database with the server's migrations, runs EXPLAIN QUERY PLAN
+for every statement in analytics_server.HOT_QUERIES and verifies the planner picks the
+expected (covering) index instead of a full table scan. Raw-event queries are checked
+against the newest monthly partition (attached as p_YYYYMM).
+
+Usage:
+  python3 scripts/check_query_plans.py            # fresh temporary database
+  python3 scripts/check_query_plans.py --db data/runtime/analytics.db   # real data + stats
+
+Returns non-zero exit code if any hot query lost its index.
+"""
+import os
+import sys
+import argparse
+import sqlite3
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import analytics_server  # noqa: E402
+
+
+def explain(conn, sql):
+    params = [0] * sql.count('?')
+    if 'LIKE ?' in sql:
+        params[0] = 'view%'
+    return [row[3] for row in conn.execute('EXPLAIN QUERY PLAN ' + sql, params)]
+
+
+def main():
+    ap = argparse.ArgumentParser(description='Check analytics query plans')
+    ap.add_argument('--db', help='existing analytics database (read-only); default: temporary')
+    args = ap.parse_args()
+
+    tmp = None
+    if args.db:
+        db_path = os.path.abspath(args.db)
+        conn = sqlite3.connect(f'file:{db_path}?mode=ro', uri=True)
+        row = conn.execute("SELECT month, file FROM partitions WHERE state IN ('hot','cold') "
+                           "ORDER BY month DESC LIMIT 1").fetchone()
+        if not row:
+            print('No live partitions to check')
+            sys.exit(1)
+        month, rel = row
+        part = os.path.join(os.path.dirname(db_path), rel)
+        alias = analytics_server.attach(conn, month, f'file:{part}?mode=ro')
+    else:
+        tmp = tempfile.TemporaryDirectory()
+        path = os.path.join(tmp.name, 'plans.db')
+        analytics_server.Database(path)
+        conn = sqlite3.connect(path)
+        month = analytics_server.month_key(time.time())
+        part, _ = analytics_server.open_partition(conn, month)
+        conn.commit()
+        alias = analytics_server.attach(conn, month, part)
+    events = alias + '.events'
+
+    failed = 0
+    for name, (sql, expected) in analytics_server.HOT_QUERIES.items():
+        sql, expected = sql.format(events=events), expected.format(events=events)
+        plan = explain(conn, sql)
+        ok = any(expected in line for line in plan)
+        status = 'OK  ' if ok else 'FAIL'
+        print(f'{status} {name}: expected "{expected}"')
+        if not ok:
+            failed += 1
+            for line in plan:
+                print(f'       {line}')
+    conn.close()
+    if tmp:
+        tmp.cleanup()
+    if failed:
+        print(f'{failed} hot queries lost their index')
+        sys.exit(1)
+    print('All hot queries use their indexes')
+
+
+if __name__ == '__main__':
+    main()
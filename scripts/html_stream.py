@@ -0,0 +1,355 @@
+#!/usr/bin/env python3
+"""
+Single-pass HTML rewriting for the site builders.
+
+Tokenizer splits a document into tokens (text, start/end tags, comments, declarations and
+the raw text of <script>/<style>) without normalizing anything, so a token no handler
+touches is written back byte for byte. It is incremental: feed() takes the document in
+chunks as it is read from disk and only holds back a token that is not complete yet.
+
+Rewriter walks the tokens once and hands each one to the handlers registered for its
+kind and tag name (handlers for any tag run first). A handler can edit tok.raw, drop the
+token (return False), insert markup, skip everything up to a closing token, or capture it
+and decide afterwards (e.g. drop a breadcrumb link only if its text matches). Observers
+see every source token that survives the handlers, in document order (text extraction).
+
+StreamWriter writes the result straight to a file. A Slot reserves a place for markup
+that depends on something later in the document (a description taken from body text,
+a footer that is only added if the page has none); only the output after the first
+unfilled slot is held in memory.
+
+    with open(tmp, 'w', encoding='utf-8') as fh:
+        out = StreamWriter(fh)
+        rw = Rewriter(out)
+        rw.on(START, 'img', rewrite_img)
+        rw.run(open(src, encoding='utf-8'))
+"""
+import re
+
+TEXT = 'text'
+START = 'start'
+END = 'end'
+COMMENT = 'comment'
+DECL = 'decl'
+RAW = 'raw'          # contents of <script>/<style>
+# held in a capture only: markup from insert() and places from slot(); observers skip them
+INSERTED = 'inserted'
+SLOT = 'slot'
+
+RAW_TEXT_TAGS = ('script', 'style')
+CHUNK = 1 << 20
+
+# comments are matched separately (Tokenizer.feed): a '>' inside one must not end it
+TAG_RE = re.compile(r'''<(?:!(?!--)[^>]*|\?[^>]*|/[a-zA-Z][^>]*|[a-zA-Z][^\s/>]*(?:"[^"]*"|'[^']*'|[^'">])*)>''')
+NAME_RE = re.compile(r'</?([a-zA-Z][^\s/>]*)')
+ATTR_RE = re.compile(r'''([^\s/>"'=]+)(?:\s*=\s*("[^"]*"|'[^']*'|[^\s>]+))?''')
+
+
+class Token:
+    __slots__ = ('kind', 'raw', 'name')
+
+    def __init__(self, kind, raw, name=None):
+        self.kind = kind
+        self.raw = raw
+        self.name = name
+
+    def attr(self, name, default=None):
+        """Value of attribute `name` of a start tag (None/default when absent, '' when bare)."""
+        if self.kind != START:
+            return default
+        m = NAME_RE.match(self.raw)
+        for a in ATTR_RE.finditer(self.raw, m.end() if m else 1):
+            if a.group(1).lower() == name:
+                v = a.group(2)
+                if v is None:
+                    return ''
+                return v[1:-1] if v[:1] in '"\'' else v
+        return default
+
+    def __repr__(self):
+        return f'Token({self.kind}, {self.raw[:40]!r})'
+
+
+class Tokenizer:
+    def __init__(self):
+        self.buf = ''
+        self.raw_end = None     # closing-tag pattern while inside <script>/<style>
+        self.raw_name = None
+        self.raw_scan = 0       # where to resume looking for raw_end in buf
+
+    def feed(self, data, final=False):
+        """Tokens completed by `data`; with final=True everything left is flushed."""
+        buf = self.buf + data if self.buf else data
+        n = len(buf)
+        pos = 0
+        out = []
+        while pos < n:
+            if self.raw_end is not None:
+                m = self.raw_end.search(buf, max(pos, self.raw_scan))
+                if m is None:
+                    if final:
+                        out.append(Token(RAW, buf[pos:], self.raw_name))
+                        pos = n
+                    else:
+                        # the closing tag may straddle the chunk boundary
+                        self.raw_scan = max(pos, n - 16)
+                    break
+                if m.start() > pos:
+                    out.append(Token(RAW, buf[pos:m.start()], self.raw_name))
+                pos = m.start()
+                self.raw_end = self.raw_name = None
+                self.raw_scan = 0
+                continue
+            lt = buf.find('<', pos)
+            if lt < 0:
+                # text runs up to the next tag, which may be in the next chunk
+                if final:
+                    out.append(Token(TEXT, buf[pos:]))
+                    pos = n
+                break
+            text_at = None
+            if lt > pos:
+                # held back with the '<' below if that cannot be decided before the next chunk
+                text_at = pos
+                out.append(Token(TEXT, buf[pos:lt]))
+                pos = lt
+            if buf.startswith('<!--', pos):
+                end = buf.find('-->', pos + 4)
+                if end < 0:
+                    if not final:
+                        pos = self._hold(out, text_at, pos)
+                        break   # the comment continues in the next chunk
+                    end = n
+                else:
+                    end += 3
+                out.append(Token(COMMENT, buf[pos:end]))
+                pos = end
+                continue
+            m = TAG_RE.match(buf, pos)
+            if m is None:
+                nxt = buf[pos + 1:pos + 2]
+                if not final and (not nxt or nxt.isalpha() or nxt in '!/?'):
+                    pos = self._hold(out, text_at, pos)
+                    break   # a tag cut off by the chunk boundary
+                # a stray '<' is text; keep it with the text around it
+                lt = buf.find('<', pos + 1)
+                if lt < 0 and not final:
+                    pos = self._hold(out, text_at, pos)
+                    break
+                end = n if lt < 0 else lt
+                if out and out[-1].kind == TEXT:
+                    out[-1].raw += buf[pos:end]
+                else:
+                    out.append(Token(TEXT, buf[pos:end]))
+                pos = end
+                continue
+            raw = m.group(0)
+            if raw[1] in '!?':
+                tok = Token(DECL, raw)
+            else:
+                tok = Token(END if raw[1] == '/' else START, raw, NAME_RE.match(raw).group(1).lower())
+            out.append(tok)
+            pos = m.end()
+            if tok.kind == START and tok.name in RAW_TEXT_TAGS and not raw.endswith('/>'):
+                self.raw_name = tok.name
+                self.raw_end = re.compile(r'</%s\s*>' % tok.name, re.IGNORECASE)
+                self.raw_scan = 0
+        self.buf = buf[pos:]
+        if self.raw_end is not None:
+            self.raw_scan -= pos
+        return out
+
+    @staticmethod
+    def _hold(out, text_at, pos):
+        """Take back the text token just added before `pos`; returns where the held-back input starts."""
+        if text_at is None:
+            return pos
+        out.pop()
+        return text_at
+
+
+class Slot:
+    __slots__ = ('text',)
+
+    def __init__(self):
+        self.text = None
+
+
+class StreamWriter:
+    """Writes to `fh` as soon as nothing before the output is waiting on an unfilled Slot."""
+
+    def __init__(self, fh):
+        self.fh = fh
+        self.held = []
+
+    def write(self, s):
+        if self.held:
+            self.held.append(s)
+        elif s:
+            self.fh.write(s)
+
+    def slot(self, slot=None):
+        slot = slot or Slot()
+        self.held.append(slot)
+        if slot.text is not None:
+            self._drain()
+        return slot
+
+    def fill(self, slot, text):
+        slot.text = text
+        self._drain()
+
+    def _drain(self):
+        i = 0
+        for item in self.held:
+            if isinstance(item, Slot):
+                if item.text is None:
+                    break
+                item = item.text
+            if item:
+                self.fh.write(item)
+            i += 1
+        del self.held[:i]
+
+    def close(self):
+        for item in self.held:
+            if isinstance(item, Slot):
+                item = item.text or ''
+            if item:
+                self.fh.write(item)
+        self.held = []
+
+
+class Rewriter:
+    def __init__(self, out):
+        self.out = out
+        self.handlers = {}
+        self.observers = []
+        self.closers = []
+        self.capture = None     # (until, done, tokens, limit) while a handler is capturing
+        self.skip = None        # until() while a handler is skipping
+        self.last_text = None   # text emitted last, held one token so trim_text() can edit it
+
+    def on(self, kind, name, fn):
+        """Call fn(rewriter, tok) for tokens of `kind` (and tag `name`; None: any)."""
+        self.handlers.setdefault((kind, name), []).append(fn)
+
+    def observe(self, fn):
+        self.observers.append(fn)
+
+    def at_close(self, fn):
+        """Call fn(rewriter) once the whole document has been read (fill remaining slots)."""
+        self.closers.append(fn)
+
+    def run(self, fh, chunk=CHUNK):
+        tz = Tokenizer()
+        while True:
+            data = fh.read(chunk)
+            for tok in tz.feed(data, final=not data):
+                self.dispatch(tok)
+            if not data:
+                break
+        self.close()
+
+    def dispatch(self, tok):
+        if self.skip is not None:
+            if self.skip(tok):
+                self.skip = None
+            return
+        for key in ((tok.kind, None), (tok.kind, tok.name)) if tok.name else ((tok.kind, None),):
+            for fn in self.handlers.get(key, ()):
+                if fn(self, tok) is False:
+                    return
+        self.emit(tok)
+
+    def emit(self, tok):
+        if self.capture is not None:
+            until, done, tokens, limit = self.capture
+            tokens.append(tok)
+            if until(tok):
+                self.capture = None
+                result = done(self, tokens)
+                if result is None:
+                    self._release(tokens)
+                else:
+                    self.insert(result)
+                    # places reserved inside the replaced markup still get written
+                    self._release([t for t in tokens if t.kind == SLOT])
+            elif limit is not None and len(tokens) >= limit:
+                # not what the handler was waiting for: pass the held tokens on unchanged
+                self.capture = None
+                self._release(tokens)
+            return
+        if tok.kind == SLOT:
+            self._flush_text()
+            self.out.slot(tok.raw)
+            return
+        if tok.kind != INSERTED:
+            for fn in self.observers:
+                fn(tok)
+        self._flush_text()
+        if tok.kind == TEXT:
+            self.last_text = tok.raw
+        else:
+            self.out.write(tok.raw)
+
+    def start_capture(self, tok, until, done, limit=None):
+        """Hold `tok` and what follows until until(token) is true, then emit done(rw, tokens)
+        if it returns a string, or the held tokens unchanged if it returns None.
+
+        With `limit`, the capture gives up (emitting the held tokens unchanged) once it holds
+        that many tokens without reaching until(); a capture that is never closed would
+        otherwise hold the rest of the document.
+        """
+        self.capture = (until, done, [tok], limit)
+        return False
+
+    def _release(self, tokens):
+        for t in tokens:
+            self.emit(t)
+
+    def skip_until(self, until):
+        """Drop the tokens that follow, up to and including the first one until(token) accepts;
+        no handler or observer sees them."""
+        self.skip = until
+
+    def insert(self, html):
+        """Markup added by a handler; not seen by observers."""
+        if self.capture is not None:
+            self.capture[2].append(Token(INSERTED, html))
+            return
+        self._flush_text()
+        self.out.write(html)
+
+    def slot(self):
+        """A place in the output to fill() later; inside a capture it stays where it was taken."""
+        if self.capture is not None:
+            slot = Slot()
+            self.capture[2].append(Token(SLOT, slot))
+            return slot
+        self._flush_text()
+        return self.out.slot()
+
+    def fill(self, slot, text):
+        self.out.fill(slot, text)
+
+    def trim_text(self, suffix):
+        """Remove `suffix` from the end of the text emitted just before the current token."""
+        if self.last_text is not None and self.last_text.endswith(suffix):
+            self.last_text = self.last_text[:-len(suffix)]
+
+    def _flush_text(self):
+        if self.last_text is not None:
+            self.out.write(self.last_text)
+            self.last_text = None
+
+    def close(self):
+        if self.capture is not None:
+            # unterminated capture: keep what was held
+            tokens = self.capture[2]
+            self.capture = None
+            self._release(tokens)
+        self._flush_text()
+        for fn in self.closers:
+            fn(self)
+        self.out.close()
@@ -1,7 +1,11 @@
 #!/usr/bin/env python3
 """
-Watches source blog HTML files and rebuilds the site automatically when new files are
-added or existing ones are changed. Uses only stdlib (polling every 2 seconds).
+Watches source blog HTML files (content/*.html) and rebuilds the site automatically when
+new files are added or existing ones are changed. Uses only stdlib (polling every 2 seconds).
+
+Builds are incremental: build_blog keeps a content-hash manifest (data/build/), so a
+change re-renders only the posts whose source changed, and the index/home/search pages
+only when their card data did. Output goes to site/blog; the sources are never rewritten.
 
 Usage:
   python3 scripts/watch_posts.py
@@ -16,15 +20,13 @@ import time
 import pathlib
 
 ROOT = pathlib.Path(__file__).resolve().parents[1]
-BLOG_DIR = ROOT / 'site' / 'blog'
+SOURCE_DIR = ROOT / 'content'
 
 def snapshot_sources():
-    # Source posts are site/blog/*.html (excluding index.html)
+    # Source posts are content/*.html, plus the slug pins next to them
     shots = {}
-    BLOG_DIR.mkdir(parents=True, exist_ok=True)
-    for p in BLOG_DIR.glob('*.html'):
-        if p.name.lower() == 'index.html':
-            continue
+    SOURCE_DIR.mkdir(parents=True, exist_ok=True)
+    for p in [*SOURCE_DIR.glob('*.html'), SOURCE_DIR / 'slugs.json']:
         try:
             shots[p] = p.stat().st_mtime
         except FileNotFoundError:
@@ -37,10 +39,10 @@ def rebuild():
     sys.path.insert(0, str(ROOT / 'scripts'))
     import importlib
     mod = importlib.import_module('build_blog')
-    mod.main()
+    mod.main([])
 
 def main():
-    print('[watch] Watching root HTML posts. Press Ctrl+C to stop.')
+    print('[watch] Watching content/*.html. Press Ctrl+C to stop.')
     prev = snapshot_sources()
     rebuild()  # initial build
     try:
@@ -0,0 +1,408 @@
+import calendar
+import gzip
+import http.client
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from http.server import ThreadingHTTPServer
+
+SCRIPTS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'scripts')
+sys.path.insert(0, SCRIPTS)
+
+import analytics_server as an  # noqa: E402
+
+
+def month_ts(year, month, day=15, hour=12):
+    return calendar.timegm((year, month, day, hour, 0, 0))
+
+
+def rows_for(ts_list, page='/blog/a', event='view'):
+    return [an.event_row({'ts': ts, 'cid': f'c{i % 7}', 'sid': f's{i % 11}', 'page': page, 'event': event},
+                         ts, '127.0.0.1', 'test') for i, ts in enumerate(ts_list)]
+
+
+def blocks(data, size=7):
+    return (data[i:i + size] for i in range(0, len(data), size))
+
+
+def ndjson(records):
+    return ''.join(json.dumps(r) + '\n' for r in records).encode('utf-8')
+
+
+class ServerTestCase(unittest.TestCase):
+    """A fresh database in a temp dir, written through a real IngestQueue."""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.db = an.Database(os.path.join(self.tmp, 'analytics.db'), readers=2)
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def ingest(self, **kw):
+        kw.setdefault('batch_size', 100000)
+        kw.setdefault('max_delay', 0.05)
+        kw.setdefault('maintenance_interval', 0)
+        q = an.IngestQueue(self.db, **kw)
+        q.start()
+        return q
+
+    def write(self, *batches):
+        """Write each batch in one transaction group; returns the writer's stats."""
+        q = self.ingest()
+        for rows in batches:
+            self.assertTrue(q.put(rows))
+        q.close(timeout=None)
+        return q.snapshot()
+
+    def load(self, data, fmt='ndjson', chunk=an.BULK_CHUNK):
+        """BulkLoad report for `data` (bytes), fed in small blocks to cross line boundaries."""
+        q = self.ingest()
+        load = an.BulkLoad(q, chunk=chunk)
+        try:
+            load.run(an.bulk_records(blocks(data), fmt), fmt == 'csv')
+        finally:
+            q.close(timeout=None)
+        return load.report()
+
+    def query(self, sql, params=()):
+        conn = self.db.acquire()
+        try:
+            return conn.execute(sql, params).fetchall()
+        finally:
+            self.db.release(conn)
+
+    def raw_count(self, since=0, until=1 << 62):
+        conn = self.db.acquire()
+        try:
+            return sum(conn.execute(f"SELECT COUNT(*) FROM {t} WHERE ts >= ? AND ts < ?", (since, until)).fetchone()[0]
+                       for t in an.each_partition(conn, since, until))
+        finally:
+            self.db.release(conn)
+
+
+class PartitionTest(ServerTestCase):
+    def test_one_batch_spanning_twelve_months(self):
+        # more months than the writer keeps attached, all in one queue item
+        ts = [month_ts(2024, m, d) for m in range(1, 13) for d in (3, 17)]
+        stats = self.write(rows_for(ts))
+        self.assertEqual(stats['failed'], 0)
+        self.assertEqual(stats['rows_written'], len(ts))
+        parts = self.query("SELECT month, rows, state FROM partitions ORDER BY month")
+        self.assertEqual(parts, [(f'2024{m:02d}', 2, 'hot') for m in range(1, 13)])
+        self.assertEqual(self.raw_count(), len(ts))
+        ids = []
+        conn = self.db.acquire()
+        try:
+            for t in an.each_partition(conn, 0, 1 << 62):
+                ids += [r[0] for r in conn.execute(f"SELECT id FROM {t}")]
+        finally:
+            self.db.release(conn)
+        # ids stay unique and gapless across the per-group commits
+        self.assertEqual(sorted(ids), list(range(min(ids), min(ids) + len(ts))))
+
+
+class CollectTest(ServerTestCase):
+    """/api/collect -> writer flush -> /api/stats/summary, over HTTP."""
+
+    def setUp(self):
+        super().setUp()
+        srv = self.srv = ThreadingHTTPServer(('127.0.0.1', 0), an.Handler)
+        srv.db = self.db
+        srv.metrics = an.Metrics()
+        srv.ingest = an.IngestQueue(self.db, max_delay=0.01, maintenance_interval=0, metrics=srv.metrics)
+        srv.cache = an.ResultCache(16, 60)
+        srv.live = srv.snapshot = srv.bulten = None
+        srv.ingest.start()
+        threading.Thread(target=srv.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        self.srv.shutdown()
+        self.srv.server_close()
+        self.srv.ingest.close(timeout=None)
+        super().tearDown()
+
+    def request(self, method, path, body=None):
+        conn = http.client.HTTPConnection(*self.srv.server_address, timeout=10)
+        try:
+            conn.request(method, path, body and json.dumps(body),
+                         {'Content-Type': 'application/json', 'X-Analytics-Token': an.TOKEN})
+            resp = conn.getresponse()
+            return resp.status, resp.read()
+        finally:
+            conn.close()
+
+    def flushed(self, n):
+        deadline = time.monotonic() + 10
+        while self.srv.ingest.snapshot()['rows_written'] < n:
+            self.assertLess(time.monotonic(), deadline, 'writer did not flush')
+            time.sleep(0.01)
+
+    def summary(self):
+        status, body = self.request('GET', '/api/stats/summary')
+        self.assertEqual(status, 200)
+        return json.loads(body)
+
+    def test_collected_events_show_up_in_stats(self):
+        now = int(time.time())
+        batch = [{'ts': now - 60, 'cid': 'c1', 'sid': 's1', 'page': '/blog/a', 'event': 'view'},
+                 {'ts': now - 50, 'cid': 'c2', 'sid': 's2', 'page': '/blog/a', 'event': 'view'},
+                 {'ts': now - 40, 'cid': 'c2', 'sid': 's2', 'page': '/blog/b', 'event': 'view'},
+                 {'ts': now - 30, 'cid': 'c2', 'sid': 's2', 'page': '/', 'event': 'search', 'value': 'sql'}]
+        self.assertEqual(self.request('POST', '/api/collect', {'batch': batch})[0], 204)
+        self.flushed(4)
+        data = self.summary()
+        self.assertEqual((data['last24']['views'], data['last24']['searches']), (3, 1))
+        self.assertEqual(data['tops']['pages'][0], {'page': '/blog/a', 'c': 2})
+        self.assertEqual(data['tops']['searches'], [{'k': 'sql', 'c': 1}])
+        # the cached summary must not hide the next batch
+        self.assertEqual(self.request('POST', '/api/collect', batch[2])[0], 204)
+        self.flushed(5)
+        self.assertEqual(self.summary()['last24']['views'], 4)
+
+    @unittest.skipIf(an.numpy_or_none() is None, 'numpy is not installed')
+    def test_open_funnel_counts_the_last_seconds(self):
+        now = int(time.time())
+        self.assertEqual(self.request('POST', '/api/collect', {'ts': now, 'cid': 'c1', 'event': 'view'})[0], 204)
+        self.flushed(1)
+        status, body = self.request('GET', '/api/stats/funnel?days=1')
+        self.assertEqual(status, 200)
+        report = json.loads(body)
+        self.assertGreater(report['until'], now)
+        self.assertEqual(report['steps'][0]['count'], 1)
+
+
+class RollupTest(ServerTestCase):
+    def events(self):
+        t0 = month_ts(2024, 3, 30, 22)
+        out = []
+        for i in range(300):
+            ts = t0 + i * 997   # crosses hours, days and the month boundary
+            ev = ('view', 'click', 'search', 'appointment')[i % 4]
+            eo = {'ts': ts, 'cid': f'c{i % 13}', 'sid': f's{i % 29}', 'page': f'/blog/p{i % 5}', 'event': ev}
+            if ev == 'click':
+                eo['element'] = 'subscribe-btn' if i % 3 else 'nav'
+                eo['props'] = {'href': 'https://www.youtube.com/@x'} if i % 5 == 0 else {}
+            elif ev == 'search':
+                eo['value'] = f'q{i % 7}'
+            elif ev == 'appointment':
+                eo['props'] = {'start': f'2024-04-01T{i % 24:02d}:00'}
+            out.append(an.event_row(eo, ts, '127.0.0.1', 'test'))
+        return out
+
+    def rollups(self):
+        return (self.query("SELECT grain, bucket, event, page, n FROM rollup_pages ORDER BY 1, 2, 3, 4"),
+                self.query("SELECT grain, bucket, event, value, n FROM rollup_values ORDER BY 1, 2, 3, 4"))
+
+    def test_incremental_rollups_match_a_raw_recount(self):
+        rows = self.events()
+        self.write(rows[:100], rows[100:170], rows[170:])
+        pages, values = self.rollups()
+        self.assertTrue(pages and values)
+        # the daily view counts equal a plain COUNT(*) over the raw events
+        daily = {(b, p): n for g, b, e, p, n in pages if g == an.DAY and e == 'view'}
+        raw = {}
+        conn = self.db.acquire()
+        try:
+            for t in an.each_partition(conn, 0, 1 << 62):
+                for day, page, n in conn.execute(
+                        f"SELECT ts - ts % {an.DAY}, page, COUNT(*) FROM {t} WHERE event = 'view' GROUP BY 1, 2"):
+                    raw[(day, page)] = n
+            # an unaligned window: raw head and tail plus hour and day buckets
+            since, until = rows[7][0] + 1, rows[250][0] - 1
+            totals = an.rollup_totals(conn, 'pages', since, by_key=False, until=until)
+        finally:
+            self.db.release(conn)
+        self.assertEqual(daily, raw)
+        self.assertEqual(sum(totals[(e,)] for e in ('view', 'click', 'search', 'appointment')),
+                         self.raw_count(since, until))
+        # and the whole tables equal a rebuild from raw events
+        self.assertEqual(self.db.rebuild_rollups(), len(rows))
+        self.assertEqual(self.rollups(), (pages, values))
+
+
+class RoutingRetentionTest(ServerTestCase):
+    def test_rows_land_in_their_month_file(self):
+        ts = [month_ts(2024, 1, 31, 23), month_ts(2024, 2, 1, 0), month_ts(2024, 2, 20), month_ts(2024, 4, 2)]
+        self.write(rows_for(ts))
+        pdir = an.partition_dir(self.db.path)
+        self.assertEqual(sorted(os.listdir(pdir)), ['2024-01.db', '2024-02.db', '2024-04.db'])
+        self.assertEqual(self.query("SELECT month, rows FROM partitions ORDER BY month"),
+                         [('202401', 1), ('202402', 2), ('202404', 1)])
+        conn = self.db.acquire()
+        try:
+            feb = list(an.each_partition(conn, month_ts(2024, 2, 10), month_ts(2024, 2, 11)))
+        finally:
+            self.db.release(conn)
+        self.assertEqual(feb, ['p_202402.events'])
+        self.assertEqual(self.raw_count(*an.month_bounds('202402')), 2)
+
+    def maintain(self, now, mode):
+        conn = self.db.writer()
+        try:
+            return self.db.maintain(conn, now=now, retention_months=3, retention_mode=mode)
+        finally:
+            conn.close()
+
+    def test_retention_drops_old_months_and_keeps_rollups(self):
+        old = [month_ts(2024, 1, 10), month_ts(2024, 2, 10)]
+        new = [month_ts(2024, 6, 10)]
+        self.write(rows_for(old + new))
+        now = month_ts(2024, 6, 20)
+        report = self.maintain(now, 'drop')
+        self.assertEqual(report['retired'], ['202401', '202402'])
+        self.assertEqual(self.query("SELECT month, state FROM partitions ORDER BY month"),
+                         [('202401', 'dropped'), ('202402', 'dropped'), ('202406', 'hot')])
+        # replaced files (the hot originals and the dropped cold copies) go on the next pass
+        self.assertEqual(sorted(self.maintain(now, 'drop')['removed']),
+                         ['2024-01.cold.db', '2024-01.db', '2024-02.cold.db', '2024-02.db'])
+        self.assertEqual(sorted(os.listdir(an.partition_dir(self.db.path))), ['2024-06.db'])
+        self.assertEqual(self.raw_count(), 1)
+        conn = self.db.acquire()
+        try:
+            totals = an.rollup_totals(conn, 'pages', month_ts(2024, 1, 1), by_key=False, until=now)
+        finally:
+            self.db.release(conn)
+        self.assertEqual(totals[('view',)], 3)
+        # a late event for a retired month is counted as expired, not written
+        stats = self.write(rows_for([month_ts(2024, 1, 11), month_ts(2024, 6, 11)]))
+        self.assertEqual((stats['rows_written'], stats['expired'], stats['failed']), (1, 1, 0))
+
+    def test_retention_archives(self):
+        self.write(rows_for([month_ts(2024, 1, 10), month_ts(2024, 6, 10)]))
+        self.maintain(month_ts(2024, 6, 20), 'archive')
+        (rel,), = self.query("SELECT file FROM partitions WHERE month = '202401' AND state = 'archived'")
+        self.assertEqual(rel, os.path.join('analytics-events', 'archive', '2024-01.db'))
+        archived = an.sqlite3.connect(os.path.join(self.tmp, rel))
+        try:
+            self.assertEqual(archived.execute("SELECT COUNT(*) FROM events").fetchone()[0], 1)
+        finally:
+            archived.close()
+
+
+class ResultCacheTest(ServerTestCase):
+    def test_new_batch_invalidates_only_overlapping_windows(self):
+        q = self.ingest()
+
+        def flush(rows):
+            mark = q.watermark()
+            self.assertTrue(q.put(rows))
+            deadline = time.monotonic() + 10
+            while q.watermark() == mark:
+                self.assertLess(time.monotonic(), deadline, 'writer did not flush')
+                time.sleep(0.01)
+        try:
+            flush(rows_for([month_ts(2024, 3, 5)]))
+            cache = an.ResultCache(8, 60)
+            jan, feb = an.month_bounds('202401'), an.month_bounds('202402')
+            mark = q.watermark()
+            cache.put(('jan',), b'jan', mark, jan[0], jan[1], True)
+            cache.put(('feb',), b'feb', mark, feb[0], feb[1], True)
+            self.assertEqual(cache.get(('jan',), q), b'jan')
+            flush(rows_for([month_ts(2024, 2, 5)]))
+            self.assertEqual(cache.get(('jan',), q), b'jan')
+            self.assertIsNone(cache.get(('feb',), q))
+            self.assertEqual(cache.snapshot()['invalidated'], 1)
+        finally:
+            q.close(timeout=None)
+
+class BulkRecordsTest(unittest.TestCase):
+    def test_ndjson(self):
+        data = ndjson([{'ts': 1, 'cid': 'a'}, {'ts': 2, 'page': '/x'}]) + b'\n{"ts": 3}'
+        self.assertEqual(list(an.bulk_records(blocks(data))),
+                         [(1, {'ts': 1, 'cid': 'a'}, None), (2, {'ts': 2, 'page': '/x'}, None), (4, {'ts': 3}, None)])
+
+    def test_csv(self):
+        data = ('\ufeffts,client_id,page,props\n'
+                '5,c1,/a,"{""tag"": ""x""}"\n'
+                '6,,"/multi\nline",\n').encode('utf-8')
+        recs = list(an.bulk_records(blocks(data), 'csv'))
+        self.assertEqual([n for n, _rec, _reason in recs], [2, 4])
+        row, reason = an.bulk_row(recs[1][1], csv=True)
+        self.assertIsNone(reason)
+        self.assertEqual(row[:7], (6, None, None, None, None, None, '/multi\nline'))
+        row, _reason = an.bulk_row(recs[0][1], csv=True)
+        self.assertEqual((row[0], row[1], row[10], row[13]), (5, 'c1', '{"tag": "x"}', 'x'))
+
+    def test_gzip_detected_and_concatenated(self):
+        a, b = ndjson([{'ts': 1}]), ndjson([{'ts': 2}])
+        data = gzip.compress(a) + gzip.compress(b)
+        self.assertEqual([rec for _n, rec, _r in an.bulk_records(blocks(data))], [{'ts': 1}, {'ts': 2}])
+        with self.assertRaises(an.zlib.error):
+            list(an.bulk_records(blocks(gzip.compress(a)[:-12])))
+
+    def test_malformed_lines(self):
+        data = b'\n'.join([
+            b'{"ts": 1}',
+            b'{"ts": ',                          # json
+            b'[1, 2]',                           # not_object
+            b'{"page": "/x"}',                   # ts
+            b'{"ts": 2, "page": {"a": 1}}',      # type
+            b'{"ts": 3, "page": "' + b'x' * (an.BULK_MAX_LINE + 10) + b'"}',   # too_long
+            b'{"ts": 4}',
+        ])
+        reasons = [reason or an.bulk_row(rec)[1] for _n, rec, reason in an.bulk_records(blocks(data, 4096))]
+        self.assertEqual(reasons, [None, 'json', 'not_object', 'ts', 'type', 'too_long', None])
+
+
+class BulkLoadTest(ServerTestCase):
+    def test_malformed_lines_are_counted_and_sampled(self):
+        data = b'{"ts": 1700000000}\nnot json\n{"ts": -1}\n{"ts": 1700000001}\n'
+        report = self.load(data)
+        self.assertEqual((report['lines'], report['written'], report['invalid']), (4, 2, 2))
+        self.assertEqual(report['errors'], {'json': 1, 'ts': 1})
+        self.assertEqual(report['samples'], [{'line': 2, 'error': 'json'}, {'line': 3, 'error': 'ts'}])
+        self.assertEqual((report['failed'], report['pending']), (0, 0))
+
+    def test_multi_month_history_end_to_end(self):
+        # daily events over 14 months in chunks that each span several months
+        start = month_ts(2023, 11, 1)
+        days = (month_ts(2025, 1, 1) - start) // an.DAY
+        recs = [{'ts': start + d * an.DAY + 3600, 'client_id': f'c{d % 5}', 'page': f'/blog/p{d % 3}', 'event': 'view'}
+                for d in range(days)]
+        report = self.load(gzip.compress(ndjson(recs)), chunk=100)
+        self.assertEqual(report['written'], days)
+        self.assertEqual((report['invalid'], report['failed'], report['pending'], report['expired']), (0, 0, 0, 0))
+        self.assertEqual(len(self.query("SELECT month FROM partitions")), 14)
+        self.assertEqual(self.raw_count(), days)
+        conn = self.db.acquire()
+        try:
+            totals = an.rollup_totals(conn, 'pages', start, events=('view',), by_key=False, until=start + days * an.DAY)
+        finally:
+            self.db.release(conn)
+        self.assertEqual(totals[('view',)], days)
+
+    def test_csv_load(self):
+        data = b'ts,client_id,page,event\n1700000000,c1,/a,view\n1700000060,,/b,view\n'
+        report = self.load(data, 'csv')
+        self.assertEqual((report['written'], report['invalid']), (2, 0))
+        self.assertEqual(self.query("SELECT COUNT(*) FROM partitions"), [(1,)])
+
+
+class LoadCommandTest(unittest.TestCase):
+    def run_load(self, data):
+        with tempfile.TemporaryDirectory() as tmp:
+            src = os.path.join(tmp, 'events.ndjson')
+            with open(src, 'wb') as f:
+                f.write(data)
+            proc = subprocess.run([sys.executable, os.path.join(SCRIPTS, 'analytics_server.py'),
+                                   '--db', os.path.join(tmp, 'a.db'), '--load', src],
+                                  capture_output=True, text=True, timeout=120)
+        return proc.returncode, json.loads(proc.stdout.strip().splitlines()[-1])[src]
+
+    def test_exit_status(self):
+        code, report = self.run_load(ndjson([{'ts': 1700000000}, {'ts': 1700000001}]))
+        self.assertEqual((code, report['written']), (0, 2))
+        code, report = self.run_load(ndjson([{'ts': 1700000000}]) + b'{"ts": "x"}\n')
+        self.assertEqual((code, report['written'], report['invalid']), (1, 1, 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
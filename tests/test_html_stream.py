@@ -0,0 +1,69 @@
+import io
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'scripts'))
+
+import html_stream  # noqa: E402
+
+DOC = (
+    '<!DOCTYPE html><html><head><title>T</title>'
+    '<style>.a{background:url(x.png)}</style></head>'
+    '<body><!-- <div class="old">x</div> --><p>a < b</p>'
+    '<ul class="sb-navigation"><li><a href="#">Ana Sayfa</a></li></ul>'
+    '<script>if (a<b) x = "</div>";</script><!-- eski -- yorum -->son</body></html>'
+)
+
+
+def tokens(doc, chunk):
+    tz = html_stream.Tokenizer()
+    out = []
+    for i in range(0, len(doc), chunk):
+        out.extend(tz.feed(doc[i:i + chunk]))
+    out.extend(tz.feed('', final=True))
+    return [(t.kind, t.raw) for t in out]
+
+
+class TokenizerChunkTest(unittest.TestCase):
+    def test_tokens_do_not_depend_on_chunk_size(self):
+        whole = tokens(DOC, len(DOC))
+        self.assertEqual(''.join(raw for _kind, raw in whole), DOC)
+        for chunk in (1, 2, 3, 7, 13, 64):
+            self.assertEqual(tokens(DOC, chunk), whole, f'chunk={chunk}')
+
+    def test_comment_with_tags_is_one_token(self):
+        for chunk in (7, 13, 1 << 20):
+            toks = tokens('<!-- <div class="old">x</div> -->', chunk)
+            self.assertEqual(toks, [(html_stream.COMMENT, '<!-- <div class="old">x</div> -->')])
+
+
+class RewriterCaptureTest(unittest.TestCase):
+    def rewrite(self, doc):
+        out = io.StringIO()
+        rw = html_stream.Rewriter(html_stream.StreamWriter(out))
+        slots = []
+
+        def link(rw, tok):
+            return rw.start_capture(tok, lambda t: t.kind == html_stream.END and t.name == 'a',
+                                    lambda rw, tokens: None, limit=3)
+
+        def body_end(rw, tok):
+            slots.append(rw.slot())
+        rw.on(html_stream.START, 'a', link)
+        rw.on(html_stream.END, 'body', body_end)
+        rw.at_close(lambda rw: [rw.fill(s, '<footer>') for s in slots])
+        rw.run(io.StringIO(doc), chunk=5)
+        return out.getvalue()
+
+    def test_slot_taken_in_capture_keeps_its_place(self):
+        doc = '<body><p>intro</p><a href="#top">link </body>'
+        self.assertEqual(self.rewrite(doc), '<body><p>intro</p><a href="#top">link <footer></body>')
+
+    def test_unclosed_capture_gives_up_after_limit(self):
+        doc = '<body><a href="#top">unclosed <p>rest</p></body>'
+        self.assertEqual(self.rewrite(doc), '<body><a href="#top">unclosed <p>rest</p><footer></body>')
+
+
+if __name__ == '__main__':
+    unittest.main()